@@ -1,4 +1,12 @@
+from .batch import Batch
 from .file import File
 from .finder import FileFinder
-from .database import Database
+from .archiver import Archiver
+from .database import Database, DatabasePool
+from .partition import Partitioner
+from .metrics import Metrics
 from .etl import ETL
+from .scheduler import Scheduler
+from .daemon import Daemon
+from .fraud import FraudEngine
+from .detector import FraudDetector
@@ -0,0 +1,112 @@
+from typing import List, Tuple, BinaryIO
+from queue import Queue
+from threading import Thread, Lock
+import gzip
+import hashlib
+import os
+import shutil
+from .file import File
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Archiver:
+    """Class for compressing processed files to dated archive directories in background thread
+
+    File {path}/{filename} is archived to {path}/archive/{file date}/{filename}.gz (or .zst). Archive is
+    decompressed and its content hash is compared with hash of file before file is removed, file is kept in place
+    if archiving fails (ingest ledger skips it on the next run).
+    """
+
+    __EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+    __CHUNK_SIZE = 1 << 20
+
+    def __init__(self, method: str = 'gzip', level: int = None) -> None:
+        if method not in self.__EXTENSIONS:
+            raise ValueError(f"Unknown compression method '{method}', use one of {tuple(self.__EXTENSIONS)}")
+        if method == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires zstandard package')
+        self.__method = method
+        self.__level = level
+        self.__queue = Queue()
+        self.__lock = Lock()
+        self.__thread = None
+        self.__archived: List[str] = []
+        self.__errors: List[Tuple[str, Exception]] = []
+
+    def __open(self, path: str, mode: str) -> BinaryIO:
+        """Method for opening compressed file"""
+        if self.__method == 'gzip':
+            return gzip.open(path, mode, compresslevel=6 if self.__level is None else self.__level)
+        if mode == 'wb':
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=self.__level or 3))
+        return zstandard.open(path, mode)
+
+    @staticmethod
+    def __get_stream_digest(stream: BinaryIO) -> str:
+        """Method for calculating content hash of stream"""
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(Archiver.__CHUNK_SIZE), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def __archive(self, filepath: str, digest: str = None) -> str:
+        """Method for compressing file, verifying archive and removing file"""
+        path, filename, _, dt, _ = File.split_name(filepath)
+        archive_path = os.path.join(path, 'archive', dt.isoformat())
+        os.makedirs(archive_path, exist_ok=True)
+        archive_file = os.path.join(archive_path, f'{filename}.{self.__EXTENSIONS[self.__method]}')
+        digest = digest or File.get_digest(filepath)
+        with open(filepath, 'rb') as source, self.__open(f'{archive_file}.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target, self.__CHUNK_SIZE)
+        with self.__open(f'{archive_file}.tmp', 'rb') as archive:
+            if self.__get_stream_digest(archive) != digest:
+                os.remove(f'{archive_file}.tmp')
+                raise ValueError(f'Checksum of archive {archive_file} does not match file {filepath}')
+        os.replace(f'{archive_file}.tmp', archive_file)
+        os.remove(filepath)
+        return archive_file
+
+    def __run(self) -> None:
+        """Method for archiving queued files"""
+        while True:
+            filepath, digest = self.__queue.get()
+            try:
+                archive_file = self.__archive(filepath, digest)
+                with self.__lock:
+                    self.__archived.append(archive_file)
+            except Exception as error:
+                with self.__lock:
+                    self.__errors.append((filepath, error))
+            finally:
+                self.__queue.task_done()
+
+    def archive(self, filepath: str, digest: str = None) -> None:
+        """Method for queueing file for archiving, content hash is calculated if it is not given"""
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='archiver', daemon=True)
+                self.__thread.start()
+        self.__queue.put((filepath, digest))
+
+    def wait(self) -> List[str]:
+        """Method for waiting for queued files, returns archives created since last call
+
+        OSError is raised if some files were not archived, they are left in place.
+        """
+        self.__queue.join()
+        with self.__lock:
+            archived, self.__archived = self.__archived, []
+            errors, self.__errors = self.__errors, []
+        if errors:
+            raise OSError('Files were not archived: ' + '; '.join(f'{filepath}: {error}'
+                                                                  for filepath, error in errors))
+        return archived
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,195 @@
+from typing import List, Dict, Sequence, Callable
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import numpy as np
+
+
+def _to_datetime(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to datetime array, empty values are NaT, invalid ones are added to errors"""
+    try:
+        return np.array(values, dtype='datetime64[us]')
+    except ValueError:
+        pass
+    result = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[us]')
+    for position, (value, line) in enumerate(zip(values, lines)):
+        try:
+            result[position] = np.datetime64(value, 'us')
+        except ValueError:
+            errors.append((line, header, value))
+    return result
+
+
+def _to_fixed_point(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to integers scaled by 10^_FIXED_POINT_SCALE, invalid values are added to errors
+
+    Values up to 15 digits are converted exactly through float64 at once, longer or invalid ones and ones with
+    more digits after point than scale (float does not round them half up) are converted one by one.
+    Empty values are converted to _FIXED_POINT_NULL.
+    """
+    if values and max(map(len, values)) <= 15:
+        try:
+            scaled = np.array(values, dtype=np.float64) * 10 ** _FIXED_POINT_SCALE
+            result = np.rint(scaled)
+            if np.isfinite(result).all() and (np.abs(scaled - result) < 0.25).all():
+                return result.astype(np.int64)
+        except ValueError:
+            pass
+    result = np.full(len(values), _FIXED_POINT_NULL, dtype=np.int64)
+    for position, (value, line) in enumerate(zip(values, lines)):
+        if value == '':
+            continue
+        try:
+            result[position] = int(Decimal(value).scaleb(_FIXED_POINT_SCALE).to_integral_value(ROUND_HALF_UP))
+        except (InvalidOperation, ValueError, OverflowError):
+            errors.append((line, header, value))
+    return result
+
+
+def _to_number(dtype: str) -> Callable[[Sequence[str], Sequence[int], str, List[tuple]], np.ndarray]:
+    """Function for creating converter of column to integer or float array, empty values are converted to 0"""
+
+    def convert(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+        strings = np.array(values, dtype=str)
+        strings[strings == ''] = '0'
+        try:
+            return strings.astype(dtype)
+        except (ValueError, OverflowError):
+            pass
+        result = np.zeros(len(values), dtype=dtype)
+        for position, (value, line) in enumerate(zip(strings.tolist(), lines)):
+            try:
+                result[position] = value
+            except (ValueError, OverflowError):
+                errors.append((line, header, value))
+        return result
+
+    return convert
+
+
+def _to_text(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to UTF-8 bytes array, ASCII columns are encoded at once"""
+    try:
+        return np.array(values, dtype=bytes)
+    except UnicodeEncodeError:
+        return np.array([value.encode('utf-8') for value in values], dtype=bytes)
+
+
+def _to_boolean(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to boolean array, invalid values are added to errors"""
+    strings = np.char.lower(np.array(values, dtype=str))
+    result = np.isin(strings, _TRUE)
+    for position in np.flatnonzero(~result & ~np.isin(strings, _FALSE + ('',))).tolist():
+        errors.append((lines[position], header, values[position]))
+    return result
+
+
+_FIXED_POINT_SCALE = 2
+
+_FIXED_POINT_NULL = np.iinfo(np.int64).min
+
+_TRUE = ('t', 'true', 'y', 'yes', '1')
+
+_FALSE = ('f', 'false', 'n', 'no', '0')
+
+# Declared column type -> function converting column of strings to array
+_PARSERS = {'text': _to_text,
+            'timestamp': _to_datetime,
+            'date': lambda values, lines, header, errors: _to_datetime(values, lines, header,
+                                                                       errors).astype('datetime64[D]'),
+            'decimal': _to_fixed_point,
+            'integer': _to_number('int64'),
+            'float': _to_number('float64'),
+            'boolean': _to_boolean}
+
+
+class Batch:
+    """Class for columnar batch of rows: one typed NumPy array and null mask per column
+
+    Column types are declared (e.g. by result description of query): text is stored as UTF-8 bytes, timestamp and
+    date as datetime64, decimal as int64 scaled by 10^2, integer, float and boolean as NumPy numbers.
+    """
+
+    TYPES = tuple(_PARSERS)
+
+    def __init__(self, headers: Sequence[str], types: Sequence[str], values: List[np.ndarray],
+                 nulls: List[np.ndarray]) -> None:
+        unknown = set(types) - set(self.TYPES)
+        if unknown:
+            raise ValueError(f'Unknown column types {sorted(unknown)}, use one of {self.TYPES}')
+        self.headers = tuple(headers)
+        self.types = tuple(types)
+        self.__values = values
+        self.__nulls = nulls
+        self.__positions = {header: position for position, header in enumerate(self.headers)}
+
+    def __len__(self) -> int:
+        return len(self.__values[0]) if self.__values else 0
+
+    @classmethod
+    def from_text(cls, headers: Sequence[str], columns: Sequence[Sequence[str]], types: Dict[str, str] = None,
+                  lines: Sequence[int] = None, errors: List[tuple] = None,
+                  nulls: Sequence[Sequence[bool]] = None) -> 'Batch':
+        """Method for parsing columns of strings by declared types, columns without declared type are text
+
+        Empty values of typed columns are nulls, values marked in nulls (mask by column) are nulls in all columns.
+        Invalid values are added to errors as (line, column, value), lines are row numbers by default. ValueError is
+        raised for them if errors are not given.
+        """
+        types = types or {}
+        lines = range(len(columns[0]) if columns else 0) if lines is None else lines
+        raised = errors is None
+        errors = [] if raised else errors
+        column_types, values, null_masks = [], [], []
+        for position, (header, column) in enumerate(zip(headers, columns)):
+            column_type = types.get(header, 'text')
+            null_mask = np.zeros(len(column), dtype=bool) if nulls is None else np.array(nulls[position], dtype=bool)
+            if null_mask.any():
+                column = ['' if is_null else value for value, is_null in zip(column, null_mask.tolist())]
+            column_values = _PARSERS[column_type](column, lines, header, errors)
+            column_types.append(column_type)
+            values.append(column_values)
+            null_masks.append(null_mask | cls.__get_typed_nulls(column_type, column, column_values))
+        if raised and errors:
+            cls.__raise_errors(errors)
+        return cls(headers, column_types, values, null_masks)
+
+    @staticmethod
+    def __raise_errors(errors: List[tuple]) -> None:
+        """Method for raising error with invalid values as (row, column, value)"""
+        raise ValueError('Invalid values: ' + '; '.join(f'row {row}: {header} {value!r}'
+                                                        for row, header, value in errors[:10]))
+
+    @staticmethod
+    def __get_typed_nulls(column_type: str, column: Sequence[str], values: np.ndarray) -> np.ndarray:
+        """Method for getting null mask of empty values of typed column"""
+        if column_type in ('timestamp', 'date'):
+            return np.isnat(values)
+        if column_type == 'decimal':
+            return values == _FIXED_POINT_NULL
+        if column_type == 'text':
+            return np.zeros(len(values), dtype=bool)
+        return np.array(column, dtype=str) == ''
+
+    def to_numpy(self, header: str) -> np.ndarray:
+        """Method for getting column for vectorized processing (e.g. pandas)
+
+        Text is decoded to object array, decimal is converted to float, nulls are None, NaT or NaN.
+        """
+        position = self.__positions[header]
+        column_type, values, nulls = self.types[position], self.__values[position], self.__nulls[position]
+        if column_type == 'text':
+            result = np.char.decode(values, 'utf-8').astype(object)
+        elif column_type == 'decimal':
+            result = values / 10 ** _FIXED_POINT_SCALE
+        elif column_type == 'float' or (column_type == 'integer' and nulls.any()):
+            result = values.astype(np.float64)
+        elif column_type == 'boolean' and nulls.any():
+            result = values.astype(object)
+        else:
+            return values
+        if nulls.any():
+            result[nulls] = None if result.dtype == object else np.nan
+        return result
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,339 @@
+from typing import List, Dict, Tuple
+from datetime import date, datetime, timedelta
+from time import perf_counter
+import argparse
+import json
+import os
+import subprocess
+import numpy as np
+from openpyxl import Workbook
+from .database import Database
+from .finder import FileFinder
+from .metrics import Metrics
+from .etl import ETL
+
+
+class DataGenerator:
+    """Class for generating synthetic source tables and daily files with injected fraud patterns
+
+    Scale is set by total number of transactions, clients, cards and terminals are derived from it.
+    Injected patterns: expired and blacklisted passports, expired accounts, operations in other city within one hour
+    and amount probing sequences. Source tables and terminals change between days to exercise SCD2 paths.
+    """
+
+    __CITIES = ('Москва', 'Санкт-Петербург', 'Казань', 'Новосибирск', 'Екатеринбург', 'Омск', 'Тверь', 'Пермь')
+
+    __OPERATIONS = ('PAYMENT', 'WITHDRAW', 'DEPOSIT')
+
+    __TRANSACTION_HEADERS = ('transaction_id', 'transaction_date', 'amount', 'card_num', 'oper_type', 'oper_result',
+                             'terminal')
+
+    def __init__(self, path: str, transactions: int = 100000, days: int = 3, start: date = date(2021, 3, 1),
+                 seed: int = 42) -> None:
+        self.path = path
+        self.transactions = transactions
+        self.days = days
+        self.start = start
+        self.__rng = np.random.default_rng(seed)
+        self.__clients = max(100, transactions // 250)
+        self.__terminals = max(len(self.__CITIES) * 5, transactions // 2000)
+        self.__next_client = self.__clients
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def __client_id(client: int) -> str:
+        return f'{client:010d}'
+
+    @staticmethod
+    def __account(client: int) -> str:
+        return f'40817810{client:012d}'
+
+    @staticmethod
+    def __card_num(card: int) -> str:
+        client, number = divmod(card, 2)
+        return f'{client // 10000:04d} {client % 10000:04d} 0000 {number:04d}'
+
+    @staticmethod
+    def __terminal_id(terminal: int) -> str:
+        return f'T{terminal:05d}'
+
+    def __client_rows(self, clients: range, created: datetime) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+        """Method for generating clients, accounts and cards rows, some passports and accounts are expired"""
+        expired_passport = self.__rng.random(len(clients)) < 0.02
+        expired_account = self.__rng.random(len(clients)) < 0.01
+        clients_rows, accounts_rows, cards_rows = [], [], []
+        for client, passport_expired, account_expired in zip(clients, expired_passport, expired_account):
+            passport_valid_to = (self.start + timedelta(days=client % self.days) if passport_expired
+                                 else None if client % 9 == 0 else date(2040, 1, 1))
+            clients_rows.append((self.__client_id(client), f'Фамилия{client}', f'Имя{client}',
+                                 None if client % 13 == 0 else f'Отчество{client}', date(1960 + client % 40, 1, 1),
+                                 f'{client:010d}', passport_valid_to, f'+7{client:010d}', created, None))
+            valid_to = self.start + timedelta(days=client % self.days) if account_expired else date(2040, 1, 1)
+            accounts_rows.append((self.__account(client), valid_to, self.__client_id(client), created, None))
+            cards_rows += [(self.__card_num(client * 2 + number), self.__account(client), created, None)
+                           for number in range(2)]
+        return clients_rows, accounts_rows, cards_rows
+
+    def create_source(self, db: Database, schema: str = 'info') -> None:
+        """Method for creating and filling source tables of clients, accounts and cards"""
+        db.execute(f'''
+                   CREATE SCHEMA IF NOT EXISTS {schema};
+                   DROP TABLE IF EXISTS {schema}.clients;
+                   DROP TABLE IF EXISTS {schema}.accounts;
+                   DROP TABLE IF EXISTS {schema}.cards;
+                   CREATE TABLE {schema}.clients(client_id VARCHAR(10), last_name VARCHAR(20), first_name VARCHAR(20),
+                                                 patronymic VARCHAR(20), date_of_birth DATE, passport_num VARCHAR(15),
+                                                 passport_valid_to DATE, phone VARCHAR(16), create_dt TIMESTAMP,
+                                                 update_dt TIMESTAMP);
+                   CREATE TABLE {schema}.accounts(account VARCHAR(20), valid_to DATE, client VARCHAR(10),
+                                                  create_dt TIMESTAMP, update_dt TIMESTAMP);
+                   CREATE TABLE {schema}.cards(card_num VARCHAR(19), account VARCHAR(20), create_dt TIMESTAMP,
+                                               update_dt TIMESTAMP);
+                   ''')
+        created = datetime.combine(self.start - timedelta(days=30), datetime.min.time())
+        for table, rows in zip(('clients', 'accounts', 'cards'), self.__client_rows(range(self.__clients), created)):
+            db.copy_in(table=f'{schema}.{table}', columns=self.__source_columns(table), rows=rows)
+        db.save()
+
+    @staticmethod
+    def __source_columns(table: str) -> Tuple[str, ...]:
+        return {'clients': ('client_id', 'last_name', 'first_name', 'patronymic', 'date_of_birth', 'passport_num',
+                            'passport_valid_to', 'phone', 'create_dt', 'update_dt'),
+                'accounts': ('account', 'valid_to', 'client', 'create_dt', 'update_dt'),
+                'cards': ('card_num', 'account', 'create_dt', 'update_dt')}[table]
+
+    def change_source(self, db: Database, day: int, schema: str = 'info') -> None:
+        """Method for updating 1% of clients phones, deleting 0.1% of cards and adding 0.5% of new clients"""
+        updated = datetime.combine(self.start + timedelta(days=day), datetime.min.time()) + timedelta(hours=1)
+        clients = self.__rng.choice(self.__clients, size=max(1, self.__clients // 100), replace=False)
+        db.execute(f'''
+                   UPDATE      {schema}.clients
+                   SET         phone = '+7' || LPAD(REVERSE(client_id), 10, '0')
+                               ,update_dt = %s
+                   WHERE       client_id = ANY(%s);
+                   ''', (updated, [self.__client_id(client) for client in clients.tolist()]))
+        cards = self.__rng.choice(self.__clients * 2, size=max(1, self.__clients // 500), replace=False)
+        db.execute(f'DELETE FROM {schema}.cards WHERE card_num = ANY(%s);',
+                   ([self.__card_num(card) for card in cards.tolist()],))
+        new_clients = range(self.__next_client, self.__next_client + max(1, self.__clients // 200))
+        self.__next_client = new_clients.stop
+        for table, rows in zip(('clients', 'accounts', 'cards'), self.__client_rows(new_clients, updated)):
+            db.copy_in(table=f'{schema}.{table}', columns=self.__source_columns(table), rows=rows)
+        db.save()
+
+    def __write_xlsx(self, filename: str, headers: Tuple[str, ...], rows: List[tuple]) -> str:
+        """Method for writing rows to xlsx file"""
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(row)
+        filepath = os.path.join(self.path, filename)
+        workbook.save(filepath)
+        return filepath
+
+    def __write_terminals(self, day: int, dt: str) -> str:
+        """Method for writing full terminals list, some terminals move or disappear every day"""
+        rows = []
+        for terminal in range(self.__terminals):
+            if day > 0 and terminal % 97 == day:
+                continue
+            city = self.__CITIES[(terminal + (day if terminal % 101 == 0 else 0)) % len(self.__CITIES)]
+            rows.append((self.__terminal_id(terminal), ('ATM', 'POS', 'ECOM')[terminal % 3], city,
+                         f'{city}, ул. Тестовая, д. {terminal}'))
+        return self.__write_xlsx(f'terminals_{dt}.xlsx', ('terminal_id', 'terminal_type', 'terminal_city',
+                                                          'terminal_address'), rows)
+
+    def __write_blacklist(self, day: int, dt: str) -> str:
+        """Method for writing passport blacklist accumulated since start of the month"""
+        entries = max(1, self.__clients // 200)
+        rows = [(datetime.combine(self.start + timedelta(days=number % (day + 1)), datetime.min.time()),
+                 f'{(number * 7919) % self.__clients:010d}') for number in range(entries * (day + 1) // self.days)]
+        return self.__write_xlsx(f'passport_blacklist_{dt}.xlsx', ('date', 'passport'), rows)
+
+    def __probing(self, count: int) -> Dict[int, List[tuple]]:
+        """Method for generating amount probing sequences: 3 rejected decreasing operations and successful one"""
+        sequences = {}
+        for card, hour, second in zip(self.__rng.integers(0, self.__clients * 2, count).tolist(),
+                                      self.__rng.integers(0, 24, count).tolist(),
+                                      self.__rng.integers(0, 2400, count).tolist()):
+            for number, (cents, result) in enumerate(((90000, 'REJECT'), (70000, 'REJECT'), (50000, 'REJECT'),
+                                                      (30000, 'SUCCESS'))):
+                sequences.setdefault(hour, []).append((second + number * 180, card, cents, 'WITHDRAW', result,
+                                                       (card // 2) % len(self.__CITIES)))
+        return sequences
+
+    def __write_transactions(self, day: int, dt: str, prefix: int) -> str:
+        """Method for writing transactions of one day ordered by date, generated hour by hour"""
+        count = self.transactions // self.days
+        current = self.start + timedelta(days=day)
+        cities = len(self.__CITIES)
+        per_city = self.__terminals // cities
+        probing = self.__probing(max(1, count // 2000))
+        filepath = os.path.join(self.path, f'transactions_{dt}.txt')
+        number = 0
+        with open(filepath, 'w', encoding='utf-8') as file:
+            file.write(';'.join(self.__TRANSACTION_HEADERS) + '\n')
+            for hour, hour_count in enumerate(self.__rng.multinomial(count, [1 / 24] * 24).tolist()):
+                cards = self.__rng.integers(0, self.__clients * 2, hour_count)
+                # Clients pay in their home city, 2% of operations are made in another one
+                home = (cards // 2) % cities
+                travel = self.__rng.random(hour_count) < 0.02
+                city = np.where(travel, (home + self.__rng.integers(1, cities, hour_count)) % cities, home)
+                rows = list(zip(self.__rng.integers(0, 3600, hour_count).tolist(), cards.tolist(),
+                                self.__rng.integers(1000, 500000, hour_count).tolist(),
+                                self.__rng.choice(self.__OPERATIONS, hour_count).tolist(),
+                                np.where(self.__rng.random(hour_count) < 0.9, 'SUCCESS', 'REJECT').tolist(),
+                                city.tolist()))
+                rows += probing.get(hour, [])
+                rows.sort()
+                hour_prefix = f'{current.isoformat()} {hour:02d}:'
+                lines = []
+                for second, card, cents, operation, result, terminal_city in rows:
+                    terminal = self.__rng_terminal(terminal_city, per_city, number)
+                    lines.append(f'{prefix}{number:012d};{hour_prefix}{second // 60:02d}:{second % 60:02d};'
+                                 f'{cents // 100},{cents % 100:02d};{self.__card_num(card)};{operation};{result};'
+                                 f'{self.__terminal_id(terminal)}\n')
+                    number += 1
+                file.writelines(lines)
+        return filepath
+
+    def __rng_terminal(self, city: int, per_city: int, number: int) -> int:
+        """Method for choosing terminal of the city"""
+        return (number * 31 % per_city) * len(self.__CITIES) + city
+
+    def write_files(self, day: int) -> List[str]:
+        """Method for writing terminals, passport blacklist and transactions files of day (0-based)"""
+        dt = (self.start + timedelta(days=day)).strftime('%d%m%Y')
+        return [self.__write_terminals(day, dt), self.__write_blacklist(day, dt),
+                self.__write_transactions(day, dt, prefix=10 + day)]
+
+
+class Benchmark:
+    """Class for timing ETL on generated data, results are appended to JSON lines file for comparing commits"""
+
+    __TEMPLATES = ('passport_blacklist_*.xlsx', 'terminals_*.xlsx', 'transactions_*.txt')
+
+    __TABLES = ('accounts', 'clients', 'cards')
+
+    def __init__(self, target: Database, source: Database, generator: DataGenerator,
+                 ddl_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.ddl'),
+                 results_path: str = './benchmark_results.jsonl') -> None:
+        self.__target = target
+        self.__source = source
+        self.__generator = generator
+        self.__ddl_path = ddl_path
+        self.__results_path = results_path
+
+    def __reset(self) -> None:
+        """Method for recreating target tables from DDL and source tables from generator"""
+        self.__target.execute('CREATE SCHEMA IF NOT EXISTS deaian;')
+        self.__target.execute(self.__target.get_script(self.__ddl_path))
+        self.__target.save()
+        self.__generator.create_source(self.__source)
+
+    @staticmethod
+    def __get_commit() -> str:
+        """Method for getting current git commit of package"""
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def run(self) -> dict:
+        """Method for loading all generated days and saving timings of steps and ETL stages"""
+        self.__reset()
+        metrics = Metrics()
+        steps = {'generate': 0.0, 'from_file': 0.0, 'from_database': 0.0, 'mart_update': 0.0}
+        scd = {}
+        for day in range(self.__generator.days):
+            start = perf_counter()
+            if day > 0:
+                self.__generator.change_source(self.__source, day)
+            self.__generator.write_files(day)
+            steps['generate'] += perf_counter() - start
+            etl = ETL(self.__target, metrics=metrics)
+            scd.update({f"{mapping.get('target_schema_name')}.{mapping.get('target_table_name')}": mapping.get('scd')
+                        for mapping in etl.mapping})
+            for step, func in (('from_file', lambda: etl.from_file(FileFinder(path=self.__generator.path,
+                                                                              templates=self.__TEMPLATES))),
+                               ('from_database', lambda: etl.from_database(self.__source, self.__TABLES)),
+                               ('mart_update', etl.mart_update)):
+                start = perf_counter()
+                func()
+                steps[step] += perf_counter() - start
+            etl.save()
+        stages = {name: {'scd': scd.get(name), 'seconds': stage.seconds, 'extract_seconds': stage.extract_seconds,
+                         'rows': stage.rows, 'rows_per_sec': stage.rows_per_sec, 'bytes': stage.bytes,
+                         'peak_rss_kb': stage.peak_rss_kb}
+                  for name, stage in metrics.aggregate().items()}
+        result = {'commit': self.__get_commit(), 'created_dt': datetime.now().isoformat(timespec='seconds'),
+                  'transactions': self.__generator.transactions, 'days': self.__generator.days,
+                  'peak_rss_kb': max(stage.peak_rss_kb for stage in metrics.stages), 'steps': steps,
+                  'stages': stages}
+        with open(self.__results_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(result, ensure_ascii=False) + '\n')
+        return result
+
+    @staticmethod
+    def compare(results_path: str = './benchmark_results.jsonl', base: str = None,
+                head: str = None) -> List[Tuple[str, float, float, float]]:
+        """Method for comparing timings of two results (last ones by default), returns (name, base, head, ratio)
+
+        Results are looked up by commit, the last result of each commit is used.
+        """
+        with open(results_path, encoding='utf-8') as file:
+            results = [json.loads(line) for line in file if line.strip()]
+        by_commit = {result['commit']: result for result in results}
+        base_result = by_commit[base] if base else results[-2]
+        head_result = by_commit[head] if head else results[-1]
+        if base_result['transactions'] != head_result['transactions']:
+            raise ValueError(f"Results have different scale: {base_result['transactions']} "
+                             f"and {head_result['transactions']} transactions")
+        comparison = []
+        for group in ('steps', 'stages'):
+            for name, base_value in base_result[group].items():
+                head_value = head_result[group].get(name)
+                if head_value is None:
+                    continue
+                if group == 'stages':
+                    base_value, head_value = base_value['seconds'], head_value['seconds']
+                comparison.append((name, base_value, head_value, head_value / base_value if base_value else None))
+        return comparison
+
+
+if __name__ == '__main__':
+    # Usage from project directory (with sql_scripts): python -m py_scripts.benchmark run --transactions 1000000
+    parser = argparse.ArgumentParser(description='ETL benchmark on synthetic data')
+    parser.add_argument('command', choices=('run', 'compare'))
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--path', default='./benchmark_data')
+    parser.add_argument('--results', default='./benchmark_results.jsonl')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--target-database', default='edu')
+    parser.add_argument('--source-database', default='bank')
+    parser.add_argument('--base', help='commit of base result for compare')
+    parser.add_argument('--head', help='commit of head result for compare')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        trg = Database(host=args.host, port=args.port, database=args.target_database, user=args.user,
+                       password=args.password)
+        src = Database(host=args.host, port=args.port, database=args.source_database, user=args.user,
+                       password=args.password)
+        benchmark = Benchmark(trg, src, DataGenerator(args.path, transactions=args.transactions, days=args.days),
+                              results_path=args.results)
+        benchmark_result = benchmark.run()
+        for step_name, seconds in benchmark_result['steps'].items():
+            print(f'{step_name:45} {seconds:10.3f} s')
+        for stage_name, stage_result in benchmark_result['stages'].items():
+            print(f"{stage_name:45} {stage_result['seconds']:10.3f} s {stage_result['rows_per_sec'] or 0:12.0f} rows/s")
+    else:
+        for row_name, base_seconds, head_seconds, ratio in Benchmark.compare(args.results, args.base, args.head):
+            print(f"{row_name:45} {base_seconds:10.3f} {head_seconds:10.3f} "
+                  f"{'' if ratio is None else f'{(ratio - 1) * 100:+.1f}%'}")
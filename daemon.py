@@ -0,0 +1,124 @@
+from typing import Tuple, List, Dict, Set
+from datetime import date
+from threading import Event
+import logging
+import os
+from .database import Database
+from .etl import ETL
+from .file import File
+from .finder import FileFinder
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """Class for loading files as they arrive, keeping connections and ETL metadata between micro-batches
+
+    Path is watched with inotify (if inotify_simple package is installed) or polled every interval seconds.
+    Polled file is ready when its size and modification time did not change since previous poll, file reported
+    by inotify is ready when it is closed after writing or moved to path.
+    Every micro-batch is a new ETL run: ready files are loaded in date order, report is updated when files of all
+    templates are in ingest ledger for every date loaded since last report update, tables are loaded from source
+    database before it. Files which failed to load are skipped until they change.
+    """
+
+    def __init__(self, etl: ETL, path: str, templates: Tuple[str, ...], source: Database = None,
+                 tables: Tuple[str, ...] = (), interval: float = 60, source_schema: str = 'info',
+                 target_schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
+        self.__etl = etl
+        self.__path = path
+        self.__templates = templates
+        self.__source = source
+        self.__tables = tables
+        self.__interval = interval
+        self.__source_schema = source_schema
+        self.__target_schema = target_schema
+        self.__prefix = prefix
+        self.__stopped = Event()
+        self.__signatures: Dict[str, Tuple[int, int]] = {}
+        self.__failed: Dict[str, Tuple[int, int]] = {}
+        self.__pending_dates: Set[date] = set()
+
+    @staticmethod
+    def __get_signature(filepath: str) -> Tuple[int, int]:
+        """Method for getting size and modification time of file"""
+        stat = os.stat(filepath)
+        return stat.st_size, stat.st_mtime_ns
+
+    def __get_ready_files(self, closed: Set[str]) -> List[str]:
+        """Method for finding files which are not written anymore, closed are files reported by inotify"""
+        signatures = {}
+        for filepath in FileFinder(path=self.__path, templates=self.__templates):
+            try:
+                signatures[filepath] = self.__get_signature(filepath)
+            except FileNotFoundError:
+                continue
+        ready = [filepath for filepath, signature in signatures.items()
+                 if (os.path.basename(filepath) in closed or self.__signatures.get(filepath) == signature)
+                 and self.__failed.get(filepath) != signature]
+        self.__signatures = signatures
+        self.__failed = {filepath: signature for filepath, signature in self.__failed.items()
+                         if filepath in signatures}
+        return sorted(ready, key=lambda filepath: (File.split_name(filepath)[3], filepath))
+
+    def __is_complete(self, dt: date) -> bool:
+        """Method for checking if files of all templates are loaded for date"""
+        return len(self.__etl.get_ingested_tables(dt)) >= len(self.__templates)
+
+    def __run_batch(self, files: List[str]) -> None:
+        """Method for loading ready files and updating report as one ETL run"""
+        self.__etl.new_run()
+        for filepath in files:
+            try:
+                self.__etl.load_file(filepath=filepath, schema=self.__target_schema, prefix=self.__prefix)
+                self.__pending_dates.add(File.split_name(filepath)[3])
+            except Exception:
+                logger.exception('File %s was not loaded', filepath)
+                self.__etl.cancel()
+                if os.path.exists(filepath):
+                    self.__failed[filepath] = self.__get_signature(filepath)
+        if self.__pending_dates and all(self.__is_complete(dt) for dt in self.__pending_dates):
+            for table in self.__tables:
+                self.__etl.load_table(db=self.__source, table=table, source_schema=self.__source_schema,
+                                      target_schema=self.__target_schema, prefix=self.__prefix)
+            self.__etl.mart_update()
+            logger.info('Report is updated for %s', ', '.join(sorted(dt.isoformat() for dt in self.__pending_dates)))
+            self.__pending_dates.clear()
+        self.__etl.save()
+
+    def run(self) -> None:
+        """Method for watching path and loading files until stop is called"""
+        watcher = None
+        if inotify_simple is not None:
+            watcher = inotify_simple.INotify()
+            watcher.add_watch(self.__path, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+        try:
+            closed = set()
+            while not self.__stopped.is_set():
+                files = self.__get_ready_files(closed)
+                if files:
+                    try:
+                        self.__run_batch(files)
+                    except Exception:
+                        logger.exception('Micro-batch of %d files failed', len(files))
+                        self.__etl.cancel()
+                if watcher is None:
+                    self.__stopped.wait(self.__interval)
+                else:
+                    closed = {event.name for event in watcher.read(timeout=int(self.__interval * 1000))}
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def stop(self) -> None:
+        """Method for stopping run after current micro-batch"""
+        self.__stopped.set()
+
+
+if __name__ == '__main__':
+    pass
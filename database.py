@@ -1,19 +1,84 @@
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Iterable, Iterator, Sequence, Dict
 from functools import wraps
+from contextlib import contextmanager
+from queue import Queue
+from threading import Thread, Event, Lock
+from time import perf_counter
+import io
+import re
 import psycopg2
+from .batch import Batch
+
+
+class _CopyStream:
+    """File-like object for streaming rows to COPY FROM STDIN"""
+
+    def __init__(self, rows: Iterable[Sequence]) -> None:
+        self.__rows = iter(rows)
+        self.__buffer = ''
+
+    @staticmethod
+    def __format(value) -> str:
+        """Method for converting value to COPY text format"""
+        if value is None or value != value:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def read(self, size: int = -1) -> str:
+        """Method for reading next part of rows"""
+        lines = [self.__buffer]
+        length = len(self.__buffer)
+        for row in self.__rows:
+            line = '\t'.join(map(self.__format, row)) + '\n'
+            lines.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(lines)
+        if size < 0:
+            self.__buffer = ''
+            return data
+        self.__buffer = data[size:]
+        return data[:size]
 
 
 class Database:
     """Class for working with database"""
 
-    def __init__(self, host: str, port: int, database: str, user: str, password: str) -> None:
-        """Creating connection to database"""
-        self.conn = psycopg2.connect(host=host,
-                                     port=port,
-                                     database=database,
-                                     user=user,
-                                     password=password)
+    __statistics: Dict[str, List[float]] = {}
+
+    __statistics_lock = Lock()
+
+    __plans: List[dict] = []
+
+    __plans_lock = Lock()
+
+    # Type OID of result column -> Batch column type, numeric columns with scale up to 2 are decimal
+    __BATCH_TYPES = {16: 'boolean', 20: 'integer', 21: 'integer', 23: 'integer', 700: 'float', 701: 'float',
+                     1082: 'date', 1114: 'timestamp', 1700: 'decimal'}
+
+    __COPY_UNESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+    # Single statement which can be explained, leading comments are skipped
+    __EXPLAINABLE = re.compile(r'\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(?:SELECT|INSERT|UPDATE|DELETE|WITH|EXECUTE)\b',
+                               re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, host: str, port: int, database: str, user: str, password: str,
+                 capture_plans: bool = False) -> None:
+        """Creating connection to database
+
+        With capture_plans EXPLAIN (ANALYZE, BUFFERS) plans of statements run by execute, select and their prepared
+        versions are captured, see get_plans. Statements are run twice then, explained one is rolled back.
+        """
+        self.__params = dict(host=host, port=port, database=database, user=user, password=password)
+        self.__capture_plans = capture_plans
+        self.conn = psycopg2.connect(**self.__params)
         self.cur = None
+        self.__prepared: Dict[str, str] = {}
+
+    def clone(self) -> 'Database':
+        """Method for opening new connection with the same parameters"""
+        return Database(**self.__params, capture_plans=self.__capture_plans)
 
     def __del__(self) -> None:
         """Closing connection to database"""
@@ -31,6 +96,61 @@ class Database:
 
         return wrapper
 
+    def measured(func):
+        """Decorator for counting calls, time and rows of database operation for all connections"""
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = perf_counter()
+            result = func(self, *args, **kwargs)
+            seconds = perf_counter() - start
+            rows = len(result[1]) if isinstance(result, tuple) else len(result) if isinstance(result, Batch) else result
+            with Database.__statistics_lock:
+                values = Database.__statistics.setdefault(func.__name__, [0, 0.0, 0])
+                values[0] += 1
+                values[1] += seconds
+                values[2] += max(rows, 0)
+            return result
+
+        return wrapper
+
+    @staticmethod
+    def get_statistics() -> Dict[str, Tuple[int, float, int]]:
+        """Method for getting calls, seconds and rows of each database operation since process start"""
+        with Database.__statistics_lock:
+            return {operation: tuple(values) for operation, values in Database.__statistics.items()}
+
+    @staticmethod
+    def get_plans() -> List[dict]:
+        """Method for getting plans captured by all connections since previous call
+
+        Plan is dict with name of prepared statement (or None), query and EXPLAIN output.
+        """
+        with Database.__plans_lock:
+            plans = list(Database.__plans)
+            Database.__plans.clear()
+            return plans
+
+    def __capture_plan(self, query: str, params: Union[tuple, dict] = None, name: str = None) -> None:
+        """Method for capturing plan of statement with EXPLAIN ANALYZE in savepoint, which is rolled back"""
+        statement = query if name is None else f'EXECUTE {name}' + (f'({", ".join("%s" for _ in params)})'
+                                                                    if params else '')
+        # Sequences are not rolled back, so statements calling NEXTVAL are not explained
+        if (not self.__capture_plans or not self.__EXPLAINABLE.match(query)
+                or ';' in statement.strip().rstrip(';') or 'NEXTVAL' in query.upper()):
+            return
+        self.cur.execute('SAVEPOINT plan_capture;')
+        try:
+            self.cur.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}', params)
+            plan = self.cur.fetchone()[0][0]
+        except psycopg2.Error:
+            plan = None
+        self.cur.execute('ROLLBACK TO SAVEPOINT plan_capture;')
+        self.cur.execute('RELEASE SAVEPOINT plan_capture;')
+        if plan is not None:
+            with Database.__plans_lock:
+                Database.__plans.append({'name': name, 'query': query, 'plan': plan})
+
     def save(self):
         """Method for saving result to database"""
         self.conn.commit()
@@ -45,21 +165,180 @@ class Database:
         with open(filepath, encoding='utf-8-sig') as file:
             return file.read()
 
+    @measured
     @cursor
-    def select(self, query: str) -> Tuple[List, List[Tuple]]:
+    def select(self, query: str, params: Union[tuple, dict] = None) -> Tuple[List, List[Tuple]]:
         """Method for selecting data from database"""
-        self.cur.execute(query)
+        self.__capture_plan(query, params)
+        self.cur.execute(query, params)
         data = self.cur.fetchall()
         description = [x[0] for x in self.cur.description]
         return description, data
 
+    @staticmethod
+    def __get_batch_type(column: psycopg2.extensions.Column) -> str:
+        """Method for getting Batch type of result column, columns of other types are text"""
+        column_type = Database.__BATCH_TYPES.get(column.type_code, 'text')
+        if column_type == 'decimal' and not 0 <= (column.scale or 0) <= 2:
+            return 'text'
+        return column_type
+
+    @staticmethod
+    def __unescape(value: str) -> str:
+        """Method for decoding escape sequences of text value of COPY TO output"""
+        return re.sub(r'\\(.)', lambda match: Database.__COPY_UNESCAPES.get(match.group(1), match.group(1)), value)
+
+    @measured
     @cursor
-    def execute(self, query: str) -> int:
+    def select_batch(self, query: str, params: Union[tuple, dict] = None) -> Batch:
+        """Method for selecting data to columnar batch
+
+        Rows are transferred by COPY TO STDOUT in text format and parsed by columns, strings of values are
+        temporary and Python objects are not kept per value. Column types are taken from result description.
+        """
+        query = query.strip().rstrip(';')
+        self.__capture_plan(query, params)
+        self.cur.execute(f'SELECT * FROM ({query}) AS selected LIMIT 0;', params)
+        headers = tuple(column.name for column in self.cur.description)
+        types = {column.name: self.__get_batch_type(column) for column in self.cur.description}
+        buffer = io.BytesIO()
+        self.cur.copy_expert(self.cur.mogrify(f'COPY ({query}) TO STDOUT', params).decode('utf-8'), buffer)
+        data = buffer.getvalue().decode('utf-8')
+        del buffer
+        values = data.replace('\n', '\t').split('\t')[:-1]
+        columns = [values[position::len(headers)] for position in range(len(headers))]
+        # Nulls are found by raw values, text \N is sent escaped as \\N and is not null after unescaping
+        nulls = [[value == '\\N' for value in column] for column in columns]
+        if '\\' in data:
+            columns = [[self.__unescape(value) if '\\' in value else value for value in column]
+                       if types[header] == 'text' else column for header, column in zip(headers, columns)]
+        return Batch.from_text(headers, columns, types=types, nulls=nulls)
+
+    def __fetch(self, query: str, params: tuple = None, batch_size: int = 10000) -> Iterator[List[tuple]]:
+        """Method for fetching data by batches with server-side cursor"""
+        with self.conn.cursor(name=f'stream_{id(query)}') as cur:
+            cur.itersize = batch_size
+            cur.execute(query, params)
+            batch = cur.fetchmany(batch_size)
+            while batch:
+                yield batch
+                batch = cur.fetchmany(batch_size)
+
+    @staticmethod
+    def __consume(batches: Queue, stopped: Event, threads: List[Thread]) -> Iterator[tuple]:
+        """Method for getting batches from background threads until all of them are finished"""
+        running = len(threads)
+        for thread in threads:
+            thread.start()
+        try:
+            while running:
+                item = batches.get()
+                if isinstance(item[-1], Exception):
+                    raise item[-1]
+                if item[-1] is None:
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            stopped.set()
+            while any(thread.is_alive() for thread in threads):
+                while not batches.empty():
+                    batches.get_nowait()
+                for thread in threads:
+                    thread.join(0.1)
+
+    def stream(self, query: str, batch_size: int = 10000, prefetch: int = 2,
+               params: tuple = None) -> Iterator[List[tuple]]:
+        """Method for selecting data from database by batches with server-side cursor
+
+        Batches are fetched in background thread, so up to prefetch batches are ready while previous one is processed.
+        """
+        batches = Queue(maxsize=prefetch)
+        stopped = Event()
+
+        def fetch() -> None:
+            try:
+                for batch in self.__fetch(query, params, batch_size):
+                    if stopped.is_set():
+                        break
+                    batches.put((batch,))
+                batches.put((None,))
+            except Exception as error:
+                batches.put((error,))
+
+        for batch, in self.__consume(batches, stopped, [Thread(target=fetch, daemon=True)]):
+            yield batch
+
+    def stream_slices(self, queries: List[Tuple[str, tuple]], batch_size: int = 10000,
+                      prefetch: int = 2) -> Iterator[Tuple[int, List[tuple]]]:
+        """Method for selecting data by slices in parallel, each slice over its own connection
+
+        All connections share exported snapshot of this connection, so slices are consistent with each other.
+        Batches are returned together with slice number in order of arrival.
+        """
+        _, data = self.select('SELECT pg_export_snapshot();')
+        snapshot = data[0][0]
+        batches = Queue(maxsize=prefetch * len(queries))
+        stopped = Event()
+
+        def fetch(number: int, query: str, params: tuple) -> None:
+            try:
+                db = self.clone()
+                db.execute(f"SET TRANSACTION ISOLATION LEVEL REPEATABLE READ; SET TRANSACTION SNAPSHOT '{snapshot}';")
+                for batch in db.__fetch(query, params, batch_size):
+                    if stopped.is_set():
+                        break
+                    batches.put((number, batch))
+                db.cancel()
+                batches.put((number, None))
+            except Exception as error:
+                batches.put((number, error))
+
+        threads = [Thread(target=fetch, args=(number, query, params), daemon=True)
+                   for number, (query, params) in enumerate(queries)]
+        yield from self.__consume(batches, stopped, threads)
+
+    @measured
+    @cursor
+    def execute(self, query: str, params: Union[tuple, dict] = None) -> int:
         """Method for execute SQL query"""
-        self.cur.execute(query)
+        self.__capture_plan(query, params)
+        self.cur.execute(query, params)
         rows = self.cur.rowcount
         return rows
 
+    def __execute_prepared(self, name: str, query: str, params: tuple) -> None:
+        """Method for executing server-side prepared statement, statement is prepared on first call
+
+        Query uses $1, $2, ... placeholders. Prepared statements live as long as connection (also after rollback),
+        statement is prepared again if its query was changed.
+        """
+        if self.__prepared.get(name) != query:
+            if name in self.__prepared:
+                self.cur.execute(f'DEALLOCATE {name};')
+                del self.__prepared[name]
+            self.cur.execute(f'PREPARE {name} AS {query}')
+            self.__prepared[name] = query
+        self.__capture_plan(query, params, name=name)
+        self.cur.execute(f'EXECUTE {name}' + (f'({", ".join("%s" for _ in params)});' if params else ';'), params)
+
+    @measured
+    @cursor
+    def execute_prepared(self, name: str, query: str, params: tuple = ()) -> int:
+        """Method for executing query as server-side prepared statement"""
+        self.__execute_prepared(name, query, params)
+        return self.cur.rowcount
+
+    @measured
+    @cursor
+    def select_prepared(self, name: str, query: str, params: tuple = ()) -> Tuple[List, List[Tuple]]:
+        """Method for selecting data with server-side prepared statement"""
+        self.__execute_prepared(name, query, params)
+        data = self.cur.fetchall()
+        description = [x[0] for x in self.cur.description]
+        return description, data
+
+    @measured
     @cursor
     def insert(self, query: str, data: Union[list, tuple]) -> int:
         """Method for inserting data to database"""
@@ -67,6 +346,69 @@ class Database:
         rows = self.cur.rowcount
         return rows
 
+    @staticmethod
+    def to_copy(rows: Iterable[Sequence]) -> str:
+        """Method for formatting rows to COPY text format as copy_in sends them"""
+        return _CopyStream(rows).read()
+
+    @measured
+    @cursor
+    def copy_in(self, table: str, columns: Union[Tuple[str, ...], List[str]], rows: Iterable[Sequence],
+                constants: Dict[str, str] = None) -> int:
+        """Method for bulk loading data to database with COPY FROM STDIN
+
+        Constants are mapping of column name to SQL expression (e.g. NOW()) which is calculated on the server side.
+        """
+        column_list = ', '.join(columns)
+        if not constants:
+            self.cur.copy_expert(f'COPY {table}({column_list}) FROM STDIN', _CopyStream(rows))
+            return self.cur.rowcount
+        buffer_table = f'{table.rsplit(".", 1)[-1]}_copy'
+        constant_columns = ', '.join(constants.keys())
+        constant_values = ', '.join(constants.values())
+        self.cur.execute(f'CREATE TEMP TABLE {buffer_table} AS SELECT {column_list} FROM {table} WITH NO DATA;')
+        self.cur.copy_expert(f'COPY {buffer_table}({column_list}) FROM STDIN', _CopyStream(rows))
+        self.cur.execute(f'''
+                         INSERT INTO {table}({column_list}, {constant_columns})
+                         SELECT      {column_list}, {constant_values}
+                         FROM        {buffer_table};
+                         ''')
+        inserted = self.cur.rowcount
+        self.cur.execute(f'DROP TABLE {buffer_table};')
+        return inserted
+
+
+class DatabasePool:
+    """Class for sharing limited number of database connections between threads"""
+
+    def __init__(self, database: Database, size: int) -> None:
+        """Connections are opened lazily as clones of database"""
+        self.__database = database
+        self.__size = size
+        self.__opened = 0
+        self.__free = Queue()
+        self.__lock = Lock()
+
+    def __acquire(self) -> Database:
+        """Method for getting free connection or opening new one while pool is not full"""
+        with self.__lock:
+            if self.__free.empty() and self.__opened < self.__size:
+                self.__opened += 1
+                return self.__database.clone()
+        return self.__free.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[Database]:
+        """Method for borrowing connection, uncommitted changes are cancelled on error"""
+        db = self.__acquire()
+        try:
+            yield db
+        except Exception:
+            db.cancel()
+            raise
+        finally:
+            self.__free.put(db)
+
 
 if __name__ == '__main__':
     # pass
@@ -82,3 +424,16 @@ if __name__ == '__main__':
                   password=trg_password)
 
     print(db.select('select 1;'))
+
+    # Comparing executemany and COPY loading speed
+    db.execute('CREATE TEMP TABLE copy_benchmark(id INT, name VARCHAR(20), amount DECIMAL(18,2), '
+               'create_dt DATE NOT NULL, processed_dt TIMESTAMP NOT NULL);')
+    benchmark_rows = [(i, f'name_{i}', f'{i % 1000}.50') for i in range(100000)]
+    start = perf_counter()
+    db.insert('INSERT INTO copy_benchmark VALUES(%s, %s, %s, CURRENT_DATE, NOW());', benchmark_rows)
+    print(f'executemany: {len(benchmark_rows) / (perf_counter() - start):.0f} rows/sec')
+    start = perf_counter()
+    db.copy_in('copy_benchmark', ('id', 'name', 'amount'), benchmark_rows,
+               constants={'create_dt': 'CURRENT_DATE', 'processed_dt': 'NOW()'})
+    print(f'copy_in: {len(benchmark_rows) / (perf_counter() - start):.0f} rows/sec')
+    db.cancel()
@@ -0,0 +1,198 @@
+from typing import Tuple, List, Dict, Union
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+import json
+import os
+from .database import Database
+from .fraud import ENRICHED_TRANSACTIONS_QUERY, PASSPORT_BLACKLIST_QUERY
+from .partition import Partitioner
+
+
+class FraudDetector:
+    """Class for incremental fraud detection with per-client and per-card sliding window state
+
+    Only transactions created after last processed date are read. Rules 3 and 4 use state kept between runs:
+    last city of each client (1 hour window) and last 3 operations of each card (20 minutes window).
+    Transactions are expected to arrive in order, late transactions older than the state are not re-scored.
+    Transactions are read from trsh_dwh_fact_transaction_enriched, so ETL.enriched_update should be run before.
+    """
+
+    __COLUMNS = ('event_dt', 'passport', 'fio', 'phone', 'event_type', 'report_dt')
+
+    __CITY_WINDOW = timedelta(hours=1)
+
+    __AMOUNT_WINDOW = timedelta(minutes=20)
+
+    def __init__(self, target: Database, state_path: str = None, batch_size: int = 10000) -> None:
+        """State is saved to target database or to local JSON file if state_path is given"""
+        self.__target = target
+        self.__state_path = state_path
+        self.__batch_size = batch_size
+        self.__watermark, self.__cities, self.__operations = self.__load_state()
+
+    @staticmethod
+    def __to_datetime(value: Union[date, datetime, None]) -> Union[datetime, None]:
+        """Method for converting date to datetime for comparing with transaction date"""
+        if value is None or isinstance(value, datetime):
+            return value
+        return datetime.combine(value, time())
+
+    def __load_state(self) -> Tuple[date, Dict[str, tuple], Dict[Tuple[str, str], List[tuple]]]:
+        """Method for loading window state from file or database"""
+        if self.__state_path is not None:
+            if not os.path.exists(self.__state_path):
+                return date(1800, 1, 1), {}, {}
+            with open(self.__state_path, encoding='utf-8') as file:
+                state = json.load(file)
+            cities = {client: (datetime.fromisoformat(dt), city) for client, dt, city in state['cities']}
+            operations = {}
+            for client, card, dt, amt, rejected, decreasing in state['operations']:
+                operations.setdefault((client, card), []).append((datetime.fromisoformat(dt), Decimal(amt),
+                                                                  rejected, decreasing))
+            return date.fromisoformat(state['watermark']), cities, operations
+        query = '''
+                SELECT      max_update_dt
+                FROM        deaian.trsh_meta_etl_update
+                WHERE       schema_name = 'deaian'
+                            AND table_name = 'trsh_rep_fraud';
+                '''
+        _, data = self.__target.select(query)
+        watermark = data[0][0]
+        query = '''
+                SELECT      client_id
+                            ,trans_date
+                            ,terminal_city
+                FROM        deaian.trsh_meta_fraud_city_state;
+                '''
+        _, data = self.__target.select(query)
+        cities = {client: (dt, city) for client, dt, city in data}
+        query = '''
+                SELECT      client_id
+                            ,card_num
+                            ,trans_date
+                            ,amt
+                            ,rejected_flg
+                            ,decreasing_flg
+                FROM        deaian.trsh_meta_fraud_card_state
+                ORDER BY    client_id, card_num, position;
+                '''
+        _, data = self.__target.select(query)
+        operations = {}
+        for client, card, dt, amt, rejected, decreasing in data:
+            operations.setdefault((client, card), []).append((dt, amt, rejected, decreasing))
+        return watermark, cities, operations
+
+    def __save_state(self) -> None:
+        """Method for saving window state to file or database"""
+        if self.__state_path is not None:
+            state = {'watermark': self.__watermark.isoformat(),
+                     'cities': [(client, dt.isoformat(), city) for client, (dt, city) in self.__cities.items()],
+                     'operations': [(client, card, dt.isoformat(), str(amt), rejected, decreasing)
+                                    for (client, card), operations in self.__operations.items()
+                                    for dt, amt, rejected, decreasing in operations]}
+            with open(f'{self.__state_path}.tmp', 'w', encoding='utf-8') as file:
+                json.dump(state, file)
+            os.replace(f'{self.__state_path}.tmp', self.__state_path)
+            return
+        self.__target.execute('DELETE FROM deaian.trsh_meta_fraud_city_state;')
+        self.__target.copy_in(table='deaian.trsh_meta_fraud_city_state',
+                              columns=('client_id', 'trans_date', 'terminal_city'),
+                              rows=((client, dt, city) for client, (dt, city) in self.__cities.items()),
+                              constants={'processed_dt': 'NOW()'})
+        self.__target.execute('DELETE FROM deaian.trsh_meta_fraud_card_state;')
+        self.__target.copy_in(table='deaian.trsh_meta_fraud_card_state',
+                              columns=('client_id', 'card_num', 'position', 'trans_date', 'amt', 'rejected_flg',
+                                       'decreasing_flg'),
+                              rows=((client, card, position, *operation)
+                                    for (client, card), operations in self.__operations.items()
+                                    for position, operation in enumerate(operations, start=1)),
+                              constants={'processed_dt': 'NOW()'})
+        query = '''
+                UPDATE      deaian.trsh_meta_etl_update
+                SET         max_update_dt = %s
+                            ,processed_dt = NOW()
+                WHERE       schema_name = 'deaian'
+                            AND table_name = 'trsh_rep_fraud';
+                '''
+        self.__target.execute(query, (self.__watermark,))
+
+    def __prune(self, now: datetime) -> None:
+        """Method for removing state which can not affect transactions after now"""
+        self.__cities = {client: (dt, city) for client, (dt, city) in self.__cities.items()
+                         if dt + self.__CITY_WINDOW > now}
+        self.__operations = {card: operations for card, operations in self.__operations.items()
+                             if operations[-1][0] + self.__AMOUNT_WINDOW > now}
+
+    def __detect(self, row: dict, blacklist: Dict[str, datetime]) -> List[int]:
+        """Method for checking transaction by all rules and updating window state"""
+        events = []
+        trans_date = row['trans_date']
+
+        # 1. Expired or blacklisted passport
+        passport_valid_to = self.__to_datetime(row['passport_valid_to'])
+        blacklist_dt = blacklist.get(row['passport_num'])
+        if (passport_valid_to is not None and trans_date > passport_valid_to
+                or blacklist_dt is not None and trans_date > blacklist_dt):
+            events.append(1)
+
+        # 2. Expired account
+        if trans_date > self.__to_datetime(row['account_valid_to']):
+            events.append(2)
+
+        # 3. Different cities within one hour
+        if row['terminal_city'] is not None:
+            previous = self.__cities.get(row['client_id'])
+            if (previous is not None and previous[1] != row['terminal_city']
+                    and trans_date < previous[0] + self.__CITY_WINDOW):
+                events.append(3)
+            self.__cities[row['client_id']] = (trans_date, row['terminal_city'])
+
+        # 4. Amount probing: 3 rejected decreasing operations and successful one within 20 minutes
+        card = (row['client_id'], row['card_num'])
+        operations = self.__operations.get(card, [])
+        decreasing = bool(operations) and row['amt'] < operations[-1][1]
+        withdraw = row['oper_type'] in ('WITHDRAW', 'PAYMENT')
+        if (withdraw and row['oper_result'] == 'SUCCESS' and len(operations) == 3
+                and all(operation[2] for operation in operations)
+                and trans_date < operations[0][0] + self.__AMOUNT_WINDOW
+                and decreasing and operations[-1][3] and operations[-2][3]):
+            events.append(4)
+        self.__operations[card] = (operations + [(trans_date, row['amt'], withdraw and row['oper_result'] == 'REJECT',
+                                                  decreasing)])[-3:]
+        return events
+
+    def run(self) -> int:
+        """Method for detecting frauds in new transactions and saving them to report, report partitions are created"""
+        _, data = self.__target.select(PASSPORT_BLACKLIST_QUERY)
+        blacklist = {passport: self.__to_datetime(entry_dt) for passport, entry_dt in data}
+        query = ENRICHED_TRANSACTIONS_QUERY.format(scored='TRUE', condition='tr.create_dt > %s')
+        query = f'{query} ORDER BY tr.trans_date, tr.trans_id;'
+        headers = ('trans_id', 'trans_date', 'card_num', 'oper_type', 'oper_result', 'amt', 'create_dt', 'client_id',
+                   'first_name', 'last_name', 'patronymic', 'passport_num', 'passport_valid_to', 'phone',
+                   'account_valid_to', 'terminal_city', 'scored')
+        frauds = []
+        last_dt = None
+        for batch in self.__target.stream(query=query, batch_size=self.__batch_size, params=(self.__watermark,)):
+            for values in batch:
+                row = dict(zip(headers, values))
+                fio = ' '.join(name for name in (row['first_name'], row['last_name'], row['patronymic'])
+                               if name is not None)
+                frauds.extend((row['trans_date'], row['passport_num'], fio, row['phone'], event_type,
+                               row['create_dt'].date()) for event_type in self.__detect(row, blacklist))
+                self.__watermark = max(self.__watermark, row['create_dt'].date())
+                last_dt = row['trans_date']
+        if last_dt is None:
+            return 0
+        self.__prune(last_dt)
+        if frauds:
+            Partitioner(self.__target).create_report(min(fraud[5] for fraud in frauds),
+                                                     max(fraud[5] for fraud in frauds))
+        inserted = self.__target.copy_in(table='deaian.trsh_rep_fraud', columns=self.__COLUMNS, rows=frauds,
+                                         constants={'processed_dt': 'NOW()'})
+        self.__save_state()
+        self.__target.save()
+        return inserted
+
+
+if __name__ == '__main__':
+    pass
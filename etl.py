@@ -1,21 +1,77 @@
-from typing import Iterable, Tuple, List, Union
-from datetime import datetime
+from typing import Iterable, Iterator, Tuple, List, Union, Dict, Set
+from datetime import datetime, date
+from itertools import chain
+from contextlib import contextmanager
+from threading import local, Lock
+import hashlib
+import json
+import os
 from .database import Database
 from .file import File
+from .archiver import Archiver
+from .partition import Partitioner
+from .metrics import Metrics, Stage
 
 
 class ETL:
     """Class for performing ETL processes"""
 
-    def __init__(self, target: Database) -> None:
-        self.__target = target
+    __MAPPING_HEADERS = ('target_schema_name', 'target_table_name', 'target_columns', 'target_keys', 'scd',
+                         'source_schema_name', 'source_table_name', 'source_columns', 'source_keys', 'extract_method',
+                         'extract_slices', 'delete_buckets', 'partition_column', 'partition_interval',
+                         'snapshot_feed')
+
+    # Open end of current SCD2 versions, constant literal matches predicate of partial indexes on current versions
+    __OPEN_END = "TIMESTAMP '9999-12-31'"
+
+    # Plan is flagged as regression if its shape differs from baseline or its cost grows by this ratio
+    __PLAN_COST_RATIO = 2.0
+
+    def __init__(self, target: Database, bulk_load: bool = True, batch_size: int = 10000,
+                 metrics: Metrics = None, cache_path: str = None, parse_workers: int = None,
+                 archiver: Archiver = None) -> None:
+        """Parsed .xlsx files are cached in cache_path by content hash if it is given
+
+        With parse_workers given .txt files are parsed in process pool of this size.
+        Processed files are archived by archiver in background, gzip Archiver is used by default.
+        """
+        self.__default_target = target
+        self.__metrics = metrics or Metrics()
+        self.__local = local()
+        self.__bulk_load = bulk_load
+        self.__batch_size = batch_size
+        self.__cache_path = cache_path
+        self.__parse_workers = parse_workers
+        self.__archiver = archiver or Archiver()
         self.__run_start_dt = datetime.now()
+        self.__loads: Dict[Tuple[str, str], int] = {}
+        self.__loads_lock = Lock()
         self.__meta = self.__get_meta_etl_update()
         self.__mapping = self.__get_meta_core_table_mapping()
+        self.__statements = {key: self.__compile(mapping) for key, mapping in self.__mapping.items()}
         self.__run_id = self.__get_run_id()
 
-    def __get_meta_etl_update(self) -> List[tuple]:
-        """Method for getting tables last update dates"""
+    @property
+    def __target(self) -> Database:
+        """Target database bound to current thread or default one"""
+        return getattr(self.__local, 'target', self.__default_target)
+
+    @contextmanager
+    def bind(self, target: Database) -> Iterator[None]:
+        """Method for running ETL stages of current thread on another target connection"""
+        self.__local.target = target
+        try:
+            yield
+        finally:
+            del self.__local.target
+
+    @property
+    def mapping(self) -> List[dict]:
+        """Core tables mapping"""
+        return [dict(mapping) for mapping in self.__mapping.values()]
+
+    def __get_meta_etl_update(self) -> Dict[Tuple[str, str], date]:
+        """Method for getting tables last update dates indexed by (schema, table)"""
         query = '''
                 SELECT      schema_name
                             ,table_name
@@ -23,10 +79,10 @@ class ETL:
                 FROM        deaian.trsh_meta_etl_update;
                 '''
         _, data = self.__target.select(query)
-        return data
+        return {(schema, table): max_update_dt for schema, table, max_update_dt in data}
 
-    def __get_meta_core_table_mapping(self) -> List[tuple]:
-        """Method for getting core tables mapping"""
+    def __get_meta_core_table_mapping(self) -> Dict[Tuple[str, str], dict]:
+        """Method for getting core tables mapping indexed by STG (schema, table)"""
         query = '''
                 SELECT      target_schema_name
                             ,target_table_name
@@ -37,10 +93,17 @@ class ETL:
                             ,source_table_name
                             ,source_columns
                             ,source_keys
+                            ,extract_method
+                            ,extract_slices
+                            ,delete_buckets
+                            ,partition_column
+                            ,partition_interval
+                            ,snapshot_feed
                 FROM        deaian.trsh_meta_core_table_mapping;
                 '''
         _, data = self.__target.select(query)
-        return data
+        mapping = (dict(zip(self.__MAPPING_HEADERS, row)) for row in data)
+        return {(row['source_schema_name'], row['source_table_name']): row for row in mapping}
 
     def __get_run_id(self) -> int:
         """Method for getting run_id"""
@@ -72,216 +135,835 @@ class ETL:
         """Method for extending table name"""
         return (f'{schema}.' if schema else '') + (f'{prefix}_' if prefix else '') + table
 
-    def __get_last_update_dt(self, table: str, schema: str) -> datetime:
-        """Method for comparing file date vs last update date"""
-        for row in self.__meta:
-            if table == row[1] and schema == row[0]:
-                return row[2]
+    def __get_last_update_dt(self, table: str, schema: str) -> date:
+        """Method for getting last update date of table"""
+        return self.__meta.get((schema, table))
+
+    def __get_statement_columns(self, mapping: dict) -> dict:
+        """Method for getting table names, columns and keys of mapped table for generating statements"""
+        return dict(stg_table_name=self.__generate_table_name(table=mapping.get('source_table_name'),
+                                                              schema=mapping.get('source_schema_name')),
+                    stg_columns=tuple(mapping.get('source_columns')),
+                    stg_keys=tuple(mapping.get('source_keys')),
+                    dwh_table_name=self.__generate_table_name(table=mapping.get('target_table_name'),
+                                                              schema=mapping.get('target_schema_name')),
+                    dwh_columns=mapping.get('target_columns'),
+                    dwh_keys=mapping.get('target_keys'))
+
+    def __compile(self, mapping: dict) -> Dict[str, List[Tuple[str, str]]]:
+        """Method for generating statements of mapped table once, statements are prepared on first execution
+
+        SCD2 deleting statements of tables with delete_buckets take array of hash buckets to be checked
+        as parameter (NULL means all buckets). SCD2 deleting of snapshot delta closes keys removed from snapshot.
+        Snapshot statements take schema and name of STG table as parameters.
+        """
+        schema = mapping.get('source_schema_name')
+        table = mapping.get('source_table_name')
+        columns = self.__get_statement_columns(mapping)
+        stg_table_name, stg_columns, stg_keys, dwh_table_name, dwh_columns, dwh_keys = columns.values()
+        if mapping.get('delete_buckets') is None:
+            dwh_filter = 'TRUE'
+        else:
+            bucket = self.__bucket(keys=dwh_keys, buckets=mapping.get('delete_buckets'), alias='dwh')
+            dwh_filter = f'($1::INT[] IS NULL OR {bucket} = ANY($1::INT[]))'
+        queries = {
+            'clean_stg': (f'DELETE FROM {stg_table_name};',),
+            'clean_stg_del': (f'DELETE FROM {stg_table_name}_del;',),
+            'set_update_dt': (self.__set_new_update_dt_query(stg_table_name=stg_table_name),),
+            'set_row_hash': (self.__set_row_hash_query(table_name=stg_table_name, columns=stg_columns),),
+            'scd1_updating': (self.__scd1_updating(**columns),),
+            'scd2_updating': (self.__scd2_updating(**columns),),
+            'scd2_deleting': (self.__scd2_deleting(stg_del_table_name=stg_table_name, stg_keys=stg_keys,
+                                                   dwh_table_name=dwh_table_name, dwh_columns=dwh_columns,
+                                                   dwh_keys=dwh_keys, dwh_filter=dwh_filter),),
+            'scd2_deleting_del': (self.__scd2_deleting(stg_del_table_name=f'{stg_table_name}_del', stg_keys=stg_keys,
+                                                       dwh_table_name=dwh_table_name, dwh_columns=dwh_columns,
+                                                       dwh_keys=dwh_keys, dwh_filter=dwh_filter),),
+            'scd2_deleting_removed': (self.__scd2_deleting(stg_del_table_name=f'{stg_table_name}_del',
+                                                           stg_keys=stg_keys, dwh_table_name=dwh_table_name,
+                                                           dwh_columns=dwh_columns, dwh_keys=dwh_keys,
+                                                           dwh_filter=dwh_filter, removed=True),),
+            'scd_inserting': (self.__scd_inserting(scd=mapping.get('scd'), **columns),),
+            'snapshot_removed': (self.__snapshot_removed(stg_table_name=stg_table_name, stg_keys=stg_keys),),
+            'snapshot_unchanged': (self.__snapshot_unchanged(stg_table_name=stg_table_name, stg_keys=stg_keys),),
+            'snapshot_digest_removed': (self.__snapshot_digest_removed(stg_table_name=stg_table_name,
+                                                                       stg_keys=stg_keys),),
+            'snapshot_digest': (self.__snapshot_digest(stg_table_name=stg_table_name, stg_keys=stg_keys),),
+            'snapshot_digest_backfill': (self.__snapshot_digest_clean(),
+                                         self.__snapshot_digest(stg_table_name=stg_table_name, stg_keys=stg_keys,
+                                                                condition=f'stg.create_dt = (SELECT MAX(create_dt) '
+                                                                          f'FROM {stg_table_name})')),
+            'scd1_backfill_updating': (self.__scd1_backfill_updating(**columns),),
+            'scd1_backfill_inserting': (self.__scd1_backfill_inserting(**columns),),
+            'scd2_backfill_closing': (self.__scd2_backfill_closing(**columns),),
+            'scd2_backfill_inserting': (self.__scd2_backfill_inserting(**columns),)
+        }
+        return {statement: [(f'{schema}_{table}_{statement}_{number}', query) for number, query in enumerate(query)]
+                for statement, query in queries.items()}
+
+    def __execute(self, table: str, schema: str, statement: str, params: tuple = ()) -> int:
+        """Method for executing compiled statement of table, returns row count of its last query"""
+        rows = 0
+        for name, query in self.__statements[(schema, table)][statement]:
+            rows = self.__target.execute_prepared(name=name, query=query, params=params)
+        return rows
 
-    def __clean_stg(self, full_table_name) -> int:
+    def __clean_stg(self, table: str, schema: str, statement: str = 'clean_stg') -> int:
         """Method for cleaning stg tables before loading"""
-        query = f'''
-                DELETE FROM {full_table_name};
+        return self.__execute(table=table, schema=schema, statement=statement)
+
+    @staticmethod
+    def __row_hash(columns: Union[Tuple[str, ...], List[str]], alias: str = None) -> str:
+        """Method for generating MD5 hash expression of row values"""
+        columns = [f'{alias}.{column}' if alias else column for column in columns]
+        return f"MD5(ROW({', '.join(columns)})::TEXT)"
+
+    @staticmethod
+    def __dwh_row_hash(stg_alias: str, stg_columns: Union[Tuple[str, ...], List[str]], dwh_alias: str,
+                       dwh_columns: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating row hash expression of DWH row compared with STG row
+
+        DWH rows loaded before row hash was added have no hash, they get hash of STG row if their values are equal
+        or hash of their own values otherwise (also when STG row is missing).
+        """
+        stg_values = ', '.join(f'{stg_alias}.{column}' for column in stg_columns)
+        dwh_values = ', '.join(f'{dwh_alias}.{column}' for column in dwh_columns)
+        return (f'COALESCE({dwh_alias}.row_hash, CASE WHEN ROW({dwh_values}) IS NOT DISTINCT FROM ROW({stg_values}) '
+                f'THEN {stg_alias}.row_hash ELSE MD5(ROW({dwh_values})::TEXT) END)')
+
+    def __set_row_hash_query(self, table_name: str, columns: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query calculating row hash of rows inserted to stg without bulk load"""
+        return f'''
+                UPDATE		{table_name}
+                SET			row_hash = {self.__row_hash(columns)};
                 '''
-        return self.__target.execute(query)
 
-    def __insert_file_to_stg(self, file: File, prefix: str, schema: str) -> int:
-        """Method for downloading data from file to stg"""
+    def __insert_file_to_stg(self, file: File, prefix: str, schema: str, columns: Tuple[str, ...],
+                             stage: Stage) -> int:
+        """Method for downloading data from file to stg, row hash is calculated from mapped columns"""
+        table_name = self.__generate_table_name(table=file.name, prefix=prefix, schema=schema)
+        batches = self.__metrics.timed(stage, file.batches())
+        if self.__bulk_load:
+            constants = {'create_dt': f"TO_DATE('{file.dt}', 'YYYY-MM-DD')", 'processed_dt': 'NOW()',
+                         'row_hash': self.__row_hash(columns)}
+            return self.__target.copy_in(table=table_name, columns=file.headers,
+                                         rows=chain.from_iterable(batches), constants=constants)
         query = f'''
-                INSERT INTO {self.__generate_table_name(table=file.name, prefix=prefix, schema=schema)}({self.__columns_to_string(file.headers)})
-                VALUES ({self.__generate_values(len(file.headers))}, TO_DATE('{file.dt}', 'YYYY-MM-DD'), NOW());
+                INSERT INTO {table_name}({self.__columns_to_string(file.headers)})
+                VALUES ({self.__generate_values(len(file.headers) + 1)}, NOW());
                 '''
-        return self.__target.insert(query, file.data)
+        inserted = sum(self.__target.insert(query, [tuple(row) + (file.dt,) for row in batch])
+                       for batch in batches)
+        self.__execute(table=self.__generate_table_name(table=file.name, prefix=prefix), schema=schema,
+                       statement='set_row_hash')
+        return inserted
 
-    def __set_new_update_dt(self, table: str, schema: str) -> None:
-        """Method for updating max update date in meta table"""
-        query = f'''
-                UPDATE		deaian.trsh_meta_etl_update
-                SET			max_update_dt = (SELECT (MAX(create_dt)) FROM {schema}.{table})
+    @staticmethod
+    def __set_new_update_dt_query(stg_table_name: str) -> str:
+        """Method for generating query updating max update date in meta table, schema and table are parameters"""
+        return f'''
+                UPDATE		deaian.trsh_meta_etl_update AS meta
+                SET			max_update_dt = stg.max_update_dt
                             ,processed_dt = NOW()
-                WHERE		schema_name = '{schema}'
-                            AND table_name = '{table}'
-                            AND max_update_dt < (SELECT (MAX(create_dt)) FROM {schema}.{table});
+                FROM		(SELECT MAX(create_dt) AS max_update_dt FROM {stg_table_name}) AS stg
+                WHERE		meta.schema_name = $1
+                            AND meta.table_name = $2
+                            AND meta.max_update_dt < stg.max_update_dt
+                RETURNING	meta.max_update_dt;
                 '''
-        self.__target.execute(query)
 
-    def __save_etl_run_log(self, schema, table, deleted: int = 0, updated: int = 0, inserted: int = 0) -> None:
-        """Method for saving ETL log to meta table"""
-        query = f'''
-                INSERT INTO deaian.trsh_meta_etl_run_log(run_id, schema_name, table_name, rows_deleted,
-                                                        rows_updated, rows_inserted, run_start_dt, processed_dt)
-                VALUES({self.__generate_values(7)}, NOW());
+    def __set_new_update_dt(self, table: str, schema: str) -> None:
+        """Method for updating max update date in meta table and in loaded meta"""
+        name, query = self.__statements[(schema, table)]['set_update_dt'][0]
+        _, data = self.__target.select_prepared(name=name, query=query, params=(schema, table))
+        if data:
+            self.__meta[(schema, table)] = data[0][0]
+
+    def __get_load_no(self, schema: str, table: str, slice_id: int) -> int:
+        """Method for numbering loads of table in run, slices are logged under the number of their load
+
+        One run can load several files of one table (several days in scheduler or daemon micro-batch).
+        """
+        with self.__loads_lock:
+            if slice_id == 0:
+                self.__loads[(schema, table)] = self.__loads.get((schema, table), 0) + 1
+            return self.__loads.get((schema, table), 1)
+
+    def __save_etl_run_log(self, schema, table, deleted: int = 0, updated: int = 0, inserted: int = 0,
+                           slice_id: int = 0, stage: Stage = None) -> None:
+        """Method for saving ETL log to meta table, measurements are saved if stage is given"""
+        query = '''
+                INSERT INTO deaian.trsh_meta_etl_run_log(run_id, schema_name, table_name, load_no, slice_id,
+                                                        rows_deleted, rows_updated, rows_inserted, run_start_dt,
+                                                        duration_sec, extract_sec, rows_per_sec, bytes_read,
+                                                        peak_rss_kb, processed_dt)
+                VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, NOW());
                 '''
-        data = (self.__run_id, schema, table, deleted, updated, inserted, self.__run_start_dt)
-        self.__target.insert(query, [data])
+        measurements = (None,) * 5 if stage is None else (stage.seconds, stage.extract_seconds, stage.rows_per_sec,
+                                                          stage.bytes, stage.peak_rss_kb)
+        load_no = self.__get_load_no(schema, table, slice_id)
+        data = (self.__run_id, schema, table, load_no, slice_id, deleted, updated, inserted,
+                self.__run_start_dt) + measurements
+        self.__target.execute_prepared(name='trsh_meta_etl_run_log_insert', query=query, params=data)
 
     def __save_etl_run_log_end_dt(self) -> None:
         """Method for saving ETL finish date to meta table"""
-        query = f'''
+        query = '''
                 UPDATE      deaian.trsh_meta_etl_run_log
-                SET         run_end_dt = '{datetime.now()}'
-                WHERE       run_id = {self.__run_id};
+                SET         run_end_dt = $1
+                WHERE       run_id = $2;
                 '''
-        self.__target.execute(query)
+        self.__target.execute_prepared(name='trsh_meta_etl_run_log_end', query=query,
+                                       params=(datetime.now(), self.__run_id))
+
+    def new_run(self) -> int:
+        """Method for starting new run with the same connections and cached metadata, returns run_id
+
+        Stages of previous run are dropped from metrics, so exported stage gauges describe the last run.
+        """
+        self.__run_start_dt = datetime.now()
+        self.__run_id = self.__get_run_id()
+        with self.__loads_lock:
+            self.__loads = {}
+        self.__metrics.reset()
+        return self.__run_id
+
+    @staticmethod
+    def __get_plan_shape(node: dict) -> list:
+        """Method for getting plan tree without costs and row counts: node types, joins, relations and indexes"""
+        return [node.get('Node Type'), node.get('Join Type'), node.get('Strategy'), node.get('Relation Name'),
+                node.get('Index Name'), [ETL.__get_plan_shape(child) for child in node.get('Plans', ())]]
+
+    def __save_query_plans(self) -> None:
+        """Method for saving plans captured by target connections with Database capture_plans mode
+
+        Every plan is compared with the last plan of the same query saved by previous runs (baseline),
+        regression_flg is set if shape of plan changed or its total cost grew by __PLAN_COST_RATIO.
+        """
+        plans = Database.get_plans()
+        if not plans:
+            return
+        query = '''
+                SELECT      DISTINCT ON (query_hash)
+                            query_hash
+                            ,run_id
+                            ,fingerprint
+                            ,total_cost
+                FROM        deaian.trsh_meta_query_plan
+                WHERE       query_hash = ANY($1)
+                            AND run_id < $2
+                ORDER BY    query_hash, run_id DESC;
+                '''
+        for plan in plans:
+            shape = self.__get_plan_shape(plan['plan']['Plan'])
+            plan['query_hash'] = hashlib.md5(plan['query'].encode()).hexdigest()
+            plan['fingerprint'] = hashlib.md5(json.dumps(shape).encode()).hexdigest()
+        _, data = self.__target.select_prepared(name='trsh_meta_query_plan_baseline', query=query,
+                                                params=(sorted({plan['query_hash'] for plan in plans}), self.__run_id))
+        baselines = {query_hash: (run_id, fingerprint, total_cost)
+                     for query_hash, run_id, fingerprint, total_cost in data}
+        rows = []
+        for plan in plans:
+            node = plan['plan']['Plan']
+            baseline_run_id, baseline_fingerprint, baseline_cost = baselines.get(plan['query_hash'], (None,) * 3)
+            total_cost = node['Total Cost']
+            cost_ratio = total_cost / float(baseline_cost) if baseline_cost else None
+            shape_changed = baseline_fingerprint is not None and baseline_fingerprint != plan['fingerprint']
+            regression = shape_changed or cost_ratio is not None and cost_ratio >= self.__PLAN_COST_RATIO
+            rows.append((self.__run_id, plan['name'], plan['query_hash'], plan['fingerprint'], total_cost,
+                         plan['plan'].get('Execution Time'), node.get('Shared Hit Blocks'),
+                         node.get('Shared Read Blocks'), baseline_run_id, cost_ratio, shape_changed, regression,
+                         plan['query'], json.dumps(plan['plan'])))
+        self.__target.copy_in(table='deaian.trsh_meta_query_plan',
+                              columns=('run_id', 'statement_name', 'query_hash', 'fingerprint', 'total_cost',
+                                       'execution_ms', 'shared_hit_blocks', 'shared_read_blocks', 'baseline_run_id',
+                                       'cost_ratio', 'shape_changed_flg', 'regression_flg', 'query_text', 'plan'),
+                              rows=rows, constants={'processed_dt': 'NOW()'})
 
     def save(self) -> None:
-        """Method for saving ETL finish date to meta table for all tables"""
+        """Method for saving ETL finish date and query plans, exporting metrics and waiting for archiving of files"""
         self.__save_etl_run_log_end_dt()
+        self.__save_query_plans()
+        self.__target.save()
+        self.__metrics.export()
+        self.__archiver.wait()
+
+    def cancel(self) -> None:
+        """Method for rolling back uncommitted changes of current run"""
+        self.__target.cancel()
+
+    def __is_file_ingested(self, digest: str, size: int) -> bool:
+        """Method for checking ingest ledger for file with the same content"""
+        query = '''
+                SELECT      filename
+                FROM        deaian.trsh_meta_file_ingest
+                WHERE       content_hash = $1
+                            AND file_size = $2;
+                '''
+        _, data = self.__target.select_prepared(name='trsh_meta_file_ingest_select', query=query,
+                                                params=(digest, size))
+        return bool(data)
+
+    def get_ingested_tables(self, dt: date) -> Set[str]:
+        """Method for getting STG tables with files of date saved in ingest ledger"""
+        query = '''
+                SELECT      DISTINCT table_name
+                FROM        deaian.trsh_meta_file_ingest
+                WHERE       file_dt = $1;
+                '''
+        _, data = self.__target.select_prepared(name='trsh_meta_file_ingest_tables', query=query, params=(dt,))
+        return {table for table, in data}
+
+    def __save_file_ingest(self, file: File, schema: str, table: str, inserted: int) -> None:
+        """Method for saving loaded file to ingest ledger"""
+        query = '''
+                INSERT INTO deaian.trsh_meta_file_ingest(content_hash, file_size, filename, schema_name, table_name,
+                                                        file_dt, run_id, rows_inserted, processed_dt)
+                VALUES($1, $2, $3, $4, $5, $6, $7, $8, NOW())
+                ON CONFLICT DO NOTHING;
+                '''
+        self.__target.execute_prepared(name='trsh_meta_file_ingest_insert', query=query,
+                                       params=(file.digest, file.size, file.filename, schema, table, file.dt,
+                                               self.__run_id, inserted))
+
+    def __has_snapshot_digest(self, schema: str, table: str) -> bool:
+        """Method for checking if digest of previous snapshot of STG table is saved"""
+        query = '''
+                SELECT      EXISTS(	SELECT		1
+                                    FROM		deaian.trsh_meta_snapshot_digest
+                                    WHERE		schema_name = $1
+                                                AND table_name = $2);
+                '''
+        _, data = self.__target.select_prepared(name='trsh_meta_snapshot_digest_exists', query=query,
+                                                params=(schema, table))
+        return data[0][0]
+
+    def __snapshot_removed(self, stg_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query staging keys of previous snapshot missing in STG to _del table"""
+        return f'''
+                INSERT INTO {stg_table_name}_del({self.__columns_to_string(stg_keys, mode=0)})
+                SELECT      {self.__columns_to_string(stg_keys, mode=2, alias='k')}
+                            ,NOW()
+                FROM        deaian.trsh_meta_snapshot_digest AS d
+                            CROSS JOIN JSONB_POPULATE_RECORD(NULL::{stg_table_name}_del, d.key_values) AS k
+                WHERE       d.schema_name = $1
+                            AND d.table_name = $2
+                            AND NOT EXISTS(	SELECT		1
+                                            FROM		{stg_table_name} AS stg
+                                            WHERE		{self.__key_hash(stg_keys, alias='stg')} = d.key_hash);
+                '''
+
+    def __snapshot_unchanged(self, stg_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query removing rows unchanged since previous snapshot from STG"""
+        return f'''
+                DELETE FROM {stg_table_name} AS stg
+                USING       deaian.trsh_meta_snapshot_digest AS d
+                WHERE       d.schema_name = $1
+                            AND d.table_name = $2
+                            AND d.key_hash = {self.__key_hash(stg_keys, alias='stg')}
+                            AND d.row_hash = stg.row_hash;
+                '''
+
+    def __snapshot_digest_removed(self, stg_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query removing keys staged to _del table from snapshot digest"""
+        return f'''
+                DELETE FROM deaian.trsh_meta_snapshot_digest AS d
+                USING       {stg_table_name}_del AS del
+                WHERE       d.schema_name = $1
+                            AND d.table_name = $2
+                            AND d.key_hash = {self.__key_hash(stg_keys, alias='del')};
+                '''
+
+    @staticmethod
+    def __snapshot_digest_clean() -> str:
+        """Method for generating query removing snapshot digest of STG table"""
+        return '''
+                DELETE FROM deaian.trsh_meta_snapshot_digest
+                WHERE       schema_name = $1
+                            AND table_name = $2;
+                '''
+
+    def __snapshot_digest(self, stg_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]],
+                          condition: str = 'TRUE') -> str:
+        """Method for generating query saving key and row hashes of STG rows matching condition to snapshot digest
+
+        Key values are saved as JSON object, removed keys are staged from it to _del table.
+        """
+        return f'''
+                INSERT INTO deaian.trsh_meta_snapshot_digest(schema_name, table_name, key_hash, row_hash, key_values,
+                                                            snapshot_dt, processed_dt)
+                SELECT      $1::VARCHAR
+                            ,$2::VARCHAR
+                            ,{self.__key_hash(stg_keys, alias='stg')}
+                            ,stg.row_hash
+                            ,JSONB_BUILD_OBJECT({', '.join(f"'{key}', stg.{key}" for key in stg_keys)})
+                            ,stg.create_dt
+                            ,NOW()
+                FROM        {stg_table_name} AS stg
+                WHERE       {condition}
+                ON CONFLICT (schema_name, table_name, key_hash) DO UPDATE
+                SET         row_hash = EXCLUDED.row_hash
+                            ,key_values = EXCLUDED.key_values
+                            ,snapshot_dt = EXCLUDED.snapshot_dt
+                            ,processed_dt = EXCLUDED.processed_dt;
+                '''
+
+    def create_partition(self, schema: str, table: str, column: str, interval: str, dt: date) -> str:
+        """Method for creating partition containing date if it does not exist, returns partition name"""
+        return Partitioner(self.__target).create(schema=schema, table=table, column=column, interval=interval, dt=dt)
+
+    def detach_partitions(self, schema: str, table: str, before: date) -> List[str]:
+        """Method for detaching partitions created by ETL with all dates before given one, returns their names
+
+        Detached tables are kept, they can be archived or dropped separately.
+        """
+        detached = Partitioner(self.__target).detach(schema=schema, table=table, before=before)
         self.__target.save()
+        return detached
+
+    def __insert_partition(self, mapping: dict, dt: date) -> int:
+        """Method for inserting new STG rows to DWH partition of date
+
+        Partition which does not exist yet is loaded as standalone table and attached after loading,
+        rows of existing partition are inserted to partitioned table.
+        """
+        schema = mapping.get('target_schema_name')
+        table = mapping.get('target_table_name')
+        column = mapping.get('partition_column')
+        interval = mapping.get('partition_interval')
+        partitioner = Partitioner(self.__target)
+        if partitioner.exists(schema, partitioner.get_name(table, dt, interval)):
+            return self.__execute(table=mapping.get('source_table_name'), schema=mapping.get('source_schema_name'),
+                                  statement='scd_inserting')
+        partition, lower, upper = partitioner.create_standalone(schema, table, column, interval, dt)
+        inserted = self.__target.execute(self.__scd_inserting(scd=mapping.get('scd'),
+                                                              insert_table_name=f'{schema}.{partition}',
+                                                              **self.__get_statement_columns(mapping)))
+        partitioner.attach(schema, table, partition, lower, upper)
+        return inserted
 
     def from_file(self, files: Iterable[str], schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
         """Method for processing ETL loading from file"""
         for filepath in files:
-            file = File(filepath)
-            stg_full_table_name = self.__generate_table_name(table=file.name, prefix=prefix, schema=schema)
-            short_table_name = self.__generate_table_name(table=file.name, prefix=prefix)
-            mapping = self.__get_mapping(table=file.name, prefix=prefix, schema=schema)
-            stg_columns = tuple(mapping.get('source_columns'))
-            stg_keys = tuple(mapping.get('source_keys'))
-            dwh_schema = mapping.get('target_schema_name')
-            dwh_table = mapping.get('target_table_name')
-            dwh_table_name = self.__generate_table_name(table=dwh_table, schema=dwh_schema)
-            dwh_keys = mapping.get('target_keys')
-            dwh_columns = mapping.get('target_columns')
-            scd = mapping.get('scd')
-
-            # Loading data to STG
-            deleted = self.__clean_stg(stg_full_table_name)
+            self.load_file(filepath=filepath, schema=schema, prefix=prefix)
+
+    def load_file(self, filepath: str, schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
+        """Method for processing ETL loading of one file
+
+        File with content already saved in ingest ledger is not parsed. Files are archived after loading.
+        Rows of snapshot feeds unchanged since previous snapshot are removed from STG by key and row hashes
+        saved in snapshot digest, keys removed from snapshot are staged to _del table for SCD2 deleting.
+        The first snapshot is loaded fully.
+        """
+        _, _, name, _, _ = File.split_name(filepath)
+        digest = File.get_digest(filepath)
+        if self.__is_file_ingested(digest, os.path.getsize(filepath)):
+            self.__archiver.archive(filepath, digest)
+            return
+        short_table_name = self.__generate_table_name(table=name, prefix=prefix)
+        mapping = self.__get_mapping(table=name, prefix=prefix, schema=schema)
+        stg_columns = tuple(mapping.get('source_columns'))
+        dwh_schema = mapping.get('target_schema_name')
+        dwh_table = mapping.get('target_table_name')
+        scd = mapping.get('scd')
+        snapshot = False
+        delta = False
+        params = (schema, short_table_name)
+
+        # Loading data to STG, snapshot feeds are loaded fully and reduced to delta since previous snapshot
+        with self.__metrics.stage(f'{schema}.{short_table_name}') as stg_stage:
+            with stg_stage.extracting():
+                file = File(filepath, batch_size=self.__batch_size, cache_path=self.__cache_path,
+                            workers=self.__parse_workers, digest=digest)
+            deleted = self.__clean_stg(table=short_table_name, schema=schema)
             if self.__get_last_update_dt(table=short_table_name, schema=schema) < file.dt:
-                inserted = self.__insert_file_to_stg(file=file, prefix=prefix, schema=schema)
+                inserted = self.__insert_file_to_stg(file=file, prefix=prefix, schema=schema, columns=stg_columns,
+                                                     stage=stg_stage)
                 self.__set_new_update_dt(table=short_table_name, schema=schema)
+                stg_stage.bytes = file.size
+                snapshot = bool(mapping.get('snapshot_feed'))
+                delta = snapshot and self.__has_snapshot_digest(schema=schema, table=short_table_name)
+                if delta and scd == 2:
+                    with self.__metrics.stage(f'{schema}.{short_table_name}_del') as stg_del_stage:
+                        stg_del_deleted = self.__clean_stg(table=short_table_name, schema=schema,
+                                                           statement='clean_stg_del')
+                        stg_del_inserted = self.__execute(table=short_table_name, schema=schema,
+                                                          statement='snapshot_removed', params=params)
+                        stg_del_stage.rows = stg_del_inserted
+                    self.__save_etl_run_log(schema=schema, table=f'{short_table_name}_del', deleted=stg_del_deleted,
+                                            inserted=stg_del_inserted, stage=stg_del_stage)
+                if delta:
+                    inserted -= self.__execute(table=short_table_name, schema=schema, statement='snapshot_unchanged',
+                                               params=params)
             else:
                 inserted = 0
-            self.__save_etl_run_log(schema, short_table_name, deleted=deleted, inserted=inserted)
-            self.__target.save()
+            stg_stage.rows = inserted
+        self.__save_etl_run_log(schema, short_table_name, deleted=deleted, inserted=inserted, stage=stg_stage)
+        self.__target.save()
 
-            # Loading data to DWH
+        # Loading data to DWH
+        with self.__metrics.stage(f'{dwh_schema}.{dwh_table}') as dwh_stage:
             if scd == 1:
-                dwh_updated = self.__scd1_updating(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                   stg_keys=stg_keys, dwh_table_name=dwh_table_name,
-                                                   dwh_columns=dwh_columns, dwh_keys=dwh_keys)
+                dwh_updated = self.__execute(table=short_table_name, schema=schema, statement='scd1_updating')
                 dwh_deleted = 0
             elif scd == 2:
-                dwh_deleted = self.__scd2_deleting(stg_del_table_name=stg_full_table_name, stg_keys=stg_keys,
-                                                   dwh_table_name=dwh_table_name, dwh_columns=dwh_columns,
-                                                   dwh_keys=dwh_keys)
-                dwh_updated = self.__scd2_updating(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                   stg_keys=stg_keys, dwh_table_name=dwh_table_name,
-                                                   dwh_columns=dwh_columns, dwh_keys=dwh_keys)
+                dwh_deleted = self.__execute(table=short_table_name, schema=schema,
+                                             statement='scd2_deleting_removed' if delta else 'scd2_deleting',
+                                             params=self.__bucket_params(mapping))
+                dwh_updated = self.__execute(table=short_table_name, schema=schema, statement='scd2_updating')
             else:
                 dwh_deleted = 0
                 dwh_updated = 0
+            if mapping.get('partition_column') is None:
+                dwh_inserted = self.__execute(table=short_table_name, schema=schema, statement='scd_inserting')
+            else:
+                dwh_inserted = self.__insert_partition(mapping=mapping, dt=file.dt)
+            dwh_stage.rows = dwh_deleted + dwh_updated + dwh_inserted
+        self.__save_etl_run_log(schema=dwh_schema, table=dwh_table, deleted=dwh_deleted, updated=dwh_updated,
+                                inserted=dwh_inserted, stage=dwh_stage)
+        if delta and scd == 2:
+            self.__execute(table=short_table_name, schema=schema, statement='snapshot_digest_removed', params=params)
+        if snapshot:
+            self.__execute(table=short_table_name, schema=schema, statement='snapshot_digest', params=params)
+        self.__save_file_ingest(file=file, schema=schema, table=short_table_name, inserted=inserted)
+        self.__target.save()
+        self.__archiver.archive(filepath, digest)
+
+    def backfill(self, files: Iterable[str], db: Database = None, tables: Tuple[str, ...] = (),
+                 source_schema: str = 'info', schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
+        """Method for loading several days of files with one set-based merge per table and one report update
+
+        Files of each table are loaded to STG together, rows are tagged by create_dt of their file, and merged
+        to DWH in date order by one statement. Files older than last update are loaded too, except for SCD2 tables.
+        Tables of source database are loaded after files, report is updated once at the end.
+        """
+        files_by_table = {}
+        for filepath in files:
+            _, _, name, dt, _ = File.split_name(filepath)
+            files_by_table.setdefault(name, []).append((dt, filepath))
+        for name, dated_files in files_by_table.items():
+            self.__backfill_table(filepaths=[filepath for _, filepath in sorted(dated_files)], name=name,
+                                  schema=schema, prefix=prefix)
+        for table in tables:
+            self.load_table(db=db, table=table, source_schema=source_schema, target_schema=schema, prefix=prefix)
+        self.mart_update()
 
-            dwh_inserted = self.__scd_inserting(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                stg_keys=stg_keys, dwh_table_name=dwh_table_name
-                                                , dwh_columns=dwh_columns, dwh_keys=dwh_keys, scd=scd)
-            self.__save_etl_run_log(schema=dwh_schema, table=dwh_table, deleted=dwh_deleted, updated=dwh_updated,
-                                    inserted=dwh_inserted)
-            self.__target.save()
+    def __backfill_table(self, filepaths: List[str], name: str, schema: str, prefix: str) -> None:
+        """Method for loading files of one table in date order to STG and merging them to DWH at once
+
+        Digest of snapshot feed is replaced by the last backfilled snapshot, next daily load is diffed against it.
+        """
+        short_table_name = self.__generate_table_name(table=name, prefix=prefix)
+        mapping = self.__get_mapping(table=name, prefix=prefix, schema=schema)
+        stg_columns = tuple(mapping.get('source_columns'))
+        dwh_schema = mapping.get('target_schema_name')
+        dwh_table = mapping.get('target_table_name')
+        scd = mapping.get('scd')
+        pending = []
+        for filepath in filepaths:
+            digest = File.get_digest(filepath)
+            if self.__is_file_ingested(digest, os.path.getsize(filepath)):
+                self.__archiver.archive(filepath, digest)
+            else:
+                pending.append((filepath, digest))
+        if not pending:
+            return
+        last_update_dt = self.__get_last_update_dt(table=short_table_name, schema=schema)
+        if scd == 2 and File.split_name(pending[0][0])[3] <= last_update_dt:
+            raise ValueError(f'{schema}.{short_table_name}: SCD2 history can be backfilled only with files newer '
+                             f'than last update {last_update_dt}')
+
+        # Loading all files to STG
+        loaded = []
+        with self.__metrics.stage(f'{schema}.{short_table_name}') as stg_stage:
+            deleted = self.__clean_stg(table=short_table_name, schema=schema)
+            for filepath, digest in pending:
+                with stg_stage.extracting():
+                    file = File(filepath, batch_size=self.__batch_size, cache_path=self.__cache_path,
+                                workers=self.__parse_workers, digest=digest)
+                loaded.append((filepath, file, self.__insert_file_to_stg(file=file, prefix=prefix, schema=schema,
+                                                                         columns=stg_columns, stage=stg_stage)))
+                stg_stage.bytes = (stg_stage.bytes or 0) + file.size
+            self.__set_new_update_dt(table=short_table_name, schema=schema)
+            stg_stage.rows = sum(inserted for _, _, inserted in loaded)
+        self.__save_etl_run_log(schema, short_table_name, deleted=deleted, inserted=stg_stage.rows, stage=stg_stage)
+        self.__target.save()
+
+        # Merging all days to DWH
+        if mapping.get('partition_column') is not None:
+            for _, file, _ in loaded:
+                self.create_partition(schema=dwh_schema, table=dwh_table, column=mapping.get('partition_column'),
+                                      interval=mapping.get('partition_interval'), dt=file.dt)
+        with self.__metrics.stage(f'{dwh_schema}.{dwh_table}') as dwh_stage:
+            if scd == 2:
+                dwh_updated = self.__execute(table=short_table_name, schema=schema,
+                                             statement='scd2_backfill_closing')
+                dwh_inserted = self.__execute(table=short_table_name, schema=schema,
+                                              statement='scd2_backfill_inserting')
+            else:
+                dwh_updated = self.__execute(table=short_table_name, schema=schema,
+                                             statement='scd1_backfill_updating')
+                dwh_inserted = self.__execute(table=short_table_name, schema=schema,
+                                              statement='scd1_backfill_inserting')
+            dwh_stage.rows = dwh_updated + dwh_inserted
+        self.__save_etl_run_log(schema=dwh_schema, table=dwh_table, updated=dwh_updated, inserted=dwh_inserted,
+                                stage=dwh_stage)
+        if mapping.get('snapshot_feed'):
+            self.__execute(table=short_table_name, schema=schema, statement='snapshot_digest_backfill',
+                           params=(schema, short_table_name))
+        for _, file, inserted in loaded:
+            self.__save_file_ingest(file=file, schema=schema, table=short_table_name, inserted=inserted)
+        self.__target.save()
+        for filepath, file, _ in loaded:
+            self.__archiver.archive(filepath, file.digest)
 
     def __get_mapping(self, table: str, prefix: str, schema: str) -> dict:
         """Method for getting column names from table"""
-        headers = ['target_schema_name', 'target_table_name', 'target_columns', 'target_keys', 'scd',
-                   'source_schema_name', 'source_table_name', 'source_columns', 'source_keys']
-        for row in self.__mapping:
-            if row[5] == schema and row[6] == self.__generate_table_name(table=table, prefix=prefix):
-                return dict(zip(headers, row))
-
-    def __get_data(self, db: Database, table_name: str, columns: tuple, last_update_dt: datetime) -> List[tuple]:
-        """Method for getting data from source database"""
-        query = f'''
-                SELECT      {self.__columns_to_string(columns=columns, mode=2)}
-                            ,COALESCE(update_dt, create_dt) AS create_dt
-                FROM        {table_name}
-                WHERE       COALESCE(update_dt, create_dt) > TO_DATE('{last_update_dt}', 'YYYY-MM-DD');
-                '''
-        _, data = db.select(query=query)
-        return data
+        return self.__mapping.get((schema, self.__generate_table_name(table=table, prefix=prefix)))
+
+    def __get_slices(self, db: Database, table_name: str, keys: Union[Tuple[str, ...], List[str]],
+                     method: Union[str, None], slices: int) -> List[Tuple[str, tuple]]:
+        """Method for splitting source table to slices by key ranges or hash buckets"""
+        if method is None or slices <= 1:
+            return [('TRUE', ())]
+        if method == 'hash':
+            key = f"CONCAT_WS('|', {self.__columns_to_string(columns=keys, mode=2)})"
+            return [(f'MOD(HASHTEXT({key}) & 2147483647, {slices}) = {number}', ()) for number in range(slices)]
+        if method == 'range':
+            key = keys[0]
+            fractions = ', '.join(str(number / slices) for number in range(1, slices))
+            query = f'''
+                    SELECT      PERCENTILE_DISC(ARRAY[{fractions}]) WITHIN GROUP (ORDER BY {key})
+                    FROM        {table_name};
+                    '''
+            _, data = db.select(query=query)
+            bounds = data[0][0]
+            if bounds is None:
+                return [('TRUE', ())]
+            return ([(f'({key} < %s OR {key} IS NULL)', (bounds[0],))]
+                    + [(f'{key} >= %s AND {key} < %s', (lower, upper)) for lower, upper in zip(bounds, bounds[1:])]
+                    + [(f'{key} >= %s', (bounds[-1],))])
+        raise ValueError(f'Unknown extract method {method} for {table_name}')
+
+    @staticmethod
+    def __extract(db: Database, queries: List[Tuple[str, tuple]], counts: List[int],
+                  batch_size: int) -> Iterator[List[tuple]]:
+        """Method for extracting data by slices and counting rows of each slice"""
+        if len(queries) == 1:
+            query, params = queries[0]
+            batches = ((0, batch) for batch in db.stream(query=query, batch_size=batch_size, params=params))
+        else:
+            batches = db.stream_slices(queries=queries, batch_size=batch_size)
+        for number, batch in batches:
+            counts[number] += len(batch)
+            yield batch
+
+    def __get_data(self, db: Database, table_name: str, columns: tuple, last_update_dt: date,
+                   slices: List[Tuple[str, tuple]], counts: List[int]) -> Iterator[List[tuple]]:
+        """Method for getting data from source database by batches"""
+        queries = [(f'''
+                    SELECT      {self.__columns_to_string(columns=columns, mode=2)}
+                                ,COALESCE(update_dt, create_dt) AS create_dt
+                    FROM        {table_name}
+                    WHERE       COALESCE(update_dt, create_dt) > %s
+                                AND ({condition});
+                    ''', (last_update_dt,) + params) for condition, params in slices]
+        return self.__extract(db=db, queries=queries, counts=counts, batch_size=self.__batch_size)
+
+    def __get_indices(self, db: Database, table_name: str, columns: list, slices: List[Tuple[str, tuple]],
+                      counts: List[int]) -> Iterator[List[tuple]]:
+        """Method for getting table indices for checking deletion by batches"""
+        queries = [(f'''
+                    SELECT      {self.__columns_to_string(columns=columns, mode=2)}
+                    FROM        {table_name}
+                    WHERE       {condition};
+                    ''', params) for condition, params in slices]
+        return self.__extract(db=db, queries=queries, counts=counts, batch_size=self.__batch_size)
+
+    @staticmethod
+    def __key_hash(keys: Union[Tuple[str, ...], List[str]], alias: str = None) -> str:
+        """Method for generating MD5 hash expression of keys"""
+        columns = [f'{alias}.{key}' if alias else key for key in keys]
+        return f"MD5(CONCAT_WS('|', {', '.join(columns)}))"
 
-    def __get_indices(self, db: Database, table_name: str, columns: list) -> List[tuple]:
-        """Method for getting table indices for checking deletion"""
+    def __bucket(self, keys: Union[Tuple[str, ...], List[str]], buckets: int, alias: str = None) -> str:
+        """Method for generating hash bucket expression of keys"""
+        return f"MOD(('x' || SUBSTR({self.__key_hash(keys, alias)}, 1, 8))::BIT(32)::INT & 2147483647, {buckets})"
+
+    def __bucket_filter(self, keys: Union[Tuple[str, ...], List[str]], buckets: int, values: List[int],
+                        alias: str = None) -> str:
+        """Method for generating condition of keys belonging to hash buckets"""
+        if not values:
+            return 'FALSE'
+        return f"{self.__bucket(keys, buckets, alias)} IN ({', '.join(str(value) for value in values)})"
+
+    @staticmethod
+    def __bucket_params(mapping: dict, values: List[int] = None) -> tuple:
+        """Method for generating parameters of SCD2 deleting statement, all buckets are checked if values is None"""
+        return () if mapping.get('delete_buckets') is None else (values,)
+
+    def __get_digest(self, db: Database, keys_query: str, keys: Union[Tuple[str, ...], List[str]],
+                     buckets: int) -> dict:
+        """Method for getting count and checksum of keys for each hash bucket"""
         query = f'''
-                SELECT      {self.__columns_to_string(columns=columns, mode=2)}
-                FROM        {table_name};
+                SELECT      MOD(('x' || SUBSTR(hash, 1, 8))::BIT(32)::INT & 2147483647, {buckets}) AS bucket
+                            ,COUNT(*)
+                            ,SUM(('x' || SUBSTR(hash, 9, 8))::BIT(32)::INT::BIGINT)
+                FROM        (SELECT {self.__key_hash(keys)} AS hash FROM ({keys_query}) AS k) AS h
+                GROUP BY    1;
                 '''
         _, data = db.select(query=query)
-        return data
+        return {bucket: (count, checksum) for bucket, count, checksum in data}
+
+    def __get_changed_buckets(self, db: Database, source_table_name: str, stg_table_name: str,
+                              stg_keys: Union[Tuple[str, ...], List[str]], dwh_table_name: str,
+                              dwh_keys: Union[Tuple[str, ...], List[str]], buckets: int) -> List[int]:
+        """Method for comparing key digests of source table and DWH
+
+        DWH side contains current not deleted keys and keys of STG, which are going to be inserted.
+        Only buckets with different count or checksum can contain deleted keys.
+        """
+        source_query = f'SELECT {self.__columns_to_string(columns=stg_keys, mode=2)} FROM {source_table_name}'
+        target_query = f'''
+                        SELECT      {self.__columns_to_string(columns=dwh_keys, mode=2)}
+                        FROM        {dwh_table_name}
+                        WHERE       effective_to = {self.__OPEN_END}
+                                    AND deleted_flg = FALSE
+                        UNION
+                        SELECT      {self.__columns_to_string(columns=stg_keys, mode=2)}
+                        FROM        {stg_table_name}
+                        '''
+        source_digest = self.__get_digest(db=db, keys_query=source_query, keys=stg_keys, buckets=buckets)
+        target_digest = self.__get_digest(db=self.__target, keys_query=target_query, keys=dwh_keys, buckets=buckets)
+        return sorted(bucket for bucket in source_digest.keys() | target_digest.keys()
+                      if source_digest.get(bucket) != target_digest.get(bucket))
 
-    def __insert_data_to_stg(self, table: str, schema: str, prefix: str, columns: tuple, data: List[tuple],
-                             add_col=1) -> int:
-        """Method for inserting data to stg"""
+    def __reconcile_slices(self, schema: str, table: str, counts: List[int], inserted: int) -> None:
+        """Method for checking and logging row counts of extracted slices"""
+        if sum(counts) != inserted:
+            raise RuntimeError(f'{schema}.{table}: {sum(counts)} rows extracted by slices, but {inserted} loaded')
+        if len(counts) > 1:
+            for number, count in enumerate(counts, start=1):
+                self.__save_etl_run_log(schema=schema, table=table, inserted=count, slice_id=number)
+
+    def __insert_data_to_stg(self, table: str, schema: str, prefix: str, columns: tuple,
+                             data: Iterable[List[tuple]], add_col=1) -> int:
+        """Method for inserting batches of data to stg, row hash is calculated for data tables (add_col=1)"""
+        table_name = self.__generate_table_name(table, prefix, schema)
+        if self.__bulk_load:
+            constants = {'processed_dt': 'NOW()'}
+            if add_col == 1:
+                constants['row_hash'] = self.__row_hash(columns)
+            return self.__target.copy_in(table=table_name, columns=columns + (('create_dt',) if add_col == 1 else ()),
+                                         rows=chain.from_iterable(data), constants=constants)
         query = f'''
-                INSERT INTO {self.__generate_table_name(table, prefix, schema)}({self.__columns_to_string(columns, mode=add_col)})
+                INSERT INTO {table_name}({self.__columns_to_string(columns, mode=add_col)})
                 VALUES ({self.__generate_values(len(columns) + add_col)}, NOW());
                 '''
-        return self.__target.insert(query, data)
+        inserted = sum(self.__target.insert(query, batch) for batch in data)
+        if add_col == 1:
+            self.__execute(table=self.__generate_table_name(table, prefix), schema=schema, statement='set_row_hash')
+        return inserted
 
     def from_database(self, db: Database, tables: Tuple[str, ...], source_schema: str = 'info',
                       target_schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
         """Method for processing ETL loading from database"""
         for table in tables:
-            mapping = self.__get_mapping(table=table, prefix=prefix, schema=target_schema)
-            stg_columns = tuple(mapping.get('source_columns'))
-            stg_keys = tuple(mapping.get('source_keys'))
-            dwh_schema = mapping.get('target_schema_name')
-            dwh_table = mapping.get('target_table_name')
-            dwh_table_name = self.__generate_table_name(table=dwh_table, schema=dwh_schema)
-            dwh_keys = mapping.get('target_keys')
-            dwh_columns = mapping.get('target_columns')
-            scd = mapping.get('scd')
-
-            # Loading data to STG
-            stg_full_table_name = self.__generate_table_name(table=table, prefix=prefix, schema=target_schema)
-            stg_short_table_name = self.__generate_table_name(table=table, prefix=prefix)
-            source_table_name = self.__generate_table_name(table=table, schema=source_schema)
-            last_update_dt = self.__get_last_update_dt(table=stg_short_table_name, schema=target_schema)
+            self.load_table(db=db, table=table, source_schema=source_schema, target_schema=target_schema,
+                            prefix=prefix)
+
+    def load_table(self, db: Database, table: str, source_schema: str = 'info', target_schema: str = 'deaian',
+                   prefix: str = 'trsh_stg') -> None:
+        """Method for processing ETL loading of one table from database"""
+        mapping = self.__get_mapping(table=table, prefix=prefix, schema=target_schema)
+        stg_columns = tuple(mapping.get('source_columns'))
+        stg_keys = tuple(mapping.get('source_keys'))
+        dwh_schema = mapping.get('target_schema_name')
+        dwh_table = mapping.get('target_table_name')
+        dwh_table_name = self.__generate_table_name(table=dwh_table, schema=dwh_schema)
+        dwh_keys = mapping.get('target_keys')
+        scd = mapping.get('scd')
+
+        # Loading data to STG
+        stg_full_table_name = self.__generate_table_name(table=table, prefix=prefix, schema=target_schema)
+        stg_short_table_name = self.__generate_table_name(table=table, prefix=prefix)
+        source_table_name = self.__generate_table_name(table=table, schema=source_schema)
+        last_update_dt = self.__get_last_update_dt(table=stg_short_table_name, schema=target_schema)
+        with self.__metrics.stage(f'{target_schema}.{stg_short_table_name}') as stg_stage:
+            with stg_stage.extracting():
+                slices = self.__get_slices(db=db, table_name=source_table_name, keys=stg_keys,
+                                           method=mapping.get('extract_method'),
+                                           slices=mapping.get('extract_slices'))
+            source_counts = [0] * len(slices)
             source_data = self.__get_data(db=db, table_name=source_table_name, columns=stg_columns,
-                                          last_update_dt=last_update_dt)
-            stg_deleted = self.__clean_stg(stg_full_table_name)
+                                          last_update_dt=last_update_dt, slices=slices, counts=source_counts)
+            stg_deleted = self.__clean_stg(table=stg_short_table_name, schema=target_schema)
             stg_inserted = self.__insert_data_to_stg(table=table, schema=target_schema, prefix=prefix,
-                                                     columns=stg_columns, data=source_data)
+                                                     columns=stg_columns,
+                                                     data=self.__metrics.timed(stg_stage, source_data))
             self.__set_new_update_dt(table=stg_short_table_name, schema=target_schema)
-            self.__save_etl_run_log(schema=target_schema, table=stg_short_table_name, deleted=stg_deleted,
-                                    inserted=stg_inserted)
-            self.__target.save()
-
-            # Loading ids to STG
-            stg_del_table_name = f'{table}_del'
-            stg_del_full_table_name = f'{stg_full_table_name}_del'
-            stg_del_short_table_name = f'{stg_short_table_name}_del'
-            stg_del_deleted = self.__clean_stg(stg_del_full_table_name)
+            stg_stage.rows = stg_inserted
+        self.__save_etl_run_log(schema=target_schema, table=stg_short_table_name, deleted=stg_deleted,
+                                inserted=stg_inserted, stage=stg_stage)
+        self.__reconcile_slices(schema=target_schema, table=stg_short_table_name, counts=source_counts,
+                                inserted=stg_inserted)
+        self.__target.save()
+
+        # Loading ids to STG
+        stg_del_table_name = f'{table}_del'
+        stg_del_short_table_name = f'{stg_short_table_name}_del'
+        with self.__metrics.stage(f'{target_schema}.{stg_del_short_table_name}') as stg_del_stage:
+            stg_del_deleted = self.__clean_stg(table=stg_short_table_name, schema=target_schema,
+                                               statement='clean_stg_del')
+            delete_buckets = mapping.get('delete_buckets')
+            if delete_buckets is None or scd != 2:
+                del_slices = slices
+                del_params = self.__bucket_params(mapping)
+            else:
+                changed_buckets = self.__get_changed_buckets(db=db, source_table_name=source_table_name,
+                                                             stg_table_name=stg_full_table_name, stg_keys=stg_keys,
+                                                             dwh_table_name=dwh_table_name, dwh_keys=dwh_keys,
+                                                             buckets=delete_buckets)
+                source_del_filter = self.__bucket_filter(keys=stg_keys, buckets=delete_buckets,
+                                                         values=changed_buckets)
+                del_slices = [(f'({condition}) AND {source_del_filter}', params) for condition, params in slices]
+                del_params = self.__bucket_params(mapping, values=changed_buckets)
+            source_del_counts = [0] * len(del_slices)
             source_del_data = self.__get_indices(db=db, table_name=source_table_name,
-                                                 columns=mapping.get('source_keys'))
-            stg_del_inserted = self.__insert_data_to_stg(table=stg_del_table_name, schema=target_schema, prefix=prefix,
-                                                         columns=stg_keys, data=source_del_data, add_col=0)
-            self.__save_etl_run_log(schema=target_schema, table=stg_del_short_table_name,
-                                    deleted=stg_del_deleted,
-                                    inserted=stg_del_inserted)
-            self.__target.save()
-
-            # Loading data to DWH
+                                                 columns=mapping.get('source_keys'), slices=del_slices,
+                                                 counts=source_del_counts)
+            stg_del_inserted = self.__insert_data_to_stg(table=stg_del_table_name, schema=target_schema,
+                                                         prefix=prefix, columns=stg_keys,
+                                                         data=self.__metrics.timed(stg_del_stage, source_del_data),
+                                                         add_col=0)
+            stg_del_stage.rows = stg_del_inserted
+        self.__save_etl_run_log(schema=target_schema, table=stg_del_short_table_name,
+                                deleted=stg_del_deleted,
+                                inserted=stg_del_inserted, stage=stg_del_stage)
+        self.__reconcile_slices(schema=target_schema, table=stg_del_short_table_name, counts=source_del_counts,
+                                inserted=stg_del_inserted)
+        self.__target.save()
+
+        # Loading data to DWH
+        with self.__metrics.stage(f'{dwh_schema}.{dwh_table}') as dwh_stage:
             if scd == 1:
-                dwh_updated = self.__scd1_updating(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                   stg_keys=stg_keys,
-                                                   dwh_table_name=dwh_table_name, dwh_columns=dwh_columns,
-                                                   dwh_keys=dwh_keys)
+                dwh_updated = self.__execute(table=stg_short_table_name, schema=target_schema,
+                                             statement='scd1_updating')
                 dwh_deleted = 0
             elif scd == 2:
-                dwh_deleted = self.__scd2_deleting(stg_del_table_name=stg_del_full_table_name, stg_keys=stg_keys,
-                                                   dwh_table_name=dwh_table_name, dwh_columns=dwh_columns,
-                                                   dwh_keys=dwh_keys)
-                dwh_updated = self.__scd2_updating(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                   stg_keys=stg_keys, dwh_table_name=dwh_table_name,
-                                                   dwh_columns=dwh_columns, dwh_keys=dwh_keys)
+                dwh_deleted = self.__execute(table=stg_short_table_name, schema=target_schema,
+                                             statement='scd2_deleting_del', params=del_params)
+                dwh_updated = self.__execute(table=stg_short_table_name, schema=target_schema,
+                                             statement='scd2_updating')
             else:
                 dwh_deleted = 0
                 dwh_updated = 0
-            dwh_inserted = self.__scd_inserting(stg_table_name=stg_full_table_name, stg_columns=stg_columns,
-                                                stg_keys=stg_keys, dwh_table_name=dwh_table_name,
-                                                dwh_columns=dwh_columns, dwh_keys=dwh_keys, scd=scd)
-            self.__save_etl_run_log(schema=dwh_schema, table=dwh_table, deleted=dwh_deleted, updated=dwh_updated,
-                                    inserted=dwh_inserted)
-            self.__target.save()
+            dwh_inserted = self.__execute(table=stg_short_table_name, schema=target_schema,
+                                          statement='scd_inserting')
+            dwh_stage.rows = dwh_deleted + dwh_updated + dwh_inserted
+        self.__save_etl_run_log(schema=dwh_schema, table=dwh_table, deleted=dwh_deleted, updated=dwh_updated,
+                                inserted=dwh_inserted, stage=dwh_stage)
+        self.__target.save()
 
     @staticmethod
     def __matching(stg_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]]
@@ -296,88 +978,79 @@ class ETL:
 
     def __scd2_deleting(self, stg_del_table_name: str, stg_keys: Union[Tuple[str, ...], List[str]], dwh_table_name: str,
                         dwh_columns: Union[Tuple[str, ...], List[str]],
-                        dwh_keys: Union[Tuple[str, ...], List[str]]) -> int:
-        """Method for performing SCD2 deleting"""
-        query = f'''
-                UPDATE		{dwh_table_name}
-                SET			effective_to = CURRENT_DATE - INTERVAL '1 SECOND'
-                            ,processed_dt = NOW()
-                FROM		{dwh_table_name} AS dwh
-                WHERE		{self.__matching(stg_table_name='dwh', stg_keys=dwh_keys,
-                                              dwh_table_name=dwh_table_name, dwh_keys=dwh_keys)}
-                            AND {dwh_table_name}.effective_to = dwh.effective_to
-                            AND dwh.effective_to = TO_DATE('9999-12-31', 'YYYY-MM-DD')
-                            AND dwh.deleted_flg = FALSE
-                            AND NOT EXISTS(	SELECT		1
-                                            FROM		{stg_del_table_name} AS del
-                                            WHERE		{self.__matching(stg_table_name='del', stg_keys=stg_keys,
-                                                                          dwh_table_name='dwh', dwh_keys=dwh_keys)});
-                                                                             
-                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, effective_from, deleted_flg, processed_dt)
+                        dwh_keys: Union[Tuple[str, ...], List[str]], dwh_filter: str = 'TRUE',
+                        removed: bool = False) -> str:
+        """Method for generating SCD2 deleting query, only DWH rows matching dwh_filter are checked
+
+        Keys missing in stg_del_table_name are deleted, or keys present in it if removed is True.
+        Deleted versions are inserted from rows returned by closing update.
+        """
+        return f'''
+                WITH closed AS (
+                    UPDATE		{dwh_table_name} AS dwh
+                    SET			effective_to = CURRENT_DATE - INTERVAL '1 SECOND'
+                                ,processed_dt = NOW()
+                    WHERE		dwh.effective_to = {self.__OPEN_END}
+                                AND dwh.deleted_flg = FALSE
+                                AND {dwh_filter}
+                                AND {'EXISTS' if removed else 'NOT EXISTS'}(	SELECT		1
+                                                FROM		{stg_del_table_name} AS del
+                                                WHERE		{self.__matching(stg_table_name='del', stg_keys=stg_keys,
+                                                                              dwh_table_name='dwh', dwh_keys=dwh_keys)})
+                    RETURNING	{self.__columns_to_string(dwh_columns, mode=3, alias='dwh')}
+                                ,dwh.row_hash
+                    )
+                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, effective_from, deleted_flg, row_hash, processed_dt)
                 SELECT		{self.__columns_to_string(dwh_columns, mode=3)}
                             ,CURRENT_DATE
                             ,TRUE
+                            ,row_hash
                             ,NOW()
-                FROM		{dwh_table_name} AS dwh
-                WHERE		dwh.effective_to = (SELECT      MAX(effective_to)
-                                                FROM        {dwh_table_name} AS et
-                                                WHERE       {self.__matching(stg_table_name='et', stg_keys=dwh_keys,
-                                                                             dwh_table_name='dwh', dwh_keys=dwh_keys)})
-                            AND dwh.deleted_flg = FALSE
-                            AND NOT EXISTS(	SELECT		1
-                                            FROM		{stg_del_table_name} AS del
-                                            WHERE		{self.__matching(stg_table_name='del', stg_keys=stg_keys,
-                                                                          dwh_table_name='dwh', dwh_keys=dwh_keys)});
+                FROM		closed;
                 '''
-        return self.__target.execute(query)
 
     def __scd2_updating(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
                         stg_keys: Union[Tuple[str, ...], List[str]],
                         dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
-                        dwh_keys: Union[Tuple[str, ...], List[str]]) -> int:
-        """Method for performing SCD2 updating"""
-        query = f'''
-                UPDATE		{dwh_table_name}
-                SET			effective_to = stg.create_dt - INTERVAL '1 SECOND'
-                            ,processed_dt = NOW()
-                FROM		{dwh_table_name} AS dwh
-                            INNER JOIN {stg_table_name} AS stg ON {self.__matching(stg_table_name='stg', stg_keys=stg_keys,
-                                                                                   dwh_table_name='dwh', dwh_keys=dwh_keys)}
-                WHERE		{self.__matching(stg_table_name='dwh', stg_keys=dwh_keys,
-                                              dwh_table_name=dwh_table_name, dwh_keys=dwh_keys)}
-                            AND {dwh_table_name}.effective_to = dwh.effective_to
-                            AND dwh.effective_to = TO_DATE('9999-12-31', 'YYYY-MM-DD')
-                            AND NOT EXISTS(	SELECT		{self.__columns_to_string(dwh_columns, mode=3, alias='dwh')}, dwh.deleted_flg
-                                            INTERSECT
-                                            SELECT		{self.__columns_to_string(stg_columns, mode=3, alias='stg')}, FALSE);
-                                            
-                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, effective_from, deleted_flg, processed_dt)
-                SELECT		{self.__columns_to_string(stg_columns, mode=3, alias='stg')}
-                            ,stg.create_dt
+                        dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating SCD2 updating query
+
+        Changed rows are found by row hash, new versions are inserted from rows returned by closing update.
+        """
+        return f'''
+                WITH closed AS (
+                    UPDATE		{dwh_table_name} AS dwh
+                    SET			effective_to = stg.create_dt - INTERVAL '1 SECOND'
+                                ,processed_dt = NOW()
+                    FROM		{stg_table_name} AS stg
+                    WHERE		{self.__matching(stg_table_name='stg', stg_keys=stg_keys,
+                                                  dwh_table_name='dwh', dwh_keys=dwh_keys)}
+                                AND dwh.effective_to = {self.__OPEN_END}
+                                AND ({self.__dwh_row_hash('stg', stg_columns, 'dwh', dwh_columns)} IS DISTINCT FROM stg.row_hash
+                                     OR dwh.deleted_flg = TRUE)
+                    RETURNING	{self.__columns_to_string(stg_columns, mode=3, alias='stg')}
+                                ,stg.create_dt
+                                ,stg.row_hash
+                    )
+                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, effective_from, deleted_flg, row_hash, processed_dt)
+                SELECT		{self.__columns_to_string(stg_columns, mode=3)}
+                            ,create_dt
                             ,FALSE
+                            ,row_hash
                             ,NOW()
-                FROM		{dwh_table_name} AS dwh
-                            INNER JOIN {stg_table_name} AS stg ON {self.__matching(stg_table_name='stg', stg_keys=stg_keys,
-                                                                                   dwh_table_name='dwh', dwh_keys=dwh_keys)}
-                WHERE		dwh.effective_to = (SELECT      MAX(effective_to)
-                                                FROM        {dwh_table_name} AS et
-                                                WHERE       {self.__matching(stg_table_name='et', stg_keys=dwh_keys,
-                                                                             dwh_table_name='dwh', dwh_keys=dwh_keys)})
-                            AND NOT EXISTS(	SELECT		{self.__columns_to_string(dwh_columns, mode=3, alias='dwh')}, dwh.deleted_flg
-                                            INTERSECT
-                                            SELECT		{self.__columns_to_string(stg_columns, mode=3, alias='stg')}, FALSE);
+                FROM		closed;
                 '''
-        return self.__target.execute(query)
 
     def __scd_inserting(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
                         stg_keys: Union[Tuple[str, ...], List[str]],
                         dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
-                        dwh_keys: Union[Tuple[str, ...], List[str]], scd: int) -> int:
-        """Method for performing SCD inserting"""
-        query = f'''
-                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, {'effective_from' if scd == 2 else 'create_dt'}, processed_dt)
+                        dwh_keys: Union[Tuple[str, ...], List[str]], scd: int, insert_table_name: str = None) -> str:
+        """Method for generating SCD inserting query, rows are inserted to insert_table_name (DWH table by default)"""
+        return f'''
+                INSERT INTO {insert_table_name or dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, {'effective_from' if scd == 2 else 'create_dt'}, row_hash, processed_dt)
                 SELECT		{self.__columns_to_string(stg_columns, mode=3)}
                             ,create_dt
+                            ,row_hash
                             ,NOW()
                 FROM		{stg_table_name} AS stg
                 WHERE		NOT EXISTS(	SELECT		1
@@ -385,32 +1058,292 @@ class ETL:
                                         WHERE		{self.__matching(stg_table_name='stg', stg_keys=stg_keys,
                                                                       dwh_table_name='dwh', dwh_keys=dwh_keys)});
                 '''
-        return self.__target.execute(query)
 
     def __scd1_updating(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
                         stg_keys: Union[Tuple[str, ...], List[str]],
                         dwh_table_name: Union[str, None], dwh_columns: Union[Tuple[str, ...], List[str]],
-                        dwh_keys: Union[Tuple[str, ...], List[str]]) -> int:
-        """Method for performing SCD1 updating"""
-        query = f'''
+                        dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating SCD1 updating query"""
+        return f'''
                 UPDATE		{dwh_table_name}
                 SET			{self.__matching(stg_table_name='stg', stg_keys=stg_columns, dwh_table_name=None, dwh_keys=dwh_columns)}
                             ,update_dt = stg.create_dt
+                            ,row_hash = stg.row_hash
                             ,processed_dt = NOW()
                 FROM		{dwh_table_name} AS dwh
                             INNER JOIN {stg_table_name} AS stg ON {self.__matching(stg_table_name='stg', stg_keys=stg_keys,
                                                                                    dwh_table_name='dwh', dwh_keys=dwh_keys)}
-                WHERE		NOT EXISTS(	SELECT		{self.__columns_to_string(dwh_columns, mode=3, alias='dwh')}
-                                        INTERSECT
-                                        SELECT		{self.__columns_to_string(stg_columns, mode=3, alias='stg')});
+                WHERE		{self.__matching(stg_table_name='dwh', stg_keys=dwh_keys,
+                                              dwh_table_name=dwh_table_name, dwh_keys=dwh_keys)}
+                            AND {self.__dwh_row_hash('stg', stg_columns, 'dwh', dwh_columns)} IS DISTINCT FROM stg.row_hash;
+                '''
+
+    def __backfill_versions(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                            stg_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating CTE numbering STG rows of several days by key in date order"""
+        keys = self.__columns_to_string(stg_keys, mode=2, alias='stg')
+        return f'''
+                versions AS (
+                    SELECT      {self.__columns_to_string(stg_columns, mode=2, alias='stg')}
+                                ,stg.create_dt
+                                ,stg.row_hash
+                                ,LAG(stg.row_hash) OVER(PARTITION BY {keys} ORDER BY stg.create_dt) AS prev_hash
+                                ,ROW_NUMBER() OVER(PARTITION BY {keys} ORDER BY stg.create_dt) AS version
+                                ,ROW_NUMBER() OVER(PARTITION BY {keys} ORDER BY stg.create_dt DESC) AS version_desc
+                    FROM        {stg_table_name} AS stg
+                    )'''
+
+    def __scd1_backfill_updating(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                                 stg_keys: Union[Tuple[str, ...], List[str]],
+                                 dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
+                                 dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating SCD1 updating query of several days in STG
+
+        DWH rows get the last version of STG, update date is the last date when row hash changed.
+        """
+        return f'''
+                WITH {self.__backfill_versions(stg_table_name, stg_columns, stg_keys)},
+                changes AS (
+                    SELECT      {self.__columns_to_string(stg_keys, mode=2, alias='v')}
+                                ,MAX(v.create_dt) AS update_dt
+                    FROM        versions AS v
+                                INNER JOIN {dwh_table_name} AS dwh ON {self.__matching(stg_table_name='v', stg_keys=stg_keys,
+                                                                                       dwh_table_name='dwh', dwh_keys=dwh_keys)}
+                    WHERE       (CASE WHEN v.version = 1 THEN {self.__dwh_row_hash('v', stg_columns, 'dwh', dwh_columns)}
+                                      ELSE v.prev_hash END) IS DISTINCT FROM v.row_hash
+                    GROUP BY    {self.__columns_to_string(stg_keys, mode=2, alias='v')}
+                    )
+                UPDATE		{dwh_table_name} AS dwh
+                SET			{self.__matching(stg_table_name='v', stg_keys=stg_columns, dwh_table_name=None, dwh_keys=dwh_columns)}
+                            ,update_dt = ch.update_dt
+                            ,row_hash = v.row_hash
+                            ,processed_dt = NOW()
+                FROM		versions AS v
+                            INNER JOIN changes AS ch ON {self.__matching(stg_table_name='ch', stg_keys=stg_keys,
+                                                                         dwh_table_name='v', dwh_keys=stg_keys)}
+                WHERE		{self.__matching(stg_table_name='v', stg_keys=stg_keys, dwh_table_name='dwh', dwh_keys=dwh_keys)}
+                            AND v.version_desc = 1;
+                '''
+
+    def __scd1_backfill_inserting(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                                  stg_keys: Union[Tuple[str, ...], List[str]],
+                                  dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
+                                  dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating SCD1 inserting query of several days in STG
+
+        New keys get the last version of STG, create date of the first day and update date of the last change.
+        """
+        return f'''
+                WITH {self.__backfill_versions(stg_table_name, stg_columns, stg_keys)},
+                dates AS (
+                    SELECT      {self.__columns_to_string(stg_keys, mode=2, alias='v')}
+                                ,MIN(v.create_dt) AS create_dt
+                                ,MAX(CASE WHEN v.version > 1 AND v.prev_hash IS DISTINCT FROM v.row_hash
+                                          THEN v.create_dt END) AS update_dt
+                    FROM        versions AS v
+                    GROUP BY    {self.__columns_to_string(stg_keys, mode=2, alias='v')}
+                    )
+                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, create_dt, update_dt, row_hash, processed_dt)
+                SELECT		{self.__columns_to_string(stg_columns, mode=3, alias='v')}
+                            ,dt.create_dt
+                            ,dt.update_dt
+                            ,v.row_hash
+                            ,NOW()
+                FROM		versions AS v
+                            INNER JOIN dates AS dt ON {self.__matching(stg_table_name='dt', stg_keys=stg_keys,
+                                                                       dwh_table_name='v', dwh_keys=stg_keys)}
+                WHERE		v.version_desc = 1
+                            AND NOT EXISTS(	SELECT		1
+                                            FROM		{dwh_table_name} AS dwh
+                                            WHERE		{self.__matching(stg_table_name='v', stg_keys=stg_keys,
+                                                                          dwh_table_name='dwh', dwh_keys=dwh_keys)});
+                '''
+
+    def __scd2_backfill_versions(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                                 stg_keys: Union[Tuple[str, ...], List[str]],
+                                 dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
+                                 dwh_keys: Union[Tuple[str, ...], List[str]], current: bool = True) -> str:
+        """Method for generating CTEs of SCD2 versions of several days of full snapshots in STG
+
+        Every key is checked on every day of STG: versions start on days when row hash changed, key appeared or
+        disappeared (deleted version), previous version ends a second before the next one. Deleted versions copy
+        values of the version before them. DWH versions the new ones follow are current versions, or the latest
+        versions of keys if current is False (current versions are already closed).
+        """
+        keys = self.__columns_to_string(dwh_keys, mode=2, alias='c')
+        values = [(stg, dwh) for stg, dwh in zip(stg_columns, dwh_columns) if dwh not in dwh_keys]
+        return f'''
+                WITH days AS (
+                    SELECT      DISTINCT create_dt
+                    FROM        {stg_table_name}
+                    ),
+                cur AS (
+                    SELECT      {'' if current else f"DISTINCT ON ({self.__columns_to_string(dwh_keys, mode=2, alias='dwh')})"}
+                                {self.__columns_to_string(dwh_columns, mode=2, alias='dwh')}
+                                ,dwh.row_hash
+                                ,dwh.deleted_flg
+                    FROM        {dwh_table_name} AS dwh
+                    WHERE       {f'dwh.effective_to = {self.__OPEN_END}' if current else 'TRUE'}
+                    {'' if current else f"ORDER BY    {self.__columns_to_string(dwh_keys, mode=2, alias='dwh')}, dwh.effective_from DESC"}
+                    ),
+                snapshot_keys AS (
+                    SELECT      {', '.join(f'stg.{stg} AS {dwh}' for stg, dwh in zip(stg_keys, dwh_keys))}
+                    FROM        {stg_table_name} AS stg
+                    UNION
+                    SELECT      {self.__columns_to_string(dwh_keys, mode=2, alias='cur')}
+                    FROM        cur
+                    WHERE       cur.deleted_flg = FALSE
+                    ),
+                states AS (
+                    SELECT      {self.__columns_to_string(dwh_keys, mode=2, alias='k')}
+                                {''.join(f', stg.{stg} AS {dwh}, cur.{dwh} AS cur_{dwh}' for stg, dwh in values)}
+                                ,d.create_dt
+                                ,stg.row_hash
+                                ,cur.row_hash AS cur_row_hash
+                                ,CASE WHEN cur.deleted_flg = FALSE
+                                      THEN {self.__dwh_row_hash('stg', stg_columns, 'cur', dwh_columns)} END AS cur_live_hash
+                                ,LAG(stg.row_hash) OVER(PARTITION BY {self.__columns_to_string(dwh_keys, mode=2, alias='k')}
+                                                        ORDER BY d.create_dt) AS prev_hash
+                                ,ROW_NUMBER() OVER(PARTITION BY {self.__columns_to_string(dwh_keys, mode=2, alias='k')}
+                                                   ORDER BY d.create_dt) AS day_no
+                    FROM        snapshot_keys AS k
+                                CROSS JOIN days AS d
+                                LEFT JOIN {stg_table_name} AS stg ON {self.__matching(stg_table_name='stg', stg_keys=stg_keys,
+                                                                                      dwh_table_name='k', dwh_keys=dwh_keys)}
+                                    AND stg.create_dt = d.create_dt
+                                LEFT JOIN cur ON {self.__matching(stg_table_name='k', stg_keys=dwh_keys,
+                                                                  dwh_table_name='cur', dwh_keys=dwh_keys)}
+                    ),
+                changes AS (
+                    SELECT      *
+                    FROM        states AS s
+                    WHERE       (CASE WHEN s.day_no = 1 THEN s.cur_live_hash ELSE s.prev_hash END) IS DISTINCT FROM s.row_hash
+                    ),
+                versions AS (
+                    SELECT      {keys}
+                                {''.join(f"""
+                                ,CASE WHEN c.row_hash IS NOT NULL THEN c.{dwh}
+                                      WHEN ROW_NUMBER() OVER w = 1 THEN c.cur_{dwh}
+                                      ELSE LAG(c.{dwh}) OVER w END AS {dwh}""" for _, dwh in values)}
+                                ,c.create_dt AS effective_from
+                                ,LEAD(c.create_dt) OVER w AS next_dt
+                                ,c.row_hash IS NULL AS deleted_flg
+                                ,COALESCE(c.row_hash, LAG(c.row_hash) OVER w, c.cur_row_hash) AS row_hash
+                    FROM        changes AS c
+                    WINDOW      w AS (PARTITION BY {keys} ORDER BY c.create_dt)
+                    )
+'''
+
+    def __scd2_backfill_closing(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                                stg_keys: Union[Tuple[str, ...], List[str]],
+                                dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
+                                dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query closing current DWH versions a second before the first backfilled version"""
+        return f'''
+                {self.__scd2_backfill_versions(stg_table_name, stg_columns, stg_keys, dwh_table_name, dwh_columns,
+                                               dwh_keys).strip()}
+                UPDATE		{dwh_table_name} AS dwh
+                SET			effective_to = f.effective_from - INTERVAL '1 SECOND'
+                            ,processed_dt = NOW()
+                FROM		(SELECT {self.__columns_to_string(dwh_keys, mode=2)}, MIN(effective_from) AS effective_from
+                             FROM versions GROUP BY {self.__columns_to_string(dwh_keys, mode=2)}) AS f
+                WHERE		{self.__matching(stg_table_name='f', stg_keys=dwh_keys, dwh_table_name='dwh', dwh_keys=dwh_keys)}
+                            AND dwh.effective_to = {self.__OPEN_END};
                 '''
-        return self.__target.execute(query)
 
-    def mart_update(self) -> None:
-        """Method for generating report"""
-        query = self.__target.get_script('./sql_scripts/trsh_rep_fraud_sync.sql')
-        rep_inserted = self.__target.execute(query)
-        self.__save_etl_run_log(schema='deaian', table='trsh_rep_fraud', inserted=rep_inserted)
+    def __scd2_backfill_inserting(self, stg_table_name: str, stg_columns: Union[Tuple[str, ...], List[str]],
+                                  stg_keys: Union[Tuple[str, ...], List[str]],
+                                  dwh_table_name: str, dwh_columns: Union[Tuple[str, ...], List[str]],
+                                  dwh_keys: Union[Tuple[str, ...], List[str]]) -> str:
+        """Method for generating query inserting backfilled versions, it is run after closing query"""
+        return f'''
+                {self.__scd2_backfill_versions(stg_table_name, stg_columns, stg_keys, dwh_table_name, dwh_columns,
+                                               dwh_keys, current=False).strip()}
+                INSERT INTO {dwh_table_name}({self.__columns_to_string(dwh_columns, mode=3)}, effective_from, effective_to, deleted_flg, row_hash, processed_dt)
+                SELECT		{self.__columns_to_string(dwh_columns, mode=3, alias='v')}
+                            ,v.effective_from
+                            ,COALESCE(v.next_dt - INTERVAL '1 SECOND', {self.__OPEN_END})
+                            ,v.deleted_flg
+                            ,v.row_hash
+                            ,NOW()
+                FROM		versions AS v;
+                '''
+
+    def __get_enriched_dates(self) -> Tuple[date, List[date]]:
+        """Method for getting create dates of fact partitions to read by enriched update
+
+        Partitions from last enriched create date are read, earlier ones only if transaction files of their date were
+        loaded since previous enriched update (by ingest ledger) or their rows were enriched while terminal was missing.
+        """
+        query = '''
+                SELECT      (SELECT COALESCE(MAX(create_dt), TO_DATE('1800-01-01', 'YYYY-MM-DD'))
+                             FROM deaian.trsh_dwh_fact_transaction_enriched)
+                            ,ARRAY(SELECT      file_dt
+                                   FROM        deaian.trsh_meta_file_ingest
+                                   WHERE       schema_name = 'deaian'
+                                               AND table_name = 'trsh_stg_transactions'
+                                               AND run_id >= (SELECT    COALESCE(MAX(run_id), 0)
+                                                              FROM      deaian.trsh_meta_etl_run_log
+                                                              WHERE     schema_name = 'deaian'
+                                                                        AND table_name = 'trsh_dwh_fact_transaction_enriched')
+                                   UNION
+                                   SELECT      create_dt::DATE
+                                   FROM        deaian.trsh_dwh_fact_transaction_enriched
+                                   WHERE       terminal_city IS NULL
+                                   ORDER BY    1);
+                '''
+        _, data = self.__target.select(query)
+        return data[0]
+
+    def enriched_update(self) -> None:
+        """Method for resolving new transactions to dimension versions valid at transaction date
+
+        Create dates are passed to script as literals, so fact partitions out of them are pruned at planning.
+        """
+        query = self.__target.get_script('./sql_scripts/trsh_dwh_fact_transaction_enriched_sync.sql')
+        with self.__metrics.stage('deaian.trsh_dwh_fact_transaction_enriched') as stage:
+            create_dt_from, create_dates = self.__get_enriched_dates()
+            enriched_upserted = self.__target.execute(query, {'create_dt_from': create_dt_from,
+                                                              'create_dates': create_dates})
+            stage.rows = enriched_upserted
+        self.__save_etl_run_log(schema='deaian', table='trsh_dwh_fact_transaction_enriched',
+                                inserted=enriched_upserted, stage=stage)
+        self.__target.save()
+
+    def __get_report_bounds(self) -> Tuple[date, Union[datetime, None], Union[datetime, None], Union[datetime, None]]:
+        """Method for getting last report date and range of create and transaction dates of transactions to report"""
+        query = '''
+                SELECT      wm.watermark
+                            ,MIN(tr.create_dt)
+                            ,MAX(tr.create_dt)
+                            ,MIN(tr.trans_date)
+                FROM        (SELECT COALESCE(MAX(report_dt), TO_DATE('1800-01-01', 'YYYY-MM-DD')) AS watermark
+                             FROM deaian.trsh_rep_fraud) AS wm
+                            LEFT JOIN deaian.trsh_dwh_fact_transaction_enriched AS tr ON tr.create_dt > wm.watermark
+                GROUP BY    wm.watermark;
+                '''
+        _, data = self.__target.select(query)
+        return data[0]
+
+    def mart_update(self, enrich: bool = True) -> None:
+        """Method for generating report, enriched transactions are updated first unless enrich is False
+
+        Last report date and first transaction date of new transactions are found once and passed to report script,
+        so windowed rules read only new transactions and their lookback. Report partitions are created before.
+        """
+        if enrich:
+            self.enriched_update()
+        watermark, first_dt, last_dt, trans_date_from = self.__get_report_bounds()
+        with self.__metrics.stage('deaian.trsh_rep_fraud') as stage:
+            if first_dt is None:
+                rep_inserted = 0
+            else:
+                Partitioner(self.__target).create_report(first_dt.date(), last_dt.date())
+                query = self.__target.get_script('./sql_scripts/trsh_rep_fraud_sync.sql')
+                rep_inserted = self.__target.execute(query, {'watermark': watermark,
+                                                             'trans_date_from': trans_date_from})
+            stage.rows = rep_inserted
+        self.__save_etl_run_log(schema='deaian', table='trsh_rep_fraud', inserted=rep_inserted, stage=stage)
         self.__target.save()
 
 
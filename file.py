@@ -1,15 +1,142 @@
-from typing import Tuple, List
+from typing import Tuple, List, Iterator, Sequence, Union
 from datetime import datetime, date
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gc
+import hashlib
+import mmap
 import os
-import pandas as pd
+import numpy as np
+from openpyxl import load_workbook
+
+
+def _to_datetime(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to datetime array, empty values are NaT, invalid ones are added to errors"""
+    try:
+        return np.array(values, dtype='datetime64[us]')
+    except ValueError:
+        pass
+    result = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[us]')
+    for position, (value, line) in enumerate(zip(values, lines)):
+        try:
+            result[position] = np.datetime64(value, 'us')
+        except ValueError:
+            errors.append((line, header, value))
+    return result
+
+
+def _to_fixed_point(values: Sequence[str], lines: Sequence[int], header: str, errors: List[tuple]) -> np.ndarray:
+    """Function for converting column to integers scaled by 10^_FIXED_POINT_SCALE, invalid values are added to errors
+
+    Values up to 15 digits are converted exactly through float64 at once, longer or invalid ones and ones with
+    more digits after point than scale (float does not round them half up) are converted one by one.
+    Empty values are converted to _FIXED_POINT_NULL.
+    """
+    if values and max(map(len, values)) <= 15:
+        try:
+            scaled = np.array(values, dtype=np.float64) * 10 ** _FIXED_POINT_SCALE
+            result = np.rint(scaled)
+            if np.isfinite(result).all() and (np.abs(scaled - result) < 0.25).all():
+                return result.astype(np.int64)
+        except ValueError:
+            pass
+    result = np.full(len(values), _FIXED_POINT_NULL, dtype=np.int64)
+    for position, (value, line) in enumerate(zip(values, lines)):
+        if value == '':
+            continue
+        try:
+            result[position] = int(Decimal(value).scaleb(_FIXED_POINT_SCALE).to_integral_value(ROUND_HALF_UP))
+        except (InvalidOperation, ValueError, OverflowError):
+            errors.append((line, header, value))
+    return result
+
+
+def _from_fixed_point(values: np.ndarray) -> List[Union[float, Decimal, None]]:
+    """Function for converting scaled integers back to numbers
+
+    Numbers up to 15 significant digits are exactly represented by float, so they are converted at once.
+    """
+    nulls = np.flatnonzero(values == _FIXED_POINT_NULL).tolist()
+    if np.abs(np.delete(values, nulls)).max(initial=0) < 10 ** 15:
+        result = (values / 10 ** _FIXED_POINT_SCALE).tolist()
+    else:
+        result = [Decimal(value).scaleb(-_FIXED_POINT_SCALE) for value in values.tolist()]
+    for position in nulls:
+        result[position] = None
+    return result
+
+
+_FIXED_POINT_SCALE = 2
+
+_FIXED_POINT_NULL = np.iinfo(np.int64).min
+
+# Typed .txt columns: header -> (function parsing column in worker, function converting it to Python values)
+_TXT_TYPES = {'transaction_date': (_to_datetime, np.ndarray.tolist),
+              'amount': (_to_fixed_point, _from_fixed_point)}
+
+
+def _parse_txt_range(filepath: str, start: int, end: int,
+                     headers: Tuple[str, ...]) -> Tuple[List, int, int, List[tuple]]:
+    """Function for parsing byte range of .txt file to typed columns in worker process
+
+    Returns columns, number of rows and lines in range and errors as (line number in range, column, value).
+    Text columns are joined by new line, it is much faster to transfer one string than list of them.
+    """
+    with open(filepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        lines = mapped[start:end].decode('utf-8').split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    # Garbage collection of millions of new row lists takes more time than parsing itself
+    gc.disable()
+    try:
+        rows = [line.strip().replace(',', '.').split(';') for line in lines]
+        numbers = range(len(rows))
+        errors = []
+        if any(len(row) != len(headers) for row in rows):
+            errors = [(number, None, line.strip()) for number, (line, row) in enumerate(zip(lines, rows))
+                      if len(row) != len(headers) and row != ['']]
+            numbers = [number for number, row in enumerate(rows) if len(row) == len(headers)]
+            rows = [rows[number] for number in numbers]
+        columns = list(zip(*rows)) or [() for _ in headers]
+        for position, header in enumerate(headers):
+            if header in _TXT_TYPES:
+                columns[position] = _TXT_TYPES[header][0](columns[position], numbers, header, errors)
+            else:
+                columns[position] = '\n'.join(columns[position])
+        return columns, len(rows), len(lines), sorted(errors, key=lambda error: error[0])
+    finally:
+        gc.enable()
 
 
 class File:
     """Class for handling files"""
 
-    def __init__(self, filepath: str) -> None:
-        self.path, self.filename, self.name, self.dt, self.ext = self.__split_name(filepath)
-        self.headers, self.data = self.__HANDLER[self.ext](filepath)
+    def __init__(self, filepath: str, batch_size: int = None, cache_path: str = None, workers: int = None,
+                 digest: str = None) -> None:
+        """Parsed .xlsx files are cached in cache_path by content hash if it is given
+
+        With workers given .txt files are parsed to typed values in process pool by byte ranges.
+        Content hash is calculated when it is needed if it is not given.
+        """
+        self.path, self.filename, self.name, self.dt, self.ext = self.split_name(filepath)
+        self.size = os.path.getsize(filepath)
+        self.digest = digest
+        self.batch_size = batch_size
+        if cache_path is not None and self.ext in self.__CACHED_EXTENSIONS:
+            self.headers, self.data = self.__read_cached(filepath, cache_path)
+            self.__batches = None
+        elif workers is not None and self.ext == 'txt':
+            self.headers, batches = self.__stream_txt_parallel(filepath, batch_size or self.__RANGE_SIZE, workers)
+            self.data = None if batch_size else [row for batch in batches for row in batch]
+            self.__batches = batches if batch_size else None
+        elif batch_size is None:
+            self.headers, self.data = self.__HANDLER[self.ext](filepath)
+            self.__batches = None
+        else:
+            self.headers, self.__batches = self.__STREAM_HANDLER[self.ext](filepath, batch_size)
+            self.data = None
 
     @staticmethod
     def __parse_dt(dt: str) -> date:
@@ -17,7 +144,7 @@ class File:
         return datetime.strptime(dt, '%d%m%Y').date()
 
     @staticmethod
-    def __split_name(filepath: str) -> Tuple[str, str, str, date, str]:
+    def split_name(filepath: str) -> Tuple[str, str, str, date, str]:
         """Method for getting attributes from file name"""
         path = filepath.rsplit(os.sep, 1)[0]
         filename = filepath.rsplit(os.sep, 1)[-1]
@@ -25,34 +152,195 @@ class File:
         ext = filename.rsplit('.', 1)[-1]
         return path, filename, name, File.__parse_dt(dt), ext
 
+    @staticmethod
+    def __parse_txt_row(row: str) -> List[str]:
+        """Method for splitting .txt file row to values"""
+        return row.strip().replace(',', '.').split(';')
+
+    @staticmethod
+    def __split_batches(rows: Iterator[list], batch_size: int) -> Iterator[List[list]]:
+        """Method for grouping rows to batches of fixed size"""
+        return iter(lambda: list(islice(rows, batch_size)), [])
+
     @staticmethod
     def __read_txt(filepath: str) -> Tuple[Tuple[str, ...], List[List[str]]]:
         """Method for reading .txt files"""
         with open(filepath, encoding='utf-8-sig') as file:
-            data = [row.strip().replace(',', '.').split(';') for row in file.readlines()]
+            data = [File.__parse_txt_row(row) for row in file]
             headers = tuple(data.pop(0))
         return headers, data
 
     @staticmethod
-    def __read_xlsx(filepath: str) -> Tuple[Tuple[str, ...], List[List[str]]]:
+    def __stream_txt(filepath: str, batch_size: int) -> Tuple[Tuple[str, ...], Iterator[List[List[str]]]]:
+        """Method for reading .txt files by batches"""
+        with open(filepath, encoding='utf-8-sig') as file:
+            headers = tuple(File.__parse_txt_row(file.readline()))
+
+        def batches() -> Iterator[List[List[str]]]:
+            with open(filepath, encoding='utf-8-sig') as stream:
+                stream.readline()
+                yield from File.__split_batches(map(File.__parse_txt_row, stream), batch_size)
+
+        return headers, batches()
+
+    @staticmethod
+    def __get_ranges(filepath: str) -> Tuple[Tuple[str, ...], List[Tuple[int, int]]]:
+        """Method for reading .txt file headers and splitting its data to byte ranges at line boundaries"""
+        with open(filepath, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return (), []
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = mapped.find(b'\n') + 1 or len(mapped)
+                headers = tuple(File.__parse_txt_row(mapped[:start].decode('utf-8-sig')))
+                ranges = []
+                while start < len(mapped):
+                    end = mapped.find(b'\n', start + File.__RANGE_SIZE) + 1 or len(mapped)
+                    ranges.append((start, end))
+                    start = end
+        return headers, ranges
+
+    @staticmethod
+    def __format_errors(filepath: str, errors: List[tuple]) -> str:
+        """Method for generating message of parsing errors with line numbers"""
+        messages = [f'line {line}: ' + (f'expected {column} values in {value!r}' if isinstance(column, int)
+                                        else f'invalid {column} {value!r}') for line, column, value in errors[:10]]
+        more = f' and {len(errors) - 10} more' if len(errors) > 10 else ''
+        return f'Can not parse {filepath}: ' + '; '.join(messages) + more
+
+    @staticmethod
+    def __stream_txt_parallel(filepath: str, batch_size: int,
+                              workers: int) -> Tuple[Tuple[str, ...], Iterator[List[tuple]]]:
+        """Method for parsing .txt file in process pool, ranges are merged in file order"""
+        headers, ranges = File.__get_ranges(filepath)
+
+        def batches() -> Iterator[List[tuple]]:
+            line = 2
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Only 2 ranges per worker are parsed ahead to keep memory bounded
+                pending = iter(ranges)
+                futures = deque(executor.submit(_parse_txt_range, filepath, start, end, headers)
+                                for start, end in islice(pending, workers * 2))
+                while futures:
+                    columns, rows, count, errors = futures.popleft().result()
+                    for start, end in islice(pending, 1):
+                        futures.append(executor.submit(_parse_txt_range, filepath, start, end, headers))
+                    if errors:
+                        raise ValueError(File.__format_errors(filepath, [
+                            (line + number, len(headers) if column is None else column, value)
+                            for number, column, value in errors]))
+                    if rows:
+                        columns = [_TXT_TYPES[header][1](column) if header in _TXT_TYPES else column.split('\n')
+                                   for header, column in zip(headers, columns)]
+                        yield from File.__split_batches(zip(*columns), batch_size)
+                    line += count
+
+        return headers, batches()
+
+    @staticmethod
+    def __iter_xlsx(filepath: str) -> Tuple[Tuple[str, ...], Iterator[tuple]]:
+        """Method for iterating over typed rows of first sheet of .xlsx file, empty rows are skipped"""
+        workbook = load_workbook(filepath, read_only=True, data_only=True)
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        headers = list(next(rows, ()))
+        while headers and headers[-1] is None:
+            headers.pop()
+        headers = tuple(map(str, headers))
+        width = len(headers)
+
+        def data() -> Iterator[tuple]:
+            try:
+                for row in rows:
+                    if any(value is not None for value in row):
+                        yield (row + (None,) * (width - len(row)))[:width]
+            finally:
+                workbook.close()
+
+        return headers, data()
+
+    @staticmethod
+    def __read_xlsx(filepath: str) -> Tuple[Tuple[str, ...], List[tuple]]:
         """Method for reading .xlsx files"""
-        df = pd.read_excel(filepath)
-        headers = tuple(df.columns.tolist())
-        data = df.values.tolist()
+        headers, rows = File.__iter_xlsx(filepath)
+        return headers, list(rows)
+
+    @staticmethod
+    def __stream_xlsx(filepath: str, batch_size: int) -> Tuple[Tuple[str, ...], Iterator[List[tuple]]]:
+        """Method for reading .xlsx files by batches"""
+        headers, rows = File.__iter_xlsx(filepath)
+        return headers, File.__split_batches(rows, batch_size)
+
+    @staticmethod
+    def get_digest(filepath: str) -> str:
+        """Method for calculating file content hash"""
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def __to_column(values: List) -> Tuple[np.ndarray, np.ndarray]:
+        """Method for converting column values to typed array and null mask, mixed types are saved as strings"""
+        nulls = np.array([value is None for value in values], dtype=bool)
+        types = {type(value) for value in values if value is not None}
+        dtype = File.__COLUMN_TYPES.get(types.pop()) if len(types) == 1 else None
+        if dtype is None:
+            return np.array(['' if value is None else str(value) for value in values], dtype=str), nulls
+        if dtype.startswith('datetime64'):
+            return np.array(values, dtype=dtype), nulls
+        default = '' if dtype == 'str' else 0
+        return np.array([default if value is None else value for value in values], dtype=dtype), nulls
+
+    @staticmethod
+    def __save_columns(cache_file: str, headers: Tuple[str, ...], data: List[tuple]) -> None:
+        """Method for saving file data to .npz cache by columns"""
+        columns = list(zip(*data)) or [()] * len(headers)
+        arrays = {'headers': np.array(headers, dtype=str)}
+        for number, values in enumerate(columns):
+            arrays[f'values_{number}'], arrays[f'nulls_{number}'] = File.__to_column(list(values))
+        with open(f'{cache_file}.tmp', 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(f'{cache_file}.tmp', cache_file)
+
+    @staticmethod
+    def __load_columns(cache_file: str) -> Tuple[Tuple[str, ...], List[tuple]]:
+        """Method for loading file data from .npz cache"""
+        with np.load(cache_file) as arrays:
+            headers = tuple(arrays['headers'].tolist())
+            columns = [[None if null else value for value, null in zip(arrays[f'values_{number}'].tolist(),
+                                                                       arrays[f'nulls_{number}'].tolist())]
+                       for number in range(len(headers))]
+        return headers, list(zip(*columns))
+
+    def __read_cached(self, filepath: str, cache_path: str) -> Tuple[Tuple[str, ...], List[tuple]]:
+        """Method for reading file data from cache, file is parsed and cached if it is not found"""
+        self.digest = self.digest or self.get_digest(filepath)
+        cache_file = os.path.join(cache_path, f'{self.digest}.npz')
+        if os.path.exists(cache_file):
+            return self.__load_columns(cache_file)
+        headers, data = self.__HANDLER[self.ext](filepath)
+        os.makedirs(cache_path, exist_ok=True)
+        self.__save_columns(cache_file, headers, data)
         return headers, data
 
+    __COLUMN_TYPES = {str: 'str', int: 'int64', float: 'float64', bool: 'bool', datetime: 'datetime64[us]',
+                      date: 'datetime64[D]'}
+
+    __CACHED_EXTENSIONS = ('xlsx',)
+
+    __RANGE_SIZE = 1 << 24
+
     __HANDLER = {'txt': __read_txt.__func__,
                  'xlsx': __read_xlsx.__func__}
 
-    def __archive(self) -> None:
-        """Method for archiving files"""
-        old_path = f'{self.path}{os.sep}{self.filename}'
-        new_path = f'{self.path}{os.sep}archive{os.sep}{self.filename}.backup'
-        os.rename(old_path, new_path)
+    __STREAM_HANDLER = {'txt': __stream_txt.__func__,
+                        'xlsx': __stream_xlsx.__func__}
 
-    def __del__(self):
-        """Archiving file after closing"""
-        self.__archive()
+    def batches(self) -> Iterator[List[list]]:
+        """Method for iterating over file data by batches"""
+        if self.__batches is None:
+            return self.__split_batches(iter(self.data), self.batch_size or max(len(self.data), 1))
+        return self.__batches
 
 
 if __name__ == '__main__':
@@ -0,0 +1,226 @@
+from typing import Tuple, List
+from datetime import date
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pandas as pd
+from .batch import Batch
+from .database import Database
+from .partition import Partitioner
+
+
+ENRICHED_TRANSACTIONS_QUERY = '''
+    SELECT      tr.trans_id
+                ,tr.trans_date
+                ,tr.card_num
+                ,tr.oper_type
+                ,tr.oper_result
+                ,tr.amt
+                ,tr.create_dt
+                ,tr.client_id
+                ,tr.first_name
+                ,tr.last_name
+                ,tr.patronymic
+                ,tr.passport_num
+                ,tr.passport_valid_to
+                ,tr.phone
+                ,tr.account_valid_to
+                ,tr.terminal_city
+                ,({scored}) AS scored
+    FROM        deaian.trsh_dwh_fact_transaction_enriched AS tr
+    WHERE       {condition}
+    '''
+
+PASSPORT_BLACKLIST_QUERY = '''
+    SELECT      passport_num
+                ,MIN(entry_dt) AS blacklist_dt
+    FROM        deaian.trsh_dwh_fact_passport_blacklist
+    GROUP BY    passport_num;
+    '''
+
+
+class FraudEngine:
+    """Class for evaluating fraud rules of trsh_rep_fraud_sync.sql with vectorized pandas operations"""
+
+    __COLUMNS = ('event_dt', 'passport', 'fio', 'phone', 'event_type', 'report_dt')
+
+    __LOOKBACK = pd.Timedelta(hours=1)
+
+    def __init__(self, target: Database, workers: int = None) -> None:
+        self.__target = target
+        self.__workers = workers or os.cpu_count()
+
+    def __get_watermark(self) -> date:
+        """Method for getting last report date"""
+        query = '''
+                SELECT      COALESCE(MAX(report_dt), TO_DATE('1800-01-01', 'YYYY-MM-DD'))
+                FROM        deaian.trsh_rep_fraud;
+                '''
+        _, data = self.__target.select(query)
+        return data[0][0]
+
+    @staticmethod
+    def __get_condition(date_from: date = None, date_to: date = None) -> Tuple[str, dict]:
+        """Method for generating condition of transactions to be scored"""
+        if date_from is None:
+            return 'tr.create_dt > %(watermark)s', {}
+        return 'CAST(tr.create_dt AS DATE) BETWEEN %(date_from)s AND %(date_to)s', {'date_from': date_from,
+                                                                                    'date_to': date_to or date_from}
+
+    @staticmethod
+    def __to_frame(batch: Batch) -> pd.DataFrame:
+        """Method for converting columnar batch to frame, numeric and date columns are not converted by values"""
+        return pd.DataFrame({header: batch.to_numpy(header) for header in batch.headers}, columns=batch.headers)
+
+    def load(self, date_from: date = None, date_to: date = None) -> pd.DataFrame:
+        """Method for loading enriched transactions to be scored and their lookback history
+
+        Without dates transactions created after last report date are scored (as trsh_rep_fraud_sync.sql does).
+        Rules look only back in time, so transactions later than the last scored one are not read.
+        Transactions are read from trsh_dwh_fact_transaction_enriched, so ETL.enriched_update should be run before.
+        """
+        condition, params = self.__get_condition(date_from, date_to)
+        params['watermark'] = self.__get_watermark()
+        query = f'''
+                SELECT      MIN(tr.trans_date)
+                            ,MAX(tr.trans_date)
+                FROM        deaian.trsh_dwh_fact_transaction_enriched AS tr
+                WHERE       {condition};
+                '''
+        _, data = self.__target.select(query, params)
+        if data[0][0] is None:
+            return pd.DataFrame()
+        params['lookback_dt'] = data[0][0] - self.__LOOKBACK
+        params['trans_date_to'] = data[0][1]
+        query = ENRICHED_TRANSACTIONS_QUERY.format(scored=condition,
+                                                   condition='tr.trans_date BETWEEN %(lookback_dt)s '
+                                                             'AND %(trans_date_to)s')
+        frame = self.__to_frame(self.__target.select_batch(query, params))
+        frame = frame.merge(self.__to_frame(self.__target.select_batch(PASSPORT_BLACKLIST_QUERY)), on='passport_num',
+                            how='left')
+        for column in ('trans_date', 'create_dt', 'passport_valid_to', 'account_valid_to', 'blacklist_dt'):
+            frame[column] = pd.to_datetime(frame[column])
+        return frame
+
+    @staticmethod
+    def evaluate(frame: pd.DataFrame) -> pd.DataFrame:
+        """Method for evaluating all fraud rules, frame must contain all transactions of its clients"""
+        frame = frame.sort_values(['client_id', 'card_num', 'trans_date', 'trans_id'], ignore_index=True)
+        events = []
+
+        # 1. Expired or blacklisted passport
+        events.append(frame[(frame['trans_date'] > frame['passport_valid_to'])
+                            | (frame['trans_date'] > frame['blacklist_dt'])].assign(event_type=1))
+
+        # 2. Expired account
+        events.append(frame[frame['trans_date'] > frame['account_valid_to']].assign(event_type=2))
+
+        # 3. Different cities within one hour
+        city = frame[frame['terminal_city'].notna()].sort_values(['client_id', 'trans_date', 'trans_id'])
+        previous = city.groupby('client_id')[['terminal_city', 'trans_date']].shift()
+        events.append(city[(city['terminal_city'] != previous['terminal_city'])
+                           & previous['terminal_city'].notna()
+                           & (city['trans_date'] < previous['trans_date'] + pd.Timedelta(hours=1))]
+                      .assign(event_type=3))
+
+        # 4. Amount probing: 3 rejected decreasing operations and successful one within 20 minutes
+        cards = frame.groupby(['client_id', 'card_num'])
+        decreasing = (frame['amt'] < cards['amt'].shift()).astype(int)
+        rejected = (frame['oper_type'].isin(('WITHDRAW', 'PAYMENT')) & (frame['oper_result'] == 'REJECT')).astype(int)
+        frame = frame.assign(decreasing=decreasing, rejected=rejected)
+        cards = frame.groupby(['client_id', 'card_num'])
+        reduction = pd.concat([frame['decreasing'], cards['decreasing'].shift(1, fill_value=1),
+                               cards['decreasing'].shift(2, fill_value=1)], axis=1).min(axis=1)
+        operations = sum(cards['rejected'].shift(number, fill_value=0) for number in (1, 2, 3))
+        events.append(frame[frame['oper_type'].isin(('WITHDRAW', 'PAYMENT'))
+                            & (frame['oper_result'] == 'SUCCESS')
+                            & (operations == 3)
+                            & (frame['trans_date'] < cards['trans_date'].shift(3) + pd.Timedelta(minutes=20))
+                            & (reduction == 1)].assign(event_type=4))
+
+        result = pd.concat(events, ignore_index=True)
+        result = result[result['scored'].astype(bool)]
+        return pd.DataFrame({'event_dt': result['trans_date'],
+                             'passport': result['passport_num'],
+                             'fio': result[['first_name', 'last_name', 'patronymic']].apply(
+                                 lambda names: ' '.join(name for name in names if isinstance(name, str)), axis=1),
+                             'phone': result['phone'],
+                             'event_type': result['event_type'],
+                             'report_dt': result['create_dt'].dt.date}, columns=FraudEngine.__COLUMNS)
+
+    def score(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """Method for evaluating fraud rules in process pool, transactions are sharded by client"""
+        if frame.empty:
+            return pd.DataFrame(columns=self.__COLUMNS)
+        shards = [shard for _, shard in frame.groupby(
+            pd.util.hash_pandas_object(frame['client_id'], index=False) % self.__workers)]
+        if len(shards) == 1:
+            return self.evaluate(shards[0])
+        with ProcessPoolExecutor(max_workers=self.__workers) as executor:
+            return pd.concat(executor.map(self.evaluate, shards), ignore_index=True)
+
+    def run(self, date_from: date = None, date_to: date = None) -> int:
+        """Method for scoring transactions and saving frauds to report
+
+        With dates given transactions created in these dates are re-scored, previous report rows are replaced.
+        Report partitions of report dates are created before rows are inserted.
+        """
+        result = self.score(self.load(date_from, date_to))
+        if not result.empty:
+            Partitioner(self.__target).create_report(result['report_dt'].min(), result['report_dt'].max())
+        if date_from is not None:
+            query = '''
+                    DELETE FROM deaian.trsh_rep_fraud
+                    WHERE       report_dt BETWEEN %s AND %s;
+                    '''
+            self.__target.execute(query, (date_from, date_to or date_from))
+        return self.__target.copy_in(table='deaian.trsh_rep_fraud', columns=self.__COLUMNS,
+                                     rows=result.itertuples(index=False, name=None),
+                                     constants={'processed_dt': 'NOW()'})
+
+    def parity(self, script_path: str = './sql_scripts/trsh_rep_fraud_sync.sql') -> Tuple[List[tuple], List[tuple]]:
+        """Method for comparing engine result with SQL report script, returns rows missing in each of them"""
+        script = self.__target.get_script(script_path)
+        params = {'watermark': self.__get_watermark()}
+        query = '''
+                SELECT      MIN(tr.trans_date)
+                FROM        deaian.trsh_dwh_fact_transaction_enriched AS tr
+                WHERE       tr.create_dt > %(watermark)s;
+                '''
+        _, data = self.__target.select(query, params)
+        params['trans_date_from'] = data[0][0]
+        if params['trans_date_from'] is not None:
+            _, data = self.__target.select(script[script.index('SELECT'):], params)
+        else:
+            data = []
+        expected = Counter(tuple(row[:len(self.__COLUMNS)]) for row in data)
+        result = self.score(self.load())
+        actual = Counter((row[0].to_pydatetime(), *row[1:]) for row in result.itertuples(index=False, name=None))
+        return list((expected - actual).elements()), list((actual - expected).elements())
+
+
+if __name__ == '__main__':
+    # Checking parity with SQL report and measuring throughput
+    from time import perf_counter
+    trg_host = 'de-edu-db.chronosavant.ru'
+    trg_port = 5432
+    trg_database = 'edu'
+    trg_user = 'deaian'
+    trg_password = 'sarumanthewhite'
+    db = Database(host=trg_host,
+                  port=trg_port,
+                  database=trg_database,
+                  user=trg_user,
+                  password=trg_password)
+    engine = FraudEngine(db)
+
+    sql_only, engine_only = engine.parity()
+    print(f'parity: {len(sql_only)} rows only in SQL, {len(engine_only)} rows only in engine')
+
+    start = perf_counter()
+    transactions = engine.load(date_from=date(1800, 1, 1), date_to=date(9999, 12, 31))
+    loaded = perf_counter()
+    frauds = engine.score(transactions)
+    scored = perf_counter()
+    print(f'load: {len(transactions) / (loaded - start):.0f} rows/sec, '
+          f'score: {len(transactions) / (scored - loaded):.0f} rows/sec, {len(frauds)} frauds')
@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 
+import logging
+import signal
+import sys
 from py_scripts import *
 
 
@@ -11,12 +14,36 @@ def main():
                       password='bank_etl_password')
     db_tables = ('accounts', 'clients', 'cards')
 
+    max_workers = 4
+
     etl = ETL(db_tgt)
-    etl.from_file(files_src)
-    etl.from_database(db_src, db_tables)
-    etl.mart_update()
+    scheduler = Scheduler(etl, target_pool=DatabasePool(db_tgt, size=max_workers),
+                          source_pool=DatabasePool(db_src, size=max_workers), max_workers=max_workers)
+    scheduler.plan(files=files_src, tables=db_tables)
+    scheduler.run()
     etl.save()
 
 
+def daemon():
+    db_tgt = Database(host='de-edu-db.chronosavant.ru', port=5432, database='edu', user='deaian',
+                      password='sarumanthewhite')
+    db_src = Database(host='de-edu-db.chronosavant.ru', port=5432, database='bank', user='bank_etl',
+                      password='bank_etl_password')
+    db_tables = ('accounts', 'clients', 'cards')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    etl = ETL(db_tgt)
+    watcher = Daemon(etl, path='.', templates=('passport_blacklist_*.xlsx', 'terminals_*.xlsx', 'transactions_*.txt'),
+                     source=db_src, tables=db_tables, interval=60)
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
 if __name__ == '__main__':
-    main()
+    if '--daemon' in sys.argv[1:]:
+        daemon()
+    else:
+        main()
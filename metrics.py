@@ -0,0 +1,182 @@
+from typing import Iterable, Iterator, List, Dict, Union
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import perf_counter, sleep
+import cProfile
+import os
+import resource
+from .database import Database
+
+
+class Stage:
+    """Class for measurements of one ETL stage"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.extract_seconds = 0.0
+        self.rows = 0
+        self.bytes = None
+        self.peak_rss_kb = None
+
+    @contextmanager
+    def extracting(self) -> Iterator[None]:
+        """Method for measuring part of stage spent on file parsing or source fetch"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.extract_seconds += perf_counter() - start
+
+    @property
+    def rows_per_sec(self) -> Union[float, None]:
+        """Rows processed by stage per second of its wall time"""
+        return self.rows / self.seconds if self.seconds > 0 else None
+
+
+class Metrics:
+    """Class for measuring ETL stages: wall time, rows per second, bytes read and peak RSS
+
+    Peak RSS of stage is the largest resident set size of process sampled while the stage was running, stages run
+    in parallel threads share the process, so their peaks include memory of each other.
+    Stages listed in profile are run under cProfile, statistics are saved to {profile_path}/{stage}.prof.
+    Profile only one stage at a time, cProfile can not be enabled in several threads at once.
+    """
+
+    __RSS_INTERVAL = 0.05
+
+    __PROMETHEUS_STAGE = (('etl_stage_duration_seconds', 'Wall time of ETL stage', 'seconds'),
+                          ('etl_stage_extract_seconds', 'Time of file parsing or source fetch of ETL stage',
+                           'extract_seconds'),
+                          ('etl_stage_rows', 'Rows processed by ETL stage', 'rows'),
+                          ('etl_stage_rows_per_second', 'Rows processed by ETL stage per second', 'rows_per_sec'),
+                          ('etl_stage_bytes_read', 'Bytes read from files by ETL stage', 'bytes'),
+                          ('etl_stage_peak_rss_kilobytes', 'Peak resident set size of process during ETL stage',
+                           'peak_rss_kb'))
+
+    __PROMETHEUS_DATABASE = (('etl_database_calls_total', 'Database calls', 0),
+                             ('etl_database_seconds_total', 'Time spent in database calls', 1),
+                             ('etl_database_rows_total', 'Rows returned or affected by database calls', 2))
+
+    def __init__(self, prometheus_path: str = None, profile: Iterable[str] = (), profile_path: str = '.') -> None:
+        self.__prometheus_path = prometheus_path
+        self.__profile = set(profile)
+        self.__profile_path = profile_path
+        self.__stages: List[Stage] = []
+        self.__running: List[Stage] = []
+        self.__sampler: Union[Thread, None] = None
+        self.__lock = Lock()
+
+    @property
+    def stages(self) -> List[Stage]:
+        """Finished stages in order of finishing"""
+        with self.__lock:
+            return list(self.__stages)
+
+    @staticmethod
+    def __get_rss_kb() -> int:
+        """Method for getting current resident set size of process in kilobytes
+
+        Without /proc (not Linux) peak resident set size of process lifetime is returned.
+        """
+        try:
+            with open('/proc/self/statm', encoding='ascii') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def __sample_rss(self, stages: List[Stage]) -> None:
+        """Method for raising peak RSS of stages to current RSS"""
+        rss_kb = self.__get_rss_kb()
+        for stage in stages:
+            stage.peak_rss_kb = max(stage.peak_rss_kb or 0, rss_kb)
+
+    def __sample(self) -> None:
+        """Method for sampling RSS of running stages until none of them is left"""
+        while True:
+            with self.__lock:
+                if not self.__running:
+                    self.__sampler = None
+                    return
+                self.__sample_rss(self.__running)
+            sleep(self.__RSS_INTERVAL)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        """Method for measuring stage, rows and bytes are set by caller"""
+        stage = Stage(name)
+        with self.__lock:
+            self.__sample_rss([stage])
+            self.__running.append(stage)
+            if self.__sampler is None:
+                self.__sampler = Thread(target=self.__sample, name='rss-sampler', daemon=True)
+                self.__sampler.start()
+        profiler = cProfile.Profile() if name in self.__profile else None
+        if profiler is not None:
+            profiler.enable()
+        start = perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.__profile_path, f'{name}.prof'))
+            with self.__lock:
+                self.__running.remove(stage)
+                self.__sample_rss([stage])
+                self.__stages.append(stage)
+
+    def reset(self) -> None:
+        """Method for forgetting finished stages when new run starts, stages still running are kept"""
+        with self.__lock:
+            self.__stages = []
+
+    @staticmethod
+    def timed(stage: Stage, batches: Iterable[List]) -> Iterator[List]:
+        """Method for measuring time spent on producing batches (file parsing or source fetch)"""
+        batches = iter(batches)
+        while True:
+            with stage.extracting():
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+    def aggregate(self) -> Dict[str, Stage]:
+        """Method for summing stages with the same name (e.g. several files of one table)"""
+        result = {}
+        for stage in self.stages:
+            total = result.setdefault(stage.name, Stage(stage.name))
+            total.seconds += stage.seconds
+            total.extract_seconds += stage.extract_seconds
+            total.rows += stage.rows
+            if stage.bytes is not None:
+                total.bytes = (total.bytes or 0) + stage.bytes
+            total.peak_rss_kb = max(total.peak_rss_kb or 0, stage.peak_rss_kb)
+        return result
+
+    def export(self) -> None:
+        """Method for writing stages and database statistics to Prometheus text format file, if its path is given"""
+        if self.__prometheus_path is None:
+            return
+        stages = self.aggregate()
+        lines = []
+        for metric, description, attribute in self.__PROMETHEUS_STAGE:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+            for name, stage in stages.items():
+                value = getattr(stage, attribute)
+                if value is not None:
+                    lines.append(f'{metric}{{stage="{name}"}} {value}')
+        statistics = Database.get_statistics()
+        for metric, description, position in self.__PROMETHEUS_DATABASE:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} counter']
+            lines += [f'{metric}{{operation="{operation}"}} {values[position]}'
+                      for operation, values in statistics.items()]
+        with open(f'{self.__prometheus_path}.tmp', 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(f'{self.__prometheus_path}.tmp', self.__prometheus_path)
+
+
+if __name__ == '__main__':
+    pass
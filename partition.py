@@ -0,0 +1,116 @@
+from typing import Tuple, List
+from datetime import datetime, date, timedelta
+from .database import Database
+
+
+class Partitioner:
+    """Class for managing range partitions of tables partitioned by date column
+
+    Partition of day or month containing date is named {table}_p{YYYYMMDD or YYYYMM}. New partition is created as
+    standalone table and attached, rows of its range are moved from {table}_default partition.
+    """
+
+    __FORMATS = {'day': '%Y%m%d', 'month': '%Y%m'}
+
+    # Report is not loaded by mapping, its partitions are created before report rows are inserted
+    __REPORT = ('deaian', 'trsh_rep_fraud', 'report_dt', 'month')
+
+    def __init__(self, target: Database) -> None:
+        self.__target = target
+
+    @staticmethod
+    def get_bounds(dt: date, interval: str) -> Tuple[date, date]:
+        """Method for getting range of partition containing date"""
+        if interval == 'day':
+            return dt, dt + timedelta(days=1)
+        lower = dt.replace(day=1)
+        return lower, (lower + timedelta(days=32)).replace(day=1)
+
+    def get_name(self, table: str, dt: date, interval: str) -> str:
+        """Method for generating name of partition containing date"""
+        return f'{table}_p{dt.strftime(self.__FORMATS[interval])}'
+
+    def exists(self, schema: str, partition: str) -> bool:
+        """Method for checking if partition table exists"""
+        _, data = self.__target.select('SELECT TO_REGCLASS(%s);', (f'{schema}.{partition}',))
+        return data[0][0] is not None
+
+    def create_standalone(self, schema: str, table: str, column: str, interval: str,
+                          dt: date) -> Tuple[str, date, date]:
+        """Method for creating table to be attached as partition containing date
+
+        Rows of its range are moved from DEFAULT partition, check constraint lets attaching skip validation scan.
+        """
+        lower, upper = self.get_bounds(dt, interval)
+        partition = self.get_name(table, dt, interval)
+        query = f'''
+                CREATE TABLE {schema}.{partition}(LIKE {schema}.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                                                  INCLUDING INDEXES);
+                ALTER TABLE {schema}.{partition} ADD CONSTRAINT ck_{partition}
+                CHECK({column} >= %(lower)s AND {column} < %(upper)s);
+                WITH moved AS (
+                    DELETE FROM {schema}.{table}_default
+                    WHERE       {column} >= %(lower)s
+                                AND {column} < %(upper)s
+                    RETURNING   *
+                    )
+                INSERT INTO {schema}.{partition}
+                SELECT      *
+                FROM        moved;
+                '''
+        self.__target.execute(query, {'lower': lower, 'upper': upper})
+        return partition, lower, upper
+
+    def attach(self, schema: str, table: str, partition: str, lower: date, upper: date) -> None:
+        """Method for attaching standalone table as partition"""
+        query = f'''
+                ALTER TABLE {schema}.{table} ATTACH PARTITION {schema}.{partition}
+                FOR VALUES FROM (%(lower)s) TO (%(upper)s);
+                ALTER TABLE {schema}.{partition} DROP CONSTRAINT ck_{partition};
+                '''
+        self.__target.execute(query, {'lower': lower, 'upper': upper})
+
+    def create(self, schema: str, table: str, column: str, interval: str, dt: date) -> str:
+        """Method for creating partition containing date if it does not exist, returns partition name"""
+        partition = self.get_name(table, dt, interval)
+        if not self.exists(schema, partition):
+            _, lower, upper = self.create_standalone(schema, table, column, interval, dt)
+            self.attach(schema, table, partition, lower, upper)
+        return partition
+
+    def create_report(self, first_dt: date, last_dt: date) -> None:
+        """Method for creating partitions of trsh_rep_fraud for report dates from first_dt to last_dt"""
+        schema, table, column, interval = self.__REPORT
+        dt = first_dt
+        while dt <= last_dt:
+            self.create(schema=schema, table=table, column=column, interval=interval, dt=dt)
+            dt = self.get_bounds(dt, interval)[1]
+
+    def detach(self, schema: str, table: str, before: date) -> List[str]:
+        """Method for detaching partitions with all dates before given one, returns their names
+
+        Detached tables are kept, they can be archived or dropped separately.
+        """
+        query = '''
+                SELECT      child.relname
+                FROM        pg_inherits AS inh
+                            INNER JOIN pg_class AS child ON child.oid = inh.inhrelid
+                WHERE       inh.inhparent = TO_REGCLASS(%s)
+                            AND child.relname LIKE %s;
+                '''
+        _, data = self.__target.select(query, (f'{schema}.{table}', f'{table}\\_p%'))
+        detached = []
+        for partition, in data:
+            suffix = partition[len(table) + 2:]
+            interval = {8: 'day', 6: 'month'}.get(len(suffix))
+            if interval is None or not suffix.isdigit():
+                continue
+            dt = datetime.strptime(suffix, self.__FORMATS[interval]).date()
+            if self.get_bounds(dt, interval)[1] <= before:
+                self.__target.execute(f'ALTER TABLE {schema}.{table} DETACH PARTITION {schema}.{partition};')
+                detached.append(partition)
+        return detached
+
+
+if __name__ == '__main__':
+    pass
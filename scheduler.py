@@ -0,0 +1,100 @@
+from typing import Iterable, Tuple, Dict, Callable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .database import DatabasePool
+from .etl import ETL
+from .file import File
+
+
+class Scheduler:
+    """Class for running ETL stages concurrently according to their dependencies"""
+
+    def __init__(self, etl: ETL, target_pool: DatabasePool, source_pool: DatabasePool = None,
+                 max_workers: int = 4) -> None:
+        self.__etl = etl
+        self.__target_pool = target_pool
+        self.__source_pool = source_pool
+        self.__max_workers = max_workers
+        self.__stages: Dict[str, Tuple[Callable, Tuple[str, ...], bool]] = {}
+
+    def add(self, name: str, func: Callable, depends_on: Iterable[str] = (), source: bool = False) -> None:
+        """Method for adding stage, func gets source connection as argument if source is True"""
+        self.__stages[name] = (func, tuple(depends_on), source)
+
+    def plan(self, files: Iterable[str] = (), tables: Tuple[str, ...] = (), source_schema: str = 'info',
+             target_schema: str = 'deaian', prefix: str = 'trsh_stg') -> None:
+        """Method for building stages DAG from core tables mapping
+
+        Every mapped table is loaded by its own chain of stages (files of one table are loaded in date order),
+        chains of different tables are independent. Enriched transactions update depends on last stages of chains
+        planned by this call, mart update depends on enriched transactions update.
+        """
+        files_by_table = {}
+        for filepath in files:
+            _, _, name, dt, _ = File.split_name(filepath)
+            files_by_table.setdefault(f'{prefix}_{name}', []).append((dt, filepath))
+        loaded = []
+        for mapping in self.__etl.mapping:
+            stg_table = mapping.get('source_table_name')
+            dwh_table = f"{mapping.get('target_schema_name')}.{mapping.get('target_table_name')}"
+            previous = ()
+            for number, (_, filepath) in enumerate(sorted(files_by_table.get(stg_table, []))):
+                name = f'{dwh_table}:{number}'
+                self.add(name, lambda path=filepath: self.__etl.load_file(filepath=path, schema=target_schema,
+                                                                          prefix=prefix), depends_on=previous)
+                previous = (name,)
+            table = stg_table[len(prefix) + 1:]
+            if table in tables:
+                name = f'{dwh_table}:{len(previous)}'
+                self.add(name, lambda db, table=table: self.__etl.load_table(db=db, table=table,
+                                                                             source_schema=source_schema,
+                                                                             target_schema=target_schema,
+                                                                             prefix=prefix),
+                         depends_on=previous, source=True)
+                previous = (name,)
+            loaded.extend(previous)
+        self.add('enriched_update', self.__etl.enriched_update, depends_on=loaded)
+        self.add('mart_update', lambda: self.__etl.mart_update(enrich=False), depends_on=('enriched_update',))
+
+    def __run_stage(self, func: Callable, source: bool) -> None:
+        """Method for running stage on connections borrowed from pools"""
+        with self.__target_pool.connection() as target, self.__etl.bind(target):
+            if source:
+                with self.__source_pool.connection() as db:
+                    func(db)
+            else:
+                func()
+
+    def run(self) -> None:
+        """Method for running all stages, new stages are not started after first error"""
+        for name, (_, depends_on, _) in self.__stages.items():
+            unknown = set(depends_on) - set(self.__stages)
+            if unknown:
+                raise ValueError(f'Stage {name} depends on unknown stages {sorted(unknown)}')
+        pending = dict(self.__stages)
+        done = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for name, (func, depends_on, source) in list(pending.items()):
+                        if done.issuperset(depends_on):
+                            running[executor.submit(self.__run_stage, func, source)] = name
+                            del pending[name]
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        done.add(name)
+                    elif error is None:
+                        error = future.exception()
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError(f'Stages {sorted(pending)} have circular dependencies')
+
+
+if __name__ == '__main__':
+    pass
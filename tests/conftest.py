@@ -0,0 +1,94 @@
+"""Fixtures of integration tests, tests are run against PostgreSQL given by PGHOST, PGPORT, PGUSER, PGPASSWORD
+
+Repository is the py_scripts package of deployment, it is imported under this name. Every test gets its own
+database created from main.ddl and working directory with sql_scripts, as main.py is run from.
+"""
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import importlib.util
+import os
+import shutil
+import sys
+import uuid
+from openpyxl import Workbook
+import psycopg2
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if 'py_scripts' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('py_scripts', ROOT / '__init__.py',
+                                                  submodule_search_locations=[str(ROOT)])
+    sys.modules['py_scripts'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['py_scripts'])
+
+from py_scripts import Database  # noqa: E402
+
+CONNECTION = dict(host=os.environ.get('PGHOST', 'localhost'), port=int(os.environ.get('PGPORT', 5432)),
+                  user=os.environ.get('PGUSER', 'postgres'), password=os.environ.get('PGPASSWORD', ''))
+
+TRANSACTIONS_HEADER = 'transaction_id;transaction_date;amount;card_num;oper_type;oper_result;terminal'
+
+TERMINALS_HEADER = ('terminal_id', 'terminal_type', 'terminal_city', 'terminal_address')
+
+
+def _admin(query: str) -> None:
+    """Function for running statement outside of transaction in maintenance database"""
+    conn = psycopg2.connect(database='postgres', **CONNECTION)
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(query)
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def target():
+    """Parameters of new target database with objects of main.ddl"""
+    try:
+        _admin('SELECT 1;')
+    except psycopg2.OperationalError as error:
+        pytest.skip(f'PostgreSQL is not available: {error}')
+    database = f'etl_test_{uuid.uuid4().hex[:8]}'
+    _admin(f'CREATE DATABASE {database};')
+    try:
+        db = Database(database=database, **CONNECTION)
+        db.execute('CREATE SCHEMA deaian;')
+        db.execute(db.get_script(str(ROOT / 'main.ddl')))
+        db.save()
+        del db
+        yield dict(database=database, **CONNECTION)
+    finally:
+        _admin(f'DROP DATABASE IF EXISTS {database} WITH (FORCE);')
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Working directory with SQL scripts in sql_scripts"""
+    os.makedirs(tmp_path / 'sql_scripts')
+    for script in ROOT.glob('*.sql'):
+        shutil.copy(script, tmp_path / 'sql_scripts' / script.name)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def write_transactions(path: Path, dt: date, count: int = 3) -> Path:
+    """Function for writing transactions file of date with count transactions"""
+    filepath = path / f'transactions_{dt.strftime("%d%m%Y")}.txt'
+    start = datetime.combine(dt, datetime.min.time())
+    lines = [TRANSACTIONS_HEADER] + [f'{dt:%d%m}{number:04d};{start + timedelta(minutes=number):%Y-%m-%d %H:%M:%S};'
+                                     f'{100 + number},50;0000 0000 0000 0001;PAYMENT;SUCCESS;T0001'
+                                     for number in range(count)]
+    filepath.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return filepath
+
+
+def write_terminals(path: Path, dt: date, cities: dict) -> Path:
+    """Function for writing terminals snapshot of date, cities are terminal_city by terminal_id"""
+    filepath = path / f'terminals_{dt.strftime("%d%m%Y")}.xlsx'
+    workbook = Workbook()
+    workbook.active.append(TERMINALS_HEADER)
+    for terminal, city in cities.items():
+        workbook.active.append((terminal, 'ATM', city, f'{city}, {terminal}'))
+    workbook.save(filepath)
+    return filepath
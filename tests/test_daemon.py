@@ -0,0 +1,26 @@
+from datetime import date
+from threading import Thread
+import time
+from conftest import write_transactions
+from py_scripts import Daemon, Database, ETL
+
+
+def test_backlog_of_one_feed_is_loaded_in_one_micro_batch(target, workdir):
+    files = [write_transactions(workdir, date(2021, 3, 1)), write_transactions(workdir, date(2021, 3, 2))]
+    db = Database(**target)
+    daemon = Daemon(ETL(db), path=str(workdir), templates=('transactions_*.txt',), interval=0.1)
+    thread = Thread(target=daemon.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while any(filepath.exists() for filepath in files) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    daemon.stop()
+    thread.join(30)
+
+    _, data = db.select('SELECT file_dt, run_id FROM deaian.trsh_meta_file_ingest ORDER BY file_dt;')
+    assert [file_dt for file_dt, _ in data] == [date(2021, 3, 1), date(2021, 3, 2)]
+    assert data[0][1] == data[1][1]
+    _, data = db.select('SELECT CAST(create_dt AS DATE), COUNT(*) FROM deaian.trsh_dwh_fact_transaction '
+                        'GROUP BY 1 ORDER BY 1;')
+    assert data == [(date(2021, 3, 1), 3), (date(2021, 3, 2), 3)]
+    assert not any(filepath.exists() for filepath in files)
@@ -0,0 +1,83 @@
+from typing import Set
+from datetime import date
+from conftest import write_transactions
+from py_scripts import Database, ETL
+
+DIMENSIONS = ('''INSERT INTO deaian.trsh_dwh_dim_cards_hist(card_num, account_num, effective_from, processed_dt)
+                 VALUES('0000 0000 0000 0001', 'A1', '1900-01-01', NOW());''',
+              '''INSERT INTO deaian.trsh_dwh_dim_accounts_hist(account_num, valid_to, client, effective_from,
+                                                               processed_dt)
+                 VALUES('A1', '2030-01-01', 'C1', '1900-01-01', NOW());''',
+              '''INSERT INTO deaian.trsh_dwh_dim_clients_hist(client_id, last_name, first_name, date_of_birth,
+                                                              passport_num, effective_from, processed_dt)
+                 VALUES('C1', 'Ivanov', 'Ivan', '1990-01-01', 'P1', '1900-01-01', NOW());''')
+
+TERMINALS = ('''INSERT INTO deaian.trsh_dwh_dim_terminals_hist(terminal_id, terminal_type, terminal_city,
+                                                                terminal_address, effective_from, processed_dt)
+                 VALUES('T0001', 'ATM', 'Moscow', 'Moscow, 1', '1900-01-01', NOW());''',)
+
+
+def enrich(db: Database) -> int:
+    """Function for running enriched update in new run, returns rows upserted"""
+    etl = ETL(db)
+    etl.enriched_update()
+    etl.save()
+    _, data = db.select("SELECT rows_inserted FROM deaian.trsh_meta_etl_run_log "
+                        "WHERE table_name = 'trsh_dwh_fact_transaction_enriched' ORDER BY run_id DESC LIMIT 1;")
+    return data[0][0]
+
+
+def test_late_and_unresolved_transactions_are_enriched_again(target, workdir):
+    db = Database(**target)
+    for query in DIMENSIONS:
+        db.execute(query)
+    etl = ETL(db)
+    etl.load_file(str(write_transactions(workdir, date(2021, 3, 1))))
+    etl.save()
+    assert enrich(db) == 3
+
+    # Transaction committed after enriched update, but processed before it
+    db.execute("INSERT INTO deaian.trsh_dwh_fact_transaction(trans_id, trans_date, card_num, oper_type, amt, "
+               "oper_result, terminal, create_dt, processed_dt) VALUES('late', '2021-03-01 12:00', "
+               "'0000 0000 0000 0001', 'PAYMENT', 10, 'SUCCESS', 'T0001', '2021-03-01', '2000-01-01');")
+    db.execute("INSERT INTO deaian.trsh_dwh_dim_terminals_hist(terminal_id, terminal_type, terminal_city, "
+               "terminal_address, effective_from, processed_dt) VALUES('T0001', 'ATM', 'Moscow', 'Moscow, 1', "
+               "'1900-01-01', NOW());")
+    db.save()
+    assert enrich(db) == 4
+    assert enrich(db) == 0
+    _, data = db.select('SELECT trans_id, terminal_city FROM deaian.trsh_dwh_fact_transaction_enriched '
+                        'ORDER BY trans_id;')
+    assert data == [('01030000', 'Moscow'), ('01030001', 'Moscow'), ('01030002', 'Moscow'), ('late', 'Moscow')]
+
+
+def get_fact_partitions(node: dict) -> Set[str]:
+    """Function for getting fact partitions scanned by plan node and its children"""
+    relations = {node['Relation Name']} if node.get('Relation Name', '').startswith('trsh_dwh_fact_transaction_p') \
+        else set()
+    return relations.union(*(get_fact_partitions(child) for child in node.get('Plans', ())))
+
+
+def test_enriched_update_reads_only_recent_partitions(target, workdir):
+    db = Database(**target, capture_plans=True)
+    for query in DIMENSIONS + TERMINALS:
+        db.execute(query)
+    for day in range(1, 4):
+        etl = ETL(db)
+        etl.load_file(str(write_transactions(workdir, date(2021, 3, day))))
+        etl.save()
+    assert enrich(db) == 9
+
+    # New day and file of earlier day loaded after enriched update
+    etl = ETL(db)
+    etl.load_file(str(write_transactions(workdir, date(2021, 3, 4))))
+    etl.load_file(str(write_transactions(workdir, date(2021, 3, 1), count=4)))
+    etl.save()
+    Database.get_plans()
+    ETL(db).enriched_update()
+    plans = [plan for plan in Database.get_plans()
+             if 'INSERT INTO deaian.trsh_dwh_fact_transaction_enriched' in plan['query']]
+    assert len(plans) == 1
+    assert get_fact_partitions(plans[0]['plan']['Plan']) == {'trsh_dwh_fact_transaction_p20210301',
+                                                             'trsh_dwh_fact_transaction_p20210303',
+                                                             'trsh_dwh_fact_transaction_p20210304'}
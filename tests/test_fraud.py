@@ -0,0 +1,90 @@
+from collections import Counter
+from datetime import date, datetime
+from py_scripts import Database, FraudDetector, FraudEngine
+
+ENRICHED_COLUMNS = ('trans_id', 'trans_date', 'card_num', 'oper_type', 'oper_result', 'amt', 'terminal', 'create_dt',
+                    'account_num', 'account_valid_to', 'client_id', 'first_name', 'last_name', 'patronymic',
+                    'passport_num', 'passport_valid_to', 'phone', 'terminal_city')
+
+CLIENTS = {'C1': ('P1', date(2021, 2, 1), date(2030, 1, 1)),  # 1. expired passport
+           'C2': ('P2', None, date(2030, 1, 1)),  # 1. blacklisted passport
+           'C3': ('P3', None, date(2021, 2, 1)),  # 2. expired account
+           'C4': ('P4', date(2030, 1, 1), date(2030, 1, 1)),  # 3. different cities within one hour
+           'C5': ('P5', date(2030, 1, 1), date(2030, 1, 1)),  # 4. amount probing
+           'C6': ('P6', date(2030, 1, 1), date(2030, 1, 1))}  # no frauds
+
+TRANSACTIONS = [('C1', '2021-03-01 09:00', 'PAYMENT', 'SUCCESS', 100, 'Moscow'),
+                ('C2', '2021-03-01 09:00', 'PAYMENT', 'SUCCESS', 100, 'Moscow'),
+                ('C3', '2021-03-01 09:00', 'WITHDRAW', 'SUCCESS', 100, None),
+                ('C4', '2021-03-01 23:40', 'PAYMENT', 'SUCCESS', 100, 'Moscow'),
+                ('C4', '2021-03-02 00:10', 'PAYMENT', 'SUCCESS', 100, 'Kazan'),
+                ('C4', '2021-03-02 03:00', 'PAYMENT', 'SUCCESS', 100, 'Omsk'),
+                ('C5', '2021-03-02 10:00', 'WITHDRAW', 'REJECT', 1000, 'Moscow'),
+                ('C5', '2021-03-02 10:05', 'WITHDRAW', 'REJECT', 900, 'Moscow'),
+                ('C5', '2021-03-02 10:10', 'WITHDRAW', 'REJECT', 800, 'Moscow'),
+                ('C5', '2021-03-02 10:15', 'WITHDRAW', 'SUCCESS', 700, 'Moscow'),
+                ('C6', '2021-03-02 10:00', 'WITHDRAW', 'REJECT', 1000, 'Moscow'),
+                ('C6', '2021-03-02 10:05', 'WITHDRAW', 'REJECT', 900, 'Moscow'),
+                ('C6', '2021-03-02 10:30', 'WITHDRAW', 'SUCCESS', 800, 'Moscow')]
+
+
+def write_enriched(db: Database) -> None:
+    """Function for writing enriched transactions and passport blacklist of fixture"""
+    rows = []
+    for number, (client, trans_date, oper_type, oper_result, amt, city) in enumerate(TRANSACTIONS):
+        passport, passport_valid_to, account_valid_to = CLIENTS[client]
+        trans_date = datetime.fromisoformat(trans_date)
+        rows.append((f'{number:04d}', trans_date, f'0000 0000 0000 000{client[1]}', oper_type, oper_result, amt,
+                     'T0001', datetime.combine(trans_date.date(), datetime.min.time()), f'A{client}',
+                     account_valid_to, client, 'Ivan', 'Ivanov', None, passport, passport_valid_to,
+                     '+7 900 000 00 00', city))
+    db.copy_in(table='deaian.trsh_dwh_fact_transaction_enriched', columns=ENRICHED_COLUMNS, rows=rows,
+               constants={'processed_dt': 'NOW()'})
+    db.execute('INSERT INTO deaian.trsh_dwh_fact_passport_blacklist(passport_num, entry_dt, create_dt, processed_dt) '
+               "VALUES('P2', '2021-02-15', NOW(), NOW());")
+    db.save()
+
+
+def test_engine_and_detector_match_sql_report(target, workdir):
+    db = Database(**target)
+    write_enriched(db)
+    engine = FraudEngine(db, workers=1)
+
+    sql_only, engine_only = engine.parity()
+    assert sql_only == [] and engine_only == []
+    result = engine.score(engine.load())
+    assert sorted(result['event_type']) == [1, 1, 2, 3, 4]
+    FraudDetector(db).run()
+    _, data = db.select('SELECT event_dt, passport, fio, phone, event_type, report_dt FROM deaian.trsh_rep_fraud;')
+    assert Counter(data) == Counter((row[0].to_pydatetime(), *row[1:])
+                                    for row in result.itertuples(index=False, name=None))
+    _, data = db.select('SELECT COUNT(*) FROM deaian.trsh_rep_fraud_default;')
+    assert data == [(0,)]
+
+
+def test_engine_reads_history_only_up_to_last_scored_transaction(target, workdir):
+    db = Database(**target)
+    write_enriched(db)
+    frame = FraudEngine(db, workers=1).load(date(2021, 3, 1), date(2021, 3, 1))
+
+    assert frame['trans_date'].max() == datetime(2021, 3, 1, 23, 40)
+    assert frame['scored'].all()
+
+
+def test_engine_saves_report_to_partition_of_report_month(target, workdir):
+    db = Database(**target)
+    write_enriched(db)
+    assert FraudEngine(db, workers=1).run() == 5
+    db.save()
+
+    _, data = db.select('SELECT tableoid::REGCLASS::TEXT, COUNT(*) FROM deaian.trsh_rep_fraud GROUP BY 1;')
+    assert data == [('deaian.trsh_rep_fraud_p202103', 5)]
+
+
+def test_engine_input_keeps_backslash_n_text_apart_from_null(target):
+    batch = Database(**target).select_batch(r"SELECT '\N' AS patronymic, NULL::TEXT AS phone, E'a\tb\\' AS fio "
+                                            r"UNION ALL SELECT NULL, '\N', '\\N';")
+
+    assert batch.to_numpy('patronymic').tolist() == ['\\N', None]
+    assert batch.to_numpy('phone').tolist() == [None, '\\N']
+    assert batch.to_numpy('fio').tolist() == ['a\tb\\', '\\\\N']
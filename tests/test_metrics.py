@@ -0,0 +1,29 @@
+from time import sleep
+from py_scripts import Database, ETL, Metrics
+
+
+def test_peak_rss_is_measured_per_stage():
+    metrics = Metrics()
+    with metrics.stage('large'):
+        data = b'x' * (200 * 1024 * 1024)
+        sleep(0.2)
+        del data
+    with metrics.stage('small'):
+        sleep(0.2)
+
+    large, small = metrics.stages
+    assert large.peak_rss_kb - small.peak_rss_kb > 100 * 1024
+
+
+def test_new_run_exports_stages_of_this_run_only(target, tmp_path):
+    metrics = Metrics(prometheus_path=str(tmp_path / 'etl.prom'))
+    etl = ETL(Database(**target), metrics=metrics)
+    for _ in range(2):
+        etl.new_run()
+        with metrics.stage('load') as stage:
+            stage.rows = 5
+        etl.save()
+
+    assert len(metrics.stages) == 1
+    lines = (tmp_path / 'etl.prom').read_text(encoding='utf-8').splitlines()
+    assert [line for line in lines if line.startswith('etl_stage_rows{')] == ['etl_stage_rows{stage="load"} 5']
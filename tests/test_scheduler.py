@@ -0,0 +1,38 @@
+from datetime import date
+from conftest import write_transactions
+from py_scripts import Database, DatabasePool, ETL, FileFinder, Scheduler
+
+
+def test_chain_of_files_of_one_table_is_loaded_in_one_run(target, workdir):
+    write_transactions(workdir, date(2021, 3, 1))
+    write_transactions(workdir, date(2021, 3, 2))
+    db = Database(**target)
+    etl = ETL(db)
+    scheduler = Scheduler(etl, target_pool=DatabasePool(db, size=2), max_workers=2)
+    scheduler.plan(files=FileFinder(path=str(workdir), templates=('transactions_*.txt',)))
+    scheduler.run()
+    etl.save()
+
+    _, data = db.select('SELECT CAST(create_dt AS DATE), COUNT(*) FROM deaian.trsh_dwh_fact_transaction '
+                        'GROUP BY 1 ORDER BY 1;')
+    assert data == [(date(2021, 3, 1), 3), (date(2021, 3, 2), 3)]
+    _, data = db.select("SELECT COUNT(DISTINCT run_id), ARRAY_AGG(load_no ORDER BY load_no), SUM(rows_inserted) "
+                        "FROM deaian.trsh_meta_etl_run_log WHERE table_name = 'trsh_stg_transactions';")
+    assert data == [(1, [1, 2], 6)]
+
+
+def test_planning_again_does_not_make_enriched_update_depend_on_itself(target, workdir):
+    write_transactions(workdir, date(2021, 3, 1))
+    db = Database(**target)
+    etl = ETL(db)
+    scheduler = Scheduler(etl, target_pool=DatabasePool(db, size=2), max_workers=2)
+    scheduler.plan(files=FileFinder(path=str(workdir), templates=('transactions_*.txt',)))
+    scheduler.plan(files=FileFinder(path=str(workdir), templates=('transactions_*.txt',)))
+    scheduler.run()
+    etl.save()
+
+    _, data = db.select('SELECT COUNT(*) FROM deaian.trsh_dwh_fact_transaction_enriched;')
+    assert data == [(0,)]
+    _, data = db.select("SELECT COUNT(*) FROM deaian.trsh_meta_etl_run_log "
+                        "WHERE table_name = 'trsh_dwh_fact_transaction_enriched';")
+    assert data == [(1,)]
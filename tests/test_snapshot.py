@@ -0,0 +1,82 @@
+from datetime import date, datetime
+from conftest import write_terminals
+from py_scripts import Database, ETL
+
+OPEN_END = datetime(9999, 12, 31)
+
+
+def get_terminals(db: Database) -> list:
+    """Function for getting current versions of terminals"""
+    _, data = db.select('SELECT terminal_id, terminal_city, deleted_flg FROM deaian.trsh_dwh_dim_terminals_hist '
+                        'WHERE effective_to = %s ORDER BY terminal_id;', (OPEN_END,))
+    return data
+
+
+def get_staged(db: Database, table: str) -> list:
+    """Function for getting rows inserted to STG table by every run"""
+    _, data = db.select('SELECT rows_inserted FROM deaian.trsh_meta_etl_run_log WHERE table_name = %s '
+                        'ORDER BY run_id;', (table,))
+    return [rows for rows, in data]
+
+
+def test_only_delta_of_snapshot_is_staged(target, workdir):
+    snapshots = [{'T1': 'Moscow', 'T2': 'Kazan', 'T3': 'Omsk'},
+                 {'T1': 'Moscow', 'T2': 'Perm', 'T3': 'Omsk', 'T4': 'Tver'},
+                 {'T1': 'Moscow', 'T2': 'Kazan', 'T4': 'Tver'}]
+    db = Database(**target)
+    for day, cities in enumerate(snapshots, start=1):
+        etl = ETL(db)
+        etl.load_file(str(write_terminals(workdir, date(2021, 3, day), cities)))
+        etl.save()
+
+    assert get_staged(db, 'trsh_stg_terminals') == [3, 2, 1]
+    assert get_staged(db, 'trsh_stg_terminals_del') == [0, 1]
+    assert get_terminals(db) == [('T1', 'Moscow', False), ('T2', 'Kazan', False), ('T3', 'Omsk', True),
+                                 ('T4', 'Tver', False)]
+    _, data = db.select("SELECT COUNT(*) FROM deaian.trsh_meta_snapshot_digest "
+                        "WHERE table_name = 'trsh_stg_terminals';")
+    assert data == [(3,)]
+
+
+def test_daily_load_after_backfill_is_diffed_against_last_backfilled_snapshot(target, workdir):
+    db = Database(**target)
+    etl = ETL(db)
+    etl.load_file(str(write_terminals(workdir, date(2021, 3, 1), {'T1': 'Moscow', 'T2': 'Kazan'})))
+    etl.save()
+    etl = ETL(db)
+    etl.backfill([str(write_terminals(workdir, date(2021, 3, 2), {'T1': 'Moscow', 'T2': 'Perm', 'T3': 'Omsk'})),
+                  str(write_terminals(workdir, date(2021, 3, 3), {'T1': 'Moscow', 'T2': 'Perm', 'T3': 'Omsk'}))])
+    etl.save()
+    etl = ETL(db)
+    etl.load_file(str(write_terminals(workdir, date(2021, 3, 4), {'T1': 'Moscow', 'T2': 'Kazan', 'T4': 'Tver'})))
+    etl.save()
+
+    assert get_terminals(db) == [('T1', 'Moscow', False), ('T2', 'Kazan', False), ('T3', 'Omsk', True),
+                                 ('T4', 'Tver', False)]
+    assert get_staged(db, 'trsh_stg_terminals')[-1] == 2
+
+
+def test_rows_without_row_hash_are_compared_by_values(target, workdir):
+    db = Database(**target)
+    etl = ETL(db)
+    etl.load_file(str(write_terminals(workdir, date(2021, 3, 1), {'T1': 'Moscow', 'T2': 'Kazan', 'T3': 'Omsk'})))
+    etl.save()
+    # DWH rows loaded before row hash and snapshot digest were added
+    db.execute('UPDATE deaian.trsh_dwh_dim_terminals_hist SET row_hash = NULL;')
+    db.execute('DELETE FROM deaian.trsh_meta_snapshot_digest;')
+    db.save()
+    etl = ETL(db)
+    etl.load_file(str(write_terminals(workdir, date(2021, 3, 2), {'T1': 'Moscow', 'T2': 'Perm', 'T3': 'Omsk'})))
+    etl.save()
+    db.execute('UPDATE deaian.trsh_dwh_dim_terminals_hist SET row_hash = NULL;')
+    db.save()
+    etl = ETL(db)
+    etl.backfill([str(write_terminals(workdir, date(2021, 3, 3), {'T1': 'Moscow', 'T2': 'Perm'})),
+                  str(write_terminals(workdir, date(2021, 3, 4), {'T1': 'Moscow', 'T2': 'Perm', 'T4': 'Tver'}))])
+    etl.save()
+
+    _, data = db.select('SELECT terminal_id, COUNT(*) FROM deaian.trsh_dwh_dim_terminals_hist '
+                        'GROUP BY terminal_id ORDER BY terminal_id;')
+    assert data == [('T1', 1), ('T2', 2), ('T3', 2), ('T4', 1)]
+    assert get_terminals(db) == [('T1', 'Moscow', False), ('T2', 'Perm', False), ('T3', 'Omsk', True),
+                                 ('T4', 'Tver', False)]
@@ -0,0 +1,69 @@
+-- Resolving new and updated transactions to card, account, client and terminal versions valid at transaction date
+INSERT INTO deaian.trsh_dwh_fact_transaction_enriched(trans_id, trans_date, card_num, oper_type, oper_result, amt, terminal, create_dt, account_num, account_valid_to, client_id, first_name, last_name, patronymic, passport_num, passport_valid_to, phone, terminal_city, processed_dt)
+SELECT		DISTINCT ON (tr.trans_id)
+			tr.trans_id
+			,tr.trans_date
+			,tr.card_num
+			,tr.oper_type
+			,tr.oper_result
+			,tr.amt
+			,tr.terminal
+			,tr.create_dt
+			,ac.account_num
+			,ac.valid_to AS account_valid_to
+			,cl.client_id
+			,cl.first_name
+			,cl.last_name
+			,cl.patronymic
+			,cl.passport_num
+			,cl.passport_valid_to
+			,cl.phone
+			,t.terminal_city
+			,NOW() AS processed_dt
+FROM		deaian.trsh_dwh_fact_transaction AS tr
+			INNER JOIN deaian.trsh_dwh_dim_cards_hist AS c ON tr.card_num = c.card_num
+				AND tr.trans_date BETWEEN c.effective_from AND c.effective_to
+			INNER JOIN deaian.trsh_dwh_dim_accounts_hist AS ac ON c.account_num = ac.account_num
+				AND tr.trans_date BETWEEN ac.effective_from AND ac.effective_to
+			INNER JOIN deaian.trsh_dwh_dim_clients_hist AS cl ON ac.client = cl.client_id
+				AND tr.trans_date BETWEEN cl.effective_from AND cl.effective_to
+			LEFT JOIN deaian.trsh_dwh_dim_terminals_hist AS t ON t.terminal_id = tr.terminal
+				AND tr.trans_date BETWEEN t.effective_from AND t.effective_to
+WHERE		(
+			-- Partitions from last enriched create date are read again, rows committed after previous run are not skipped
+			tr.create_dt >= %(create_dt_from)s
+			-- Earlier partitions of files loaded since previous run and of rows enriched while terminal was missing
+			OR tr.create_dt = ANY(%(create_dates)s)
+			)
+			-- Rows already enriched with the same values are not rewritten
+			AND NOT EXISTS(	SELECT		1
+							FROM		deaian.trsh_dwh_fact_transaction_enriched AS e
+							WHERE		e.trans_id = tr.trans_id
+										AND e.create_dt = tr.create_dt
+										AND e.trans_date = tr.trans_date
+										AND e.card_num = tr.card_num
+										AND e.oper_type = tr.oper_type
+										AND e.oper_result = tr.oper_result
+										AND e.amt = tr.amt
+										AND e.terminal = tr.terminal
+										AND (e.terminal_city IS NOT NULL OR t.terminal_id IS NULL))
+ORDER BY	tr.trans_id, c.effective_from DESC, ac.effective_from DESC, cl.effective_from DESC, t.effective_from DESC NULLS LAST
+ON CONFLICT (trans_id) DO UPDATE
+SET			trans_date = EXCLUDED.trans_date
+			,card_num = EXCLUDED.card_num
+			,oper_type = EXCLUDED.oper_type
+			,oper_result = EXCLUDED.oper_result
+			,amt = EXCLUDED.amt
+			,terminal = EXCLUDED.terminal
+			,create_dt = EXCLUDED.create_dt
+			,account_num = EXCLUDED.account_num
+			,account_valid_to = EXCLUDED.account_valid_to
+			,client_id = EXCLUDED.client_id
+			,first_name = EXCLUDED.first_name
+			,last_name = EXCLUDED.last_name
+			,patronymic = EXCLUDED.patronymic
+			,passport_num = EXCLUDED.passport_num
+			,passport_valid_to = EXCLUDED.passport_valid_to
+			,phone = EXCLUDED.phone
+			,terminal_city = EXCLUDED.terminal_city
+			,processed_dt = EXCLUDED.processed_dt;